@@ -20,22 +20,34 @@
 # purpose: when you are riding the flow and you gotta know . . .
 
 from math import *
+import threading
 import numpy as np
 import pandas as pd
 from gdal_raster_utils import *
+from profiler import *
+from kriging import *
 from scipy.spatial import cKDTree as KDTree
 
 class assimilations:
     '''
     generic assimilations class
     '''
-    def __init__ (self, params):
+    def __init__ (self, params, prof = None):
         '''
         initialize assimilation arrays
         params = a parameter object
+        prof = a profiler object to record stage timings (optional, disabled if None)
         '''
         self.params = params
+        if prof is None:
+            prof = profiler ()                          # a disabled profiler
+        self.profiler = prof
         self.assimilation_bounds_set = False            # flag if assimilation bounds fixed
+        self.lock = threading.Lock ()                   # guards setting and copying the rasters
+        self.grid_spec = None                           # the definition of the present grid
+        self.assimilation_bounds_3d_set = False         # flag if 3D assimilation bounds fixed
+        self.voxel_names = ('flow_x_mean', 'flow_y_mean', 'flow_x_sd', 'flow_y_sd', 'flow_x_med',
+                            'flow_y_med', 'flow_vel', 'flow_az')
         return
     
     def initialize (self, prototype_filename = None, originX = None, originY = None, cell_Width = None,
@@ -51,70 +63,242 @@ class assimilations:
         ncols = the number of columns
         nrows = the number of rows
         '''
+        # skip the re-initialization if the grid has not changed
+        grid_spec = (prototype_filename, originX, originY, cell_Width, cell_Height, ncols, nrows,
+                     self.params.compact_storage)
+        if self.assimilation_bounds_set and grid_spec == self.grid_spec:
+            return
+        self.grid_spec = grid_spec
+        
+        dtype = np.float64
+        if self.params.compact_storage:
+            dtype = np.float32                          # matches the GDT_Float32 written to disk
+        
         self.flow_x_mean = ref_raster (prototype_filename = prototype_filename, originX = originX, originY = originY,
-                                       cell_Width = cell_Width, cell_Height = cell_Height, ncols = ncols, nrows = nrows)
+                                       cell_Width = cell_Width, cell_Height = cell_Height, ncols = ncols, nrows = nrows,
+                                       dtype = dtype)
         self.flow_y_mean = ref_raster (prototype_filename = prototype_filename, originX = originX, originY = originY,
-                                       cell_Width = cell_Width, cell_Height = cell_Height, ncols = ncols, nrows = nrows)
+                                       cell_Width = cell_Width, cell_Height = cell_Height, ncols = ncols, nrows = nrows,
+                                       dtype = dtype)
         self.flow_x_sd = ref_raster (prototype_filename = prototype_filename, originX = originX, originY = originY,
-                                       cell_Width = cell_Width, cell_Height = cell_Height, ncols = ncols, nrows = nrows)
+                                       cell_Width = cell_Width, cell_Height = cell_Height, ncols = ncols, nrows = nrows,
+                                       dtype = dtype)
         self.flow_y_sd = ref_raster (prototype_filename = prototype_filename, originX = originX, originY = originY,
-                                       cell_Width = cell_Width, cell_Height = cell_Height, ncols = ncols, nrows = nrows)
+                                       cell_Width = cell_Width, cell_Height = cell_Height, ncols = ncols, nrows = nrows,
+                                       dtype = dtype)
         self.flow_x_med = ref_raster (prototype_filename = prototype_filename, originX = originX, originY = originY,
-                                       cell_Width = cell_Width, cell_Height = cell_Height, ncols = ncols, nrows = nrows)
+                                       cell_Width = cell_Width, cell_Height = cell_Height, ncols = ncols, nrows = nrows,
+                                       dtype = dtype)
         self.flow_y_med = ref_raster (prototype_filename = prototype_filename, originX = originX, originY = originY,
-                                       cell_Width = cell_Width, cell_Height = cell_Height, ncols = ncols, nrows = nrows)
+                                       cell_Width = cell_Width, cell_Height = cell_Height, ncols = ncols, nrows = nrows,
+                                       dtype = dtype)
         self.flow_vel = ref_raster (prototype_filename = prototype_filename, originX = originX, originY = originY,
-                                       cell_Width = cell_Width, cell_Height = cell_Height, ncols = ncols, nrows = nrows)
+                                       cell_Width = cell_Width, cell_Height = cell_Height, ncols = ncols, nrows = nrows,
+                                       dtype = dtype)
         self.flow_az = ref_raster (prototype_filename = prototype_filename, originX = originX, originY = originY,
-                                       cell_Width = cell_Width, cell_Height = cell_Height, ncols = ncols, nrows = nrows)
+                                       cell_Width = cell_Width, cell_Height = cell_Height, ncols = ncols, nrows = nrows,
+                                       dtype = dtype)
         self.assimilation_bounds_set = True
         return
     
+    def get_rasters (self):
+        '''
+        method to return copies of the assimilation rasters as a dictionary of numpy arrays
+        '''
+        rasters = {}
+        with self.lock:
+            for name in self.voxel_names:
+                rasters[name] = getattr (self, name).ras.copy ()
+        return (rasters)
+    
+    def set_rasters (self, rasters):
+        '''
+        method to set the assimilation rasters from a dictionary of numpy arrays (see get_rasters),
+        all the rasters are set together, so readers never see a mix of two assimilations
+        rasters = dictionary of numpy arrays
+        '''
+        with self.lock:
+            for name in self.voxel_names:
+                getattr (self, name).ras = rasters[name].copy ()
+        return
+    
+    def raster_bytes (self):
+        '''
+        method to report the memory used by the assimilation rasters (bytes)
+        '''
+        total = 0
+        for ras in (self.flow_x_mean, self.flow_y_mean, self.flow_x_sd, self.flow_y_sd,
+                    self.flow_x_med, self.flow_y_med, self.flow_vel, self.flow_az):
+            total = total + ras.ras.nbytes
+        return (total)
+    
     def assimilate (self, intersections):
         '''
         method to interpolate to the raster grids, note presently this only does 2d intersections
         intersections = supplied intersections dataframe
         '''
+        self.set_rasters (self.compute_rasters (intersections))
+        return
+    
+    def compute_rasters (self, intersections):
+        '''
+        method to compute the assimilation rasters without touching the stored rasters, so calls
+        for different intersections can run at the same time (e.g., through the assimilation cache).
+        Uses inverse distance weighting, or local ordinary kriging (see kriging.py) if
+        params.assimilation_method is 'kriging', where the sd rasters are the kriging standard deviations
+        intersections = supplied intersections dataframe
+        returns a dictionary of numpy arrays (see get_rasters)
+        '''
+        self.profiler.begin_event ()
+        tic = self.profiler.tic ()
+        
         # get relevant variables as np arrays
-        flow_x_all = np.array (intersections['flow_x'])
-        flow_y_all = np.array (intersections['flow_y'])
-        int_weight_full = np.array (intersections['weight'])
-                
-        # create KDTree for subsetting to neighbors
-        locs = np.array (zip (intersections['x'], intersections['y']))
+        flow_x_all = np.array (intersections['flow_x'], dtype = float)
+        flow_y_all = np.array (intersections['flow_y'], dtype = float)
+        int_weight_full = np.array (intersections['weight'], dtype = float)
+        locs = np.column_stack ((np.array (intersections['x'], dtype = float),
+                                 np.array (intersections['y'], dtype = float)))
+        
+        # all the cell centers (row, col order to match the arrays)
+        col, row = np.meshgrid (np.arange (0, self.flow_x_mean.ncols), np.arange (0, self.flow_x_mean.nrows))
+        points = np.column_stack ((self.flow_x_mean.x_index[col.ravel ()], self.flow_x_mean.y_index[row.ravel ()]))
+        
+        if self.params.assimilation_method == 'kriging':
+            krig = kriging (self.params)
+            results = krig.predict (locs, flow_x_all, flow_y_all, int_weight_full, points)
+            self.kriging = krig                         # keep the fitted variograms
+        else:
+            # inverse distance weighting, the same as the 3D assimilations and the parameter sweeps
+            tree = KDTree (locs, leafsize = 10)
+            results = self.idw_query (tree, flow_x_all, flow_y_all, int_weight_full, points)
+        
+        rasters = {}
+        shape = self.flow_x_mean.ras.shape
+        dtype = self.flow_x_mean.ras.dtype
+        for name, result in zip (self.voxel_names[0:6], results):
+            rasters[name] = result.reshape (shape).astype (dtype)
+        
+        # compute convenience vectors
+        rasters['flow_vel'] = np.sqrt (rasters['flow_x_mean']**2.0 + rasters['flow_y_mean']**2.0)
+        rasters['flow_az'] = (np.arctan2 (rasters['flow_x_mean'], rasters['flow_y_mean']) * 180 / pi) % 360.0
+        
+        self.profiler.count ('assimilation_cells', self.flow_x_mean.nrows * self.flow_x_mean.ncols)
+        self.profiler.toc ('assimilate', tic)
+        self.profiler.end_event ('assimilate')
+        return (rasters)
+    
+    def initialize_3d (self, prototype_filename = None, originX = None, originY = None, originZ = None,
+                       cell_Width = None, cell_Height = None, cell_Depth = None, ncols = None, nrows = None,
+                       nlayers = None):
+        '''
+        method to initialize voxel grids for 3D assimilations, the horizontal grid comes from either a
+        prototype raster or pre-defined bounds
+        prototype_filename = properly projected prototype raster for the horizontal grid (optional)
+        originX = the X origin location (m)
+        originY = the Y origin location (m)
+        originZ = the Z location of the bottom of the lowest layer (m)
+        cell_Width = the width of cells (m)
+        cell_Height = the height of cells (m)
+        cell_Depth = the thickness of the layers (m)
+        ncols = the number of columns
+        nrows = the number of rows
+        nlayers = the number of layers
+        '''
+        dtype = np.float64
+        if self.params.compact_storage:
+            dtype = np.float32
+        
+        self.voxels = {}
+        for name in self.voxel_names:
+            self.voxels[name] = ref_voxels (prototype_filename = prototype_filename, originX = originX,
+                                            originY = originY, originZ = originZ, cell_Width = cell_Width,
+                                            cell_Height = cell_Height, cell_Depth = cell_Depth, ncols = ncols,
+                                            nrows = nrows, nlayers = nlayers, dtype = dtype)
+        self.assimilation_bounds_3d_set = True
+        return
+    
+    def idw_query (self, tree, flow_x_all, flow_y_all, int_weight_full, points):
+        '''
+        method to run inverse distance weighted estimates for many points at once, the points are
+        queried in chunks of params.assimilation_chunk_size to bound the memory
+        tree = KDTree of the intersection locations
+        flow_x_all = flow x of the intersections (numpy array)
+        flow_y_all = flow y of the intersections (numpy array)
+        int_weight_full = intersection weights (numpy array)
+        points = the points to estimate at, in the same (scaled) coordinates as the tree
+        returns flow_x_mean, flow_y_mean, flow_x_sd, flow_y_sd, flow_x_med, flow_y_med numpy arrays
+        '''
+        n = points.shape[0]
+        out = np.zeros ((6, n)) * np.nan
+        k = min (self.params.k_nearest, flow_x_all.shape[0])
+        if k == 0:
+            return (out[0], out[1], out[2], out[3], out[4], out[5])
+        
+        chunk = self.params.assimilation_chunk_size
+        for start in range (0, n, chunk):
+            end = min (start + chunk, n)
+            dists, indices = tree.query (points[start:end], k = k, eps = 0.0)
+            dists = dists.reshape ((end - start, k))
+            indices = indices.reshape ((end - start, k))
+            
+            # cut down our variables
+            flow_x = flow_x_all[indices]
+            flow_y = flow_y_all[indices]
+            dists = np.maximum (dists, 1e-12)                   # a point right on an intersection
+            weight = int_weight_full[indices] / (dists**self.params.distance_exponent)
+            
+            # weighted averages
+            total = np.sum (weight, axis = 1)
+            total[total == 0.0] = np.nan
+            mean_x = np.sum (weight * flow_x, axis = 1) / total
+            mean_y = np.sum (weight * flow_y, axis = 1) / total
+            out[0, start:end] = mean_x
+            out[1, start:end] = mean_y
+            out[2, start:end] = np.sqrt (np.sum (weight * (flow_x - mean_x[:, None])**2.0, axis = 1) / total)
+            out[3, start:end] = np.sqrt (np.sum (weight * (flow_y - mean_y[:, None])**2.0, axis = 1) / total)
+            out[4, start:end] = np.median (flow_x, axis = 1)
+            out[5, start:end] = np.median (flow_y, axis = 1)
+        return (out[0], out[1], out[2], out[3], out[4], out[5])
+    
+    def assimilate_3d (self, intersections):
+        '''
+        method to interpolate to the voxel grids in one pass, distances are anisotropic with the
+        vertical differences multiplied by params.vertical_distance_scale
+        intersections = supplied intersections dataframe
+        '''
+        self.profiler.begin_event ()
+        tic = self.profiler.tic ()
+        
+        # get relevant variables as np arrays
+        flow_x_all = np.array (intersections['flow_x'], dtype = float)
+        flow_y_all = np.array (intersections['flow_y'], dtype = float)
+        int_weight_full = np.array (intersections['weight'], dtype = float)
+        scale = self.params.vertical_distance_scale
+        
+        # create KDTree of the intersections in scaled coordinates
+        locs = np.column_stack ((np.array (intersections['x'], dtype = float),
+                                 np.array (intersections['y'], dtype = float),
+                                 np.array (intersections['z'], dtype = float) * scale))
         tree = KDTree (locs, leafsize = 10)
         
-        for i in range (0, self.flow_x_mean.nrows):
-            for j in range (0, self.flow_x_mean.ncols):
-                
-                # query the tree to get nearest points
-                loc = np.array ([self.flow_x_mean.x_index[j], self.flow_x_mean.y_index[i]])
-                dists, indices = tree.query (loc, k = self.params.k_nearest, eps = 0.0)
-                dists = dists [~np.isinf (dists)]              # tree returns inf if more k neighbors requested
-                indices = indices [~np.isinf (dists)]          # than exist, this cuts the number down
-                
-                # cut down our variables
-                flow_x = flow_x_all[indices]
-                flow_y = flow_y_all[indices]
-                int_weight = int_weight_full[indices]
-                
-                # calculate weighted averages
-                dist_weight = 1.0 / (dists**self.params.distance_exponent)
-                weight = dist_weight * int_weight
-                
-                # run calculations
-                flow_x_average = np.average (a = flow_x, weights = weight)
-                flow_y_average = np.average (a = flow_y, weights = weight)
-                self.flow_x_mean.ras[i, j] = flow_x_average
-                self.flow_y_mean.ras[i, j] = flow_y_average
-                self.flow_x_sd.ras[i, j] = np.sqrt (np.average ((flow_x - flow_x_average)**2.0, weights = weight))
-                self.flow_y_sd.ras[i, j] = np.sqrt (np.average ((flow_y - flow_y_average)**2.0, weights = weight))
-                self.flow_x_med.ras[i, j] = np.percentile (a = flow_x, q = 50.0)
-                self.flow_y_med.ras[i, j] = np.percentile (a = flow_y, q = 50.0)
-                
+        # all the voxel centers (layer, row, col order to match the arrays)
+        grid = self.voxels['flow_x_mean']
+        zz, yy, xx = np.meshgrid (grid.z_index, grid.y_index, grid.x_index, indexing = 'ij')
+        points = np.column_stack ((xx.ravel (), yy.ravel (), zz.ravel () * scale))
+        
+        results = self.idw_query (tree, flow_x_all, flow_y_all, int_weight_full, points)
+        shape = grid.ras.shape
+        for name, values in zip (('flow_x_mean', 'flow_y_mean', 'flow_x_sd', 'flow_y_sd',
+                                  'flow_x_med', 'flow_y_med'), results):
+            self.voxels[name].ras[:, :, :] = values.reshape (shape)
+        
         # compute convenience vectors
-        self.flow_vel.ras = np.sqrt (self.flow_x_mean.ras**2.0 + self.flow_y_mean.ras**2.0)
-        self.flow_az.ras = np.arctan2 (self.flow_x_mean.ras, self.flow_y_mean.ras) * 180 / pi
-        self.flow_az.ras = self.flow_az.ras % 360.0
+        flow_x_mean = self.voxels['flow_x_mean'].ras
+        flow_y_mean = self.voxels['flow_y_mean'].ras
+        self.voxels['flow_vel'].ras[:, :, :] = np.sqrt (flow_x_mean**2.0 + flow_y_mean**2.0)
+        self.voxels['flow_az'].ras[:, :, :] = (np.arctan2 (flow_x_mean, flow_y_mean) * 180 / pi) % 360.0
+        
+        self.profiler.count ('assimilation_cells', points.shape[0])
+        self.profiler.toc ('assimilate', tic)
+        self.profiler.end_event ('assimilate_3d')
         return
-    
\ No newline at end of file
@@ -0,0 +1,233 @@
+# flow rider
+# Copyright 2016 Thomas E. Barchyn
+# Contact: Thomas E. Barchyn [tbarchyn@gmail.com]
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# Please familiarize yourself with the license of this tool, available
+# in the distribution with the filename: /docs/license.txt
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# batch reprocessing of many states logs on a process pool
+#
+# usage: python batch.py <states folder or manifest> <output folder> [--params params.py]
+#                        [--prototype prototype.tif] [--processes N] [--force]
+#
+# each log is read, intersected, validated, weighted, assimilated, and written to its own folder
+# in the output folder. Logs whose outputs are newer than both the log and the params file are
+# skipped, so an interrupted batch picks up where it left off. A summary table is written to
+# batch_summary.csv in the output folder.
+
+import os
+import sys
+import time
+import runpy
+import argparse
+import multiprocessing
+import pandas as pd
+
+def load_params (params_filename):
+    '''
+    function to load a parameter profile file and make its parameter object
+    params_filename = the parameter filename (None for the default params)
+    returns a parameter object
+    '''
+    if params_filename is None:
+        from params import params
+        return (params ())
+    namespace = runpy.run_path (params_filename)
+    return (namespace['params'] ())
+
+def find_logs (source):
+    '''
+    function to list the states logs to process
+    source = a folder of states csv files, or a manifest file with one states filename per line
+    returns a sorted list of filenames
+    '''
+    if os.path.isdir (source):
+        logs = [os.path.join (source, f) for f in os.listdir (source) if f.lower ().endswith ('.csv')]
+    else:
+        logs = []
+        with open (source, 'r') as f:
+            for line in f:
+                line = line.strip ()
+                if len (line) > 0 and not line.startswith ('#'):
+                    logs.append (line)
+    return (sorted (logs))
+
+def output_folder (log, output):
+    '''
+    function to get the output folder for a states log
+    log = the states log filename
+    output = the batch output folder
+    '''
+    name = os.path.splitext (os.path.basename (log))[0]
+    return (os.path.join (output, name))
+
+def output_files (log, output, p):
+    '''
+    function to list the output files for a states log
+    log = the states log filename
+    output = the batch output folder
+    p = a parameter object
+    '''
+    folder = output_folder (log, output)
+    names = [p.intersections_filename, p.assimilation_flow_x_mean_name, p.assimilation_flow_y_mean_name,
+             p.assimilation_flow_x_sd_name, p.assimilation_flow_y_sd_name, p.assimilation_flow_x_med_name,
+             p.assimilation_flow_y_med_name, p.assimilation_flow_vel_name, p.assimilation_flow_az]
+    return ([os.path.join (folder, n) for n in names])
+
+def up_to_date (log, output, params_filename, p):
+    '''
+    function to check if the outputs of a states log are newer than the log and the params file
+    log = the states log filename
+    output = the batch output folder
+    params_filename = the parameter filename
+    p = a parameter object
+    '''
+    outputs = output_files (log, output, p)
+    for f in outputs:
+        if not os.path.exists (f):
+            return (False)
+    newest_input = os.path.getmtime (log)
+    if not params_filename is None and os.path.exists (params_filename):
+        newest_input = max (newest_input, os.path.getmtime (params_filename))
+    oldest_output = min ([os.path.getmtime (f) for f in outputs])
+    return (oldest_output >= newest_input)
+
+def process_log (job):
+    '''
+    function to run the full pipeline on one states log, this runs in a worker process
+    job = tuple of (log filename, output folder, params filename, prototype filename)
+    returns a dictionary of summary values
+    '''
+    log, output, params_filename, prototype_filename = job
+    summary = {'log': log, 'status': 'ok', 'n_states': 0, 'n_intersections': 0, 'read_s': 0.0,
+               'intersect_s': 0.0, 'assimilate_s': 0.0, 'write_s': 0.0, 'total_s': 0.0, 'error': ''}
+    start = time.time ()
+    original_dir = os.getcwd ()
+    try:
+        from flow import flow
+        fl = flow (quiet = True, params_object = load_params (params_filename))
+        folder = output_folder (log, output)
+        if not os.path.isdir (folder):
+            os.makedirs (folder)
+
+        tic = time.time ()
+        fl.states.read_states (log)
+        summary['n_states'] = fl.states.df.shape[0]
+        summary['read_s'] = time.time () - tic
+
+        tic = time.time ()
+        fl.update ()                                # intersect, validate, and weight
+        summary['n_intersections'] = fl.estimates ().shape[0]
+        summary['intersect_s'] = time.time () - tic
+
+        tic = time.time ()
+        fl.assimilate (prototype_filename)
+        summary['assimilate_s'] = time.time () - tic
+
+        tic = time.time ()
+        fl.estimates ().to_csv (os.path.join (folder, fl.params.intersections_filename), index = False)
+        fl.write_assimilations (folder)
+        summary['write_s'] = time.time () - tic
+    except Exception as e:
+        summary['status'] = 'failed'
+        summary['error'] = type (e).__name__ + ': ' + str (e)
+    os.chdir (original_dir)                         # write_assimilations may leave us in the output folder
+    summary['total_s'] = time.time () - start
+    return (summary)
+
+def run_batch (source, output, params_filename = 'params.py', prototype_filename = None,
+               processes = None, force = False):
+    '''
+    function to reprocess a batch of states logs on a process pool
+    source = a folder of states csv files, or a manifest file with one states filename per line
+    output = the batch output folder
+    params_filename = the parameter filename (the parameter profile)
+    prototype_filename = a prototype raster to assimilate onto (optional)
+    processes = the number of worker processes (defaults to the number of cpus)
+    force = boolean to reprocess logs with up to date outputs
+    returns the summary dataframe
+    '''
+    # absolute paths, so the workers do not depend on their working directory
+    output = os.path.abspath (output)
+    if not params_filename is None:
+        params_filename = os.path.abspath (params_filename)
+    if not prototype_filename is None:
+        prototype_filename = os.path.abspath (prototype_filename)
+    try:
+        p = load_params (params_filename)
+    except Exception as e:
+        print ('ERROR: cannot load the parameter file ' + str(params_filename) + ' (' + str (e) + ')')
+        sys.exit (1)
+    if not os.path.isdir (output):
+        os.makedirs (output)
+
+    logs = find_logs (source)
+    jobs = []
+    rows = []
+    for log in logs:
+        if not force and up_to_date (log, output, params_filename, p):
+            rows.append ({'log': log, 'status': 'skipped'})
+        else:
+            jobs.append ((log, output, params_filename, prototype_filename))
+    print ('batch: ' + str(len (logs)) + ' logs, ' + str(len (jobs)) + ' to process, ' +
+           str(len (logs) - len (jobs)) + ' up to date')
+
+    if len (jobs) > 0:
+        pool = multiprocessing.Pool (processes = processes)
+        try:
+            done = 0
+            for summary in pool.imap_unordered (process_log, jobs):
+                done = done + 1
+                rows.append (summary)
+                message = ('[' + str(done) + '/' + str(len (jobs)) + '] ' + os.path.basename (summary['log']) +
+                           ': ' + summary['status'] + ' in ' + ('%.1f' % summary['total_s']) + ' s')
+                if summary['status'] == 'failed':
+                    message = message + ' (' + summary['error'] + ')'
+                print (message)
+        finally:
+            pool.close ()
+            pool.join ()
+
+    # keep the timings of previous runs for logs that were skipped this time
+    summary_filename = os.path.join (output, 'batch_summary.csv')
+    df = pd.DataFrame (rows)
+    if os.path.exists (summary_filename):
+        try:
+            previous = pd.read_csv (summary_filename)
+            skipped = df[df['status'] == 'skipped']
+            previous = previous[previous['log'].isin (skipped['log'])]
+            skipped = skipped[~skipped['log'].isin (previous['log'])]
+            df = pd.concat ([previous, skipped, df[df['status'] != 'skipped']], ignore_index = True)
+        except:
+            print ('ERROR: cannot read the previous batch summary ' + summary_filename)
+    df = df.sort_values ('log')
+    df.to_csv (summary_filename, index = False)
+    return (df)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser (description = 'flow_rider batch reprocessing of states logs')
+    parser.add_argument ('source', help = 'folder of states csv files, or a manifest of states filenames')
+    parser.add_argument ('output', help = 'output folder')
+    parser.add_argument ('--params', default = 'params.py', help = 'parameter file (default params.py)')
+    parser.add_argument ('--prototype', default = None, help = 'prototype raster to assimilate onto')
+    parser.add_argument ('--processes', type = int, default = None, help = 'number of worker processes')
+    parser.add_argument ('--force', action = 'store_true', help = 'reprocess logs with up to date outputs')
+    args = parser.parse_args ()
+
+    df = run_batch (args.source, args.output, params_filename = args.params,
+                    prototype_filename = args.prototype, processes = args.processes, force = args.force)
+    print (df.to_string (index = False))
+    if (df['status'] == 'failed').any ():
+        sys.exit (1)
@@ -0,0 +1,86 @@
+# flow rider
+# Copyright 2016 Thomas E. Barchyn
+# Contact: Thomas E. Barchyn [tbarchyn@gmail.com]
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# Please familiarize yourself with the license of this tool, available
+# in the distribution with the filename: /docs/license.txt
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# benchmark of the intersections update on the synthetic suite
+#
+# usage: python benchmark.py
+#
+# compares the standard pipeline (intersect, calc_all, post_validate, calc_weights) with the fused
+# kernel (numpy fallback, and numba if it is installed), and checks they give the same intersections
+
+import time
+import numpy as np
+import pandas as pd
+
+from params import *
+from states import *
+from intersections import *
+from kernels import numba_available
+from synthetic import *
+
+def run_update (block, fused_kernel, use_numba):
+    '''
+    function to time one intersections update over a states block
+    block = a states block
+    fused_kernel = boolean to use the fused kernel
+    use_numba = boolean to use numba for the fused kernel
+    returns the elapsed time (s) and the intersections dataframe
+    '''
+    p = params ()
+    p.fused_kernel = fused_kernel
+    p.use_numba = use_numba
+    s = states ()
+    s.add_states (block)
+    i = intersections (p, s.done_all_callback)
+    start = time.time ()
+    i.update (s.df)
+    return (time.time () - start, i.df)
+
+if __name__ == '__main__':
+    modes = [('pipeline', False, False), ('fused_numpy', True, False)]
+    if numba_available:
+        modes.append (('fused_numba', True, True))
+        run_update (synthetic_states (50), True, True)      # compile before timing
+    else:
+        print ('numba is not installed, skipping the numba kernel')
+
+    rows = []
+    for name, block in synthetic_suite ():
+        reference = None
+        for mode, fused_kernel, use_numba in modes:
+            elapsed, df = run_update (block, fused_kernel, use_numba)
+            if reference is None:
+                reference = df
+                matches = True
+            else:
+                cols = ['id1', 'id2', 'flow_x', 'flow_y', 'weight']
+                matches = (df.shape[0] == reference.shape[0] and
+                           np.allclose (np.array (df[cols], dtype = float),
+                                        np.array (reference[cols], dtype = float)))
+            rows.append ({'case': name, 'mode': mode, 'states': block.shape[0],
+                          'intersections': df.shape[0], 'seconds': elapsed, 'matches_pipeline': matches})
+            print (name + ' ' + mode + ': ' + ('%.3f' % elapsed) + ' s')
+
+    table = pd.DataFrame (rows)
+    table['speedup'] = np.nan
+    for name in table['case'].unique ():
+        case = table['case'] == name
+        base = table.loc[case & (table['mode'] == 'pipeline'), 'seconds'].iloc[0]
+        table.loc[case, 'speedup'] = base / table.loc[case, 'seconds']
+    print (table.to_string (index = False))
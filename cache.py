@@ -0,0 +1,176 @@
+# flow rider
+# Copyright 2016 Thomas E. Barchyn
+# Contact: Thomas E. Barchyn [tbarchyn@gmail.com]
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# Please familiarize yourself with the license of this tool, available
+# in the distribution with the filename: /docs/license.txt
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# purpose: when you are riding the flow and you gotta know . . .
+
+# NOTES: assimilation results are keyed by a sha1 fingerprint of everything they depend on: the
+# intersection locations, flows, and weights, the grid definition, and the assimilation params.
+# Results are kept in an in-memory LRU and (optionally) as npz files in a folder. Concurrent
+# requests for the same key wait for the first one to finish rather than computing it again.
+# Requests for different keys compute at the same time, so compute functions must not write any
+# shared state (flow.assimilate uses assimilations.compute_rasters, which returns new arrays).
+
+import os
+import hashlib
+import threading
+import collections
+import numpy as np
+
+class assimilation_cache:
+    '''
+    this class caches assimilation rasters by a fingerprint of their inputs
+    '''
+    def __init__ (self, params):
+        '''
+        constructor initializes an empty cache
+        params = a parameter object
+        '''
+        self.params = params
+        self.lru = collections.OrderedDict ()           # key -> dictionary of raster arrays
+        self.lock = threading.Lock ()
+        self.inflight = {}                              # key -> event set when the key is computed
+        self.hits = 0
+        self.misses = 0
+
+        # the params the assimilation results depend on
+        self.param_names = ['k_nearest', 'distance_exponent', 'compact_storage', 'assimilation_method',
+                            'kriging_neighbours', 'kriging_variogram_sample', 'kriging_variogram_lags',
+                            'kriging_max_lag']
+        return
+
+    def fingerprint (self, intersections, grid_spec):
+        '''
+        method to fingerprint the inputs of an assimilation
+        intersections = the intersections dataframe
+        grid_spec = tuple defining the grid (see assimilations.grid_spec)
+        returns a hex key
+        '''
+        h = hashlib.sha1 ()
+        for column in ('x', 'y', 'z', 'flow_x', 'flow_y', 'weight'):
+            if column in intersections.columns:
+                h.update (np.ascontiguousarray (np.array (intersections[column], dtype = float)).tobytes ())
+        h.update (repr (grid_spec).encode ('utf-8'))
+        for name in self.param_names:
+            h.update (repr ((name, getattr (self.params, name, None))).encode ('utf-8'))
+        return (h.hexdigest ())
+
+    def filename (self, key):
+        '''
+        method to return the on disk filename of a key (None if there is no disk tier)
+        key = the fingerprint
+        '''
+        if self.params.assimilation_cache_folder is None:
+            return (None)
+        return (os.path.join (self.params.assimilation_cache_folder, key + '.npz'))
+
+    def get (self, key):
+        '''
+        method to look up a key in memory, then on disk
+        key = the fingerprint
+        returns a dictionary of raster arrays, or None
+        '''
+        with self.lock:
+            if key in self.lru:
+                self.lru[key] = self.lru.pop (key)      # move to most recently used
+                return (self.lru[key])
+
+        filename = self.filename (key)
+        if not filename is None and os.path.exists (filename):
+            try:
+                with np.load (filename) as f:
+                    result = dict ([(name, f[name]) for name in f.files])
+                self.store (key, result, write = False)
+                return (result)
+            except:
+                print ('ERROR: cannot read the assimilation cache file ' + filename)
+        return (None)
+
+    def store (self, key, result, write = True):
+        '''
+        method to store a result in memory (and on disk, if there is a disk tier)
+        key = the fingerprint
+        result = dictionary of raster arrays
+        write = boolean to write to the disk tier
+        '''
+        with self.lock:
+            self.lru[key] = result
+            while len (self.lru) > self.params.assimilation_cache_size:
+                self.lru.popitem (last = False)         # drop the least recently used
+
+        filename = self.filename (key)
+        if write and not filename is None:
+            try:
+                if not os.path.isdir (self.params.assimilation_cache_folder):
+                    os.makedirs (self.params.assimilation_cache_folder)
+                temp = filename + '.' + str(os.getpid ()) + '.' + str(threading.current_thread ().ident) + '.tmp'
+                with open (temp, 'wb') as f:
+                    np.savez (f, **result)
+                os.rename (temp, filename)              # atomic, so readers never see partial files
+            except:
+                print ('ERROR: cannot write the assimilation cache file ' + filename)
+        return
+
+    def get_or_compute (self, key, compute):
+        '''
+        method to return the cached result for a key, computing it once if it is missing
+        key = the fingerprint
+        compute = function with no arguments that returns a dictionary of raster arrays, this may
+                  run at the same time as the compute of another key, so it must not write shared state
+        returns a dictionary of raster arrays
+        '''
+        while True:
+            result = self.get (key)
+            if not result is None:
+                with self.lock:
+                    self.hits = self.hits + 1
+                return (result)
+
+            with self.lock:
+                if key in self.lru:
+                    continue                            # it was stored since we looked, look again
+                event = self.inflight.get (key)
+                if event is None:
+                    event = threading.Event ()
+                    self.inflight[key] = event
+                    owner = True
+                else:
+                    owner = False
+
+            if owner:
+                break
+            event.wait ()                               # someone else is computing it, wait and look again
+
+        with self.lock:
+            self.misses = self.misses + 1
+        try:
+            result = compute ()
+            self.store (key, result)
+        finally:
+            with self.lock:
+                del self.inflight[key]
+            event.set ()
+        return (result)
+
+    def clear (self):
+        '''
+        method to clear the in-memory cache (the disk tier is left alone)
+        '''
+        with self.lock:
+            self.lru.clear ()
+        return
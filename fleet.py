@@ -0,0 +1,142 @@
+# flow rider
+# Copyright 2016 Thomas E. Barchyn
+# Contact: Thomas E. Barchyn [tbarchyn@gmail.com]
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# Please familiarize yourself with the license of this tool, available
+# in the distribution with the filename: /docs/license.txt
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# purpose: when you are riding the flow and you gotta know . . .
+
+# NOTES: all vehicles share one states dataframe (so ids from the single states.frame counter never
+# collide) and one set of intersections, so pairs are made both within and across vehicles. Each
+# vehicle has its own ingest buffer and lock, so vehicles can be fed from separate threads without
+# contending with each other; flush moves all the buffers into the states in one append.
+
+import threading
+import datetime
+import numpy as np
+import pandas as pd
+
+from flow import *
+
+class fleet:
+    '''
+    this class manages a fleet of vehicles riding in the same flow
+    '''
+    def __init__ (self, fl = None, params_filename = None, quiet = False):
+        '''
+        constructor
+        fl = a flow object to feed (optional, if None one is created)
+        params_filename = the parameter filename for a new flow object (see flow)
+        quiet = boolean to suppress some output
+        '''
+        if fl is None:
+            fl = flow (params_filename = params_filename, quiet = quiet)
+        self.flow = fl
+        self.buffers = {}                       # vehicle -> list of buffered states
+        self.locks = {}                         # vehicle -> lock for that buffer
+        self.registry_lock = threading.Lock ()  # lock for adding new vehicles
+        self.flush_lock = threading.Lock ()     # lock so only one flush runs at a time
+        self.columns = ('vehicle', 'x', 'y', 'z', 'time', 'track', 'velocity', 'heading',
+                        'min_flowspeed', 'max_flowspeed')
+        return
+
+    def register (self, vehicle):
+        '''
+        method to add a vehicle to the fleet (this is done automatically at the first add_state)
+        vehicle = the vehicle id
+        '''
+        with self.registry_lock:
+            if not vehicle in self.buffers:
+                self.buffers[vehicle] = []
+                self.locks[vehicle] = threading.Lock ()
+        return
+
+    def vehicles (self):
+        '''
+        method to return the list of vehicle ids in the fleet
+        '''
+        return (list (self.buffers.keys ()))
+
+    def add_state (self, vehicle, x, y, z, track, velocity, heading, min_flowspeed, max_flowspeed, time = None):
+        '''
+        add a state to a vehicle's ingest buffer, this is thread safe. The states are brought into
+        the shared states dataframe at the next flush.
+
+        vehicle = the vehicle id
+        x = x position (m)
+        y = y position (m)
+        z = z position (m)
+        time = time (optional, if not supplied the time is recorded as number of seconds since
+                     start of the experiment)
+        track = the azimuth the vehicle is going over the ground (degrees)
+        velocity = the velocity the vehicle is going over the ground (m/s)
+        heading = the azimuth the vehicle is pointing (degrees)
+        min_flowspeed = the minimum flow speed that is realistic (m/s)
+        max_flowspeed = the maximum flow speed that is realistic (m/s)
+        '''
+        if not vehicle in self.buffers:
+            self.register (vehicle)
+
+        # record the time now, as the state may sit in the buffer for a while
+        if time is None:
+            time_diff = datetime.datetime.now () - self.flow.states.start_time
+            time = time_diff.seconds + (1e-6 * time_diff.microseconds)
+
+        with self.locks[vehicle]:
+            self.buffers[vehicle].append ((vehicle, x, y, z, time, track, velocity, heading,
+                                           min_flowspeed, max_flowspeed))
+        return
+
+    def flush (self):
+        '''
+        method to move all the buffered states into the shared states dataframe (in time order)
+        and run the flow estimator, intersecting within and across vehicles
+        returns the number of states flushed
+        '''
+        with self.flush_lock:
+            rows = []
+            for vehicle in self.vehicles ():
+                with self.locks[vehicle]:
+                    rows.extend (self.buffers[vehicle])
+                    self.buffers[vehicle] = []
+
+            if len (rows) == 0:
+                return (0)
+
+            block = pd.DataFrame (data = rows, columns = self.columns)
+            block = block.sort_values ('time', kind = 'mergesort')
+            self.flow.states.add_states (block)
+
+            # update the online flow estimate with the new states
+            if self.flow.params.online_flow and self.flow.params.online_flow_source == 'states':
+                for row in block.itertuples ():
+                    self.flow.online.update_state (row.time, row.track, row.velocity, row.heading)
+
+            self.flow.update ()
+        return (len (rows))
+
+    def intersection_vehicles (self, df = None):
+        '''
+        method to look up the vehicles of both states in each intersection
+        df = an intersections dataframe (optional, defaults to the flow intersections)
+        returns vehicle1, vehicle2 as numpy arrays
+        '''
+        if df is None:
+            df = self.flow.intersections.df
+        lookup = self.flow.states.df.set_index ('id')['vehicle']
+        vehicle1 = np.array (lookup.loc[np.array (df['id1'], dtype = float)])
+        vehicle2 = np.array (lookup.loc[np.array (df['id2'], dtype = float)])
+        return (vehicle1, vehicle2)
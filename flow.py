@@ -32,15 +32,19 @@ import numpy as np
 import pandas as pd
 
 from intersections import *
+from neighbourhoods import *
 from states import *
 from params import *
 from assimilations import *
+from profiler import *
+from online import *
+from cache import *
 
 class flow:
     '''
     This is the lead import for flow_rider
     '''
-    def __init__ (self, params_filename = None, quiet = False):
+    def __init__ (self, params_filename = None, quiet = False, params_object = None):
         '''
         constructor
         params_filename = the filename for the parameter filename, defaults
@@ -49,25 +53,35 @@ class flow:
                           autocorrelation scales. Likely some vehicle customization will
                           be required also.
         quiet = boolean to suppress some output
+        params_object = an already loaded parameter object to use instead of reading
+                        params_filename (optional)
         '''
         self.welcome (quiet)
         
-        if params_filename is None and not quiet:
-            print ('WARNING: using default parameters file params.py - you should')
-            print ('         customize this for your flow!')
-            params_filename = 'params.py'
-        
-        # load the parameters, override default params import
-        try:
-            execfile (params_filename)
-        except:
-            print ('ERROR: cannot open flow parameter file - flow rider will not work!')
-            sys.exit ()
+        if params_object is None:
+            if params_filename is None and not quiet:
+                print ('WARNING: using default parameters file params.py - you should')
+                print ('         customize this for your flow!')
+                params_filename = 'params.py'
             
-        self.params = params ()                                             # this should read in as an object
+            # load the parameters, override default params import
+            try:
+                execfile (params_filename)
+            except:
+                print ('ERROR: cannot open flow parameter file - flow rider will not work!')
+                sys.exit ()
+                
+            self.params = params ()                                         # this should read in as an object
+        else:
+            self.params = params_object
         self.states = states ()  
-        self.intersections = intersections (self.params, self.states.done_all_callback)
-        self.assimilations = assimilations (self.params)
+        self.profiler = profiler (params = self.params)                     # reads params.profile at each call
+        self.intersections = intersections (self.params, self.states.done_all_callback, self.profiler)
+        self.neighbourhoods = neighbourhoods (self.params, self.states.done_all_callback, self.profiler)
+        self.assimilations = assimilations (self.params, self.profiler)
+        self.online = online_flow (self.params)
+        self.cache = assimilation_cache (self.params)
+        self.tile_server = None                                             # optional tile_server to publish to
         return
         
     def welcome (self, quiet):
@@ -86,17 +100,72 @@ class flow:
         
         return
 
+    def estimates (self):
+        '''
+        method to return the flow estimates dataframe from the estimator set in
+        params.flow_estimator (intersections or neighbourhoods)
+        '''
+        if self.params.flow_estimator == 'neighbourhoods':
+            return (self.neighbourhoods.df)
+        return (self.intersections.df)
+
+    def update (self):
+        '''
+        method to run the flow estimator set in params.flow_estimator over the states
+        that have not been done yet
+        '''
+        if self.params.flow_estimator == 'neighbourhoods':
+            added = self.neighbourhoods.update (self.states.df)
+        else:
+            added = self.intersections.update (self.states.df)
+        
+        # feed the new estimates (only those that were stored) to the online estimate
+        if self.params.online_flow and self.params.online_flow_source == 'estimates':
+            self.online.update_estimates (added, self.states.df)
+        return
+
     def calc_global_mean_flow (self):
         '''
-        method to return the mean flow from the intersections dataframe
+        method to return the mean flow from the estimates dataframe
         returns: flow_x_mean, flow_y_mean, flow_az, flow_vel
         '''
-        flow_x_mean = np.mean (self.intersections.df['flow_x'])
-        flow_y_mean = np.mean (self.intersections.df['flow_y'])
+        flow_x_mean = np.mean (self.estimates ()['flow_x'])
+        flow_y_mean = np.mean (self.estimates ()['flow_y'])
         flow_az = (atan2 (flow_x_mean, flow_y_mean) * 180.0 / pi) % 360.0
         flow_vel = sqrt (flow_x_mean**2.0 + flow_y_mean**2.0)
         return (flow_x_mean, flow_y_mean, flow_az, flow_vel)
 
+    def calc_running_flow_stats (self, x = None, y = None):
+        '''
+        method to return the weighted running flow stats, these are updated as estimates are
+        added so this is O(1) and suitable for polling
+        x = x location (optional, if x and y are supplied the stats for that spatial bin are
+            returned, this requires params.running_stats_bin_size)
+        y = y location (optional)
+        returns a dictionary with count, weight, flow_x_mean, flow_y_mean, flow_x_var, flow_y_var,
+        flow_az, flow_vel
+        '''
+        if self.params.flow_estimator == 'neighbourhoods':
+            return (self.neighbourhoods.running.stats (x, y))
+        return (self.intersections.running.stats (x, y))
+
+    def calc_online_flow (self):
+        '''
+        method to return the online (recursive) flow estimate, this is O(1) and is kept up to date
+        at every add_state call if params.online_flow is True. The covariance of the estimate
+        is in self.online.P
+        returns: flow_x, flow_y, flow_az, flow_vel
+        '''
+        return (self.online.estimate ())
+
+    def get_stats (self):
+        '''
+        method to return the profiling stats (per-stage wall times, pair counts, and
+        assimilation throughput) as a dictionary. These are only recorded if params.profile
+        is True.
+        '''
+        return (self.profiler.report ())
+
     def add_state (self, x, y, z, track, velocity, heading, min_flowspeed, max_flowspeed, time = None):
         '''
         add a state to the state dataframe (this echoes states.add_state), but adds
@@ -117,9 +186,13 @@ class flow:
         # add a state to the states dataframe
         self.states.add_state (x, y, z, time, track, velocity, heading, min_flowspeed, max_flowspeed)
         
+        # update the online flow estimate with the new state
+        if self.params.online_flow and self.params.online_flow_source == 'states':
+            self.online.update_state (self.states.df['time'].iloc[-1], track, velocity, heading)
+        
         # intersect that state if we are performing this realtime
         if self.params.calc_intersections_realtime:
-            self.intersections.update (self.states.df)
+            self.update ()
         
         return
 
@@ -155,8 +228,50 @@ class flow:
                 # initialize if we haven't yet
                 self.assimilations.initialize (prototype_filename = prototype_filename)
         
+        # and . . run the assimilations (or fetch them from the cache)
+        if self.params.assimilation_cache:
+            estimates = self.estimates ()
+            key = self.cache.fingerprint (estimates, self.assimilations.grid_spec)
+            def compute ():
+                return (self.assimilations.compute_rasters (estimates))    # does not touch the rasters
+            self.assimilations.set_rasters (self.cache.get_or_compute (key, compute))
+        else:
+            self.assimilations.assimilate (self.estimates ())
+        
+        # publish the new assimilations to the tile server
+        if not self.tile_server is None:
+            self.tile_server.publish ()
+        return
+    
+    def assimilate_3d (self, prototype_filename = None):
+        '''
+        method to run 3D (voxel) assimilations, the horizontal grid is set as in assimilate and the
+        layers span the z range of the states (plus a pad) in params.default_grid_layers layers
+        prototype_filename = this is a raster to copy that is projected and has pre-defined extent
+        '''
+        z = np.array (self.states.df['z'], dtype = float)
+        originZ = z.min () - self.params.default_assimilations_vertical_pad
+        cell_Depth = ((z.max () + self.params.default_assimilations_vertical_pad) - originZ) / self.params.default_grid_layers
+        nlayers = self.params.default_grid_layers
+        
+        if self.params.set_assimilation_bounds_dynamically or not self.assimilations.assimilation_bounds_3d_set:
+            if prototype_filename is None:
+                originX = np.array (self.states.df['x']).min() - self.params.default_assimilations_spacepad
+                originY = np.array (self.states.df['y']).min() - self.params.default_assimilations_spacepad
+                cell_Width = ((np.array (self.states.df['x']).max() + self.params.default_assimilations_spacepad) -
+                                originX) / self.params.default_grid_size
+                cell_Height = ((np.array (self.states.df['y']).max() + self.params.default_assimilations_spacepad) -
+                                originY) / self.params.default_grid_size
+                self.assimilations.initialize_3d (originX = originX, originY = originY, originZ = originZ,
+                                                  cell_Width = cell_Width, cell_Height = cell_Height,
+                                                  cell_Depth = cell_Depth, ncols = self.params.default_grid_size,
+                                                  nrows = self.params.default_grid_size, nlayers = nlayers)
+            else:
+                self.assimilations.initialize_3d (prototype_filename = prototype_filename, originZ = originZ,
+                                                  cell_Depth = cell_Depth, nlayers = nlayers)
+        
         # and . . run the assimilations
-        self.assimilations.assimilate (self.intersections.df)
+        self.assimilations.assimilate_3d (self.estimates ())
         return
     
     def write (self):
@@ -164,7 +279,9 @@ class flow:
         method to save everything to default filenames as supplied in the params file
         '''
         self.states.write_states (self.params.states_filename)
-        self.intersections.write_intersections (self.params.intersections_file)
+        self.intersections.write_intersections (self.params.intersections_filename)
+        if self.params.flow_estimator == 'neighbourhoods':
+            self.neighbourhoods.write_neighbourhoods (self.params.neighbourhoods_filename)
         return
     
     def read (self):
@@ -172,7 +289,9 @@ class flow:
         method to read everything from the default filenames as supplied in the params file
         '''
         self.states.read_states (self.params.states_filename)
-        self.intersections.read_intersections (self.params.intersections_file)
+        self.intersections.read_intersections (self.params.intersections_filename)
+        if self.params.flow_estimator == 'neighbourhoods':
+            self.neighbourhoods.read_neighbourhoods (self.params.neighbourhoods_filename)
         return
 
     def write_assimilations (self, folder = None):
@@ -196,5 +315,30 @@ class flow:
         os.chdir (original_dir)
         return
 
-
-
+    def write_assimilations_3d (self, folder = None):
+        '''
+        method to write 3D assimilations to disk in a folder, as multi-band tiffs (one band per layer)
+        or npz arrays depending on params.assimilation_3d_format
+        folder = assigned folder to dump the files (optional)
+        '''
+        original_dir = os.getcwd ()
+        if not folder is None:
+            os.chdir (folder)
+        names = {'flow_x_mean': self.params.assimilation_flow_x_mean_name,
+                 'flow_y_mean': self.params.assimilation_flow_y_mean_name,
+                 'flow_x_sd': self.params.assimilation_flow_x_sd_name,
+                 'flow_y_sd': self.params.assimilation_flow_y_sd_name,
+                 'flow_x_med': self.params.assimilation_flow_x_med_name,
+                 'flow_y_med': self.params.assimilation_flow_y_med_name,
+                 'flow_vel': self.params.assimilation_flow_vel_name,
+                 'flow_az': self.params.assimilation_flow_az}
+        for name in self.assimilations.voxel_names:
+            filename = self.params.assimilation_3d_prefix + names[name]
+            if self.params.assimilation_3d_format == 'npz':
+                self.assimilations.voxels[name].write_npz (os.path.splitext (filename)[0] + '.npz')
+            else:
+                self.assimilations.voxels[name].write_tiff (filename)
+        
+        # back to original directory
+        os.chdir (original_dir)
+        return
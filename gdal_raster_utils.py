@@ -30,7 +30,7 @@ class ref_raster:
     straightforward lookups of the real space location for custom interpolation.
     """
     def __init__ (self, prototype_filename = None, originX = None, originY = None, cell_Width = None,
-                  cell_Height = None, ncols = None, nrows = None):
+                  cell_Height = None, ncols = None, nrows = None, dtype = np.float64):
         """
         Constructor requires either a prototype filename, or the specifications to create
         a blank raster full of np.nans. Note that presently a prototype raster is still
@@ -43,6 +43,7 @@ class ref_raster:
         cell_Height = the height of cells (m)
         ncols = the number of columns
         nrows = the number of rows
+        dtype = the numpy dtype of the raster values (np.float32 halves the memory)
         """
         self.prototype_filename = prototype_filename
         if self.prototype_filename is None:
@@ -58,7 +59,7 @@ class ref_raster:
         
         if read_existing_raster:
             try:
-                self.ras = self.read_raster (self.prototype_filename)      # read the raster
+                self.ras = self.read_raster (self.prototype_filename).astype (dtype)      # read the raster
                 raster = gdal.Open (self.prototype_filename)
                 geotransform = raster.GetGeoTransform()
                 self.originX = geotransform[0]
@@ -71,7 +72,7 @@ class ref_raster:
                 print ('ERROR: raster read error')
         else:
             try:
-                self.ras = np.zeros ((self.nrows, self.ncols)) * np.nan
+                self.ras = np.zeros ((self.nrows, self.ncols), dtype = dtype) * np.nan
             except:
                 print ('ERROR: raster creation error')
         
@@ -196,3 +197,109 @@ class ref_raster:
     
     
 
+class ref_voxels:
+    """
+    Referenced voxel grid class, the 3D counterpart of ref_raster. Layers are stacked along the first
+    axis (ras[layer, row, col]) from the bottom up, and written as bands of a multi-band raster.
+    """
+    def __init__ (self, prototype_filename = None, originX = None, originY = None, originZ = None,
+                  cell_Width = None, cell_Height = None, cell_Depth = None, ncols = None, nrows = None,
+                  nlayers = None, dtype = np.float64):
+        """
+        Constructor requires either a prototype filename for the horizontal grid, or the horizontal
+        grid specifications, along with the vertical grid specifications.
+        
+        prototype_filename = a 2D raster to copy the horizontal grid from (optional)
+        originX = the X origin location (m)
+        originY = the Y origin location (m)
+        originZ = the Z location of the bottom of the lowest layer (m)
+        cell_Width = the width of cells (m)
+        cell_Height = the height of cells (m)
+        cell_Depth = the thickness of the layers (m)
+        ncols = the number of columns
+        nrows = the number of rows
+        nlayers = the number of layers
+        dtype = the numpy dtype of the voxel values
+        """
+        # the horizontal grid is exactly a ref_raster
+        self.grid = ref_raster (prototype_filename = prototype_filename, originX = originX, originY = originY,
+                                cell_Width = cell_Width, cell_Height = cell_Height, ncols = ncols,
+                                nrows = nrows, dtype = dtype)
+        self.prototype_filename = prototype_filename
+        self.originX = self.grid.originX
+        self.originY = self.grid.originY
+        self.cell_Width = self.grid.cell_Width
+        self.cell_Height = self.grid.cell_Height
+        self.ncols = self.grid.ncols
+        self.nrows = self.grid.nrows
+        self.x_index = self.grid.x_index
+        self.y_index = self.grid.y_index
+        
+        self.originZ = originZ
+        self.cell_Depth = cell_Depth
+        self.nlayers = nlayers
+        self.z_index = originZ + (np.arange (0, nlayers) + 0.5) * cell_Depth
+        self.ras = np.zeros ((self.nlayers, self.nrows, self.ncols), dtype = dtype) * np.nan
+        return
+    
+    def layer (self, k):
+        """
+        Return layer k as a ref_raster
+        
+        k = the layer index (0 is the bottom)
+        """
+        d = self.grid.blank_copy ()
+        d.ras = self.ras[k, :, :].copy ()
+        return d
+    
+    def write_tiff (self, filename, prototype_filename = None, proj_string = None):
+        """
+        Write a multi-band tiff to disk, one band per layer (band 1 is the bottom layer), with the
+        layer center z as the band description.
+
+        filename = the filename to write
+        prototype_filename = the prototype filename (correctly projected)
+        proj_string = projection string, if none, there is no projection assigned
+        """
+        if prototype_filename is None:
+            prototype_filename = self.prototype_filename
+        
+        driver = gdal.GetDriverByName('GTiff')
+        outRaster = driver.Create (filename, self.ncols, self.nrows, self.nlayers, gdal.GDT_Float32)
+        if prototype_filename is None:
+            outRaster.SetGeoTransform((self.originX, self.cell_Width, 0, self.originY, 0, self.cell_Height))
+        else:
+            raster = gdal.Open (prototype_filename)
+            outRaster.SetGeoTransform (raster.GetGeoTransform())
+        
+        nodata_flag = -9999.0
+        for k in range (0, self.nlayers):
+            outband = outRaster.GetRasterBand (k + 1)
+            x = self.ras[k, :, :].copy ()
+            x [np.isnan(x)] = nodata_flag
+            outband.SetNoDataValue (nodata_flag)
+            outband.SetDescription ('z = ' + str(self.z_index[k]))
+            outband.WriteArray (x)
+            outband.FlushCache ()
+        
+        # set projection (if supplied)
+        outRasterSRS = osr.SpatialReference ()
+        if not prototype_filename is None:
+            outRasterSRS.ImportFromWkt (raster.GetProjectionRef())
+            outRaster.SetProjection (outRasterSRS.ExportToWkt())
+        elif not proj_string is None:
+            outRasterSRS.ImportFromWkt (proj_string)
+            outRaster.SetProjection (outRasterSRS.ExportToWkt())
+        return
+    
+    def write_npz (self, filename):
+        """
+        Write the voxels and their cell center coordinates to a numpy npz file (like a NetCDF
+        variable with x, y, and z dimensions)
+        
+        filename = the filename to write
+        """
+        np.savez_compressed (filename, values = self.ras, x = self.x_index, y = self.y_index, z = self.z_index,
+                             geotransform = np.array ([self.originX, self.cell_Width, 0.0, self.originY,
+                                                       0.0, self.cell_Height]))
+        return
@@ -22,37 +22,101 @@
 from math import *
 import numpy as np
 import pandas as pd
+from profiler import *
+from running_stats import *
+from kernels import *
+from spatial_index import *
 
 class intersections:
     '''
     this class manages intersection storage, calculation, and validation
     '''
-    def __init__(self, params, done_states_callback):
+    def __init__(self, params, done_states_callback, prof = None):
         '''
         constructor initializes the intersections dataframe
         params = a parameter object
         done_states_callback = callback to set all states to 'done'
+        prof = a profiler object to record stage timings (optional, disabled if None)
         '''
         self.params = params
+        if prof is None:
+            prof = profiler ()                              # a disabled profiler
+        self.profiler = prof
         self.columns = ('id1', 'id2', 'x', 'y', 'z', 'sdiff', 'tdiff', 'hdiff',
                         't1_angle', 't1_vel', 'h1_angle', 't2_angle', 't2_vel', 'h2_angle',
                         'h1_vel', 'h2_vel', 'flow_x', 'flow_y', 'weight')
-        self.df = pd.DataFrame (columns = self.columns)
+        
+        # the state values copied into each intersection, these can be recovered from id1 and id2
+        # so they are not stored in compact mode
+        self.derived_columns = ('t1_angle', 't1_vel', 'h1_angle', 't2_angle', 't2_vel', 'h2_angle')
+        self.compact_columns = tuple ([c for c in self.columns if not c in self.derived_columns])
+        if self.params.compact_storage:
+            self.df = pd.DataFrame (columns = self.compact_columns)
+        else:
+            self.df = pd.DataFrame (columns = self.columns)
         self.done_states_callback = done_states_callback
+        self.running = running_stats (params)               # weighted running flow stats
+        self.thinned = running_stats (params, params.thin_cell_size)    # stats of thinned intersections
+        self.thin_keys = np.zeros (0)                       # reservoir sampling keys of stored rows
+        self.thin_cells = np.zeros ((0, 3), dtype = np.int64)   # thinning cell (col, row, time bin)
+                                                            # of stored rows
+        self.index = candidate_index ()                     # spatial index of the states (see
+                                                            # params.candidate_search_radius)
         return
     
     def update (self, states):
         '''
         method to update intersections with a supplied states dataframe
         states = a states dataframe to be intersected
+        returns the new intersections that were stored (the rows that survived thinning)
         '''
-        df = self.intersect (states)                        # run intersections
-        df = self.calc_all (df)                             # calculate all intersections
-        df = self.post_validate (df, states)                # run post validation
-        df = self.calc_weights (df)                         # calculate weights
-        self.df = self.df.append (df, ignore_index = True)  # append to existing intersections
+        self.profiler.begin_event ()
+        if self.params.fused_kernel:
+            tic = self.profiler.tic ()
+            df = self.intersect_fused (states)              # intersect, solve, validate, and weight
+            self.profiler.toc ('fused_kernel', tic)
+        else:
+            tic = self.profiler.tic ()
+            df = self.intersect (states)                    # run intersections
+            self.profiler.toc ('intersect', tic)
+        
+            tic = self.profiler.tic ()
+            df = self.calc_all (df, states)                 # calculate all intersections
+            self.profiler.toc ('solve', tic)
+        
+            tic = self.profiler.tic ()
+            n_solved = df.shape[0]
+            df = self.post_validate (df, states)            # run post validation
+            self.profiler.count ('post_validate_rejected', n_solved - df.shape[0])
+            self.profiler.toc ('post_validate', tic)
+        
+            tic = self.profiler.tic ()
+            df = self.calc_weights (df)                     # calculate weights
+            self.profiler.toc ('calc_weights', tic)
+        
+        tic = self.profiler.tic ()
+        if self.params.compact_storage:
+            df = self.compact (df)                          # drop derived columns, cast to float32
+        if self.df.shape[0] == 0:
+            self.df = df.reset_index (drop = True)          # keep the dtypes of the first add
+        else:
+            self.df = self.df.append (df, ignore_index = True)  # append to existing intersections
+        self.profiler.count ('intersections_stored', df.shape[0])
+        self.profiler.toc ('append', tic)
+        
+        tic = self.profiler.tic ()
+        self.running.update (df)                            # update the running flow stats
+        self.profiler.toc ('running_stats', tic)
+        
+        n_added = df.shape[0]
+        if not self.params.thin_max_per_cell is None:
+            tic = self.profiler.tic ()
+            n_added = self.thin (df.shape[0], states)       # cap the stored intersections per cell
+            self.profiler.toc ('thin', tic)
+        
         self.done_states_callback ()                        # call done states callback
-        return
+        self.profiler.end_event ('update')
+        return (self.df.iloc[self.df.shape[0] - n_added:])
         
     def intersect (self, full_states):
         '''
@@ -64,11 +128,23 @@ class intersections:
         # set up a subset dataframe we will append intersections into
         df = pd.DataFrame (columns = self.columns)
         
+        # optional spatial index over all the states (all vehicles) to limit the candidate pairs,
+        # this only indexes the states added since the last update
+        radius = self.params.candidate_search_radius
+        if not radius is None:
+            self.index.sync (full_states, radius)
+        
         # loop from the 'from_states' to the full states dataframe
         for i in range (0, from_states.shape[0]):
             lead_index = from_states.index[i]           # get the index here
-            states = full_states.iloc[0:lead_index, :]  # cut the full states down to only
-                                                        # include a portion of the states
+            if radius is None:
+                states = full_states.iloc[0:lead_index, :]  # cut the full states down to only
+                                                            # include a portion of the states
+            else:
+                # only the earlier states within the search radius
+                candidates = self.index.query (from_states.loc[lead_index, 'x'], from_states.loc[lead_index, 'y'],
+                                               from_states.loc[lead_index, 'z'], lead_index)
+                states = full_states.iloc[candidates, :]
             
             # ensure we successfully pulled some states
             if states.shape[0] > 0:
@@ -80,7 +156,7 @@ class intersections:
                 sdiff = np.sqrt (xdiff**2.0 + ydiff**2.0 + zdiff**2.0)
                 
                 # time differences between intersections
-                tdiff = from_states.loc[lead_index, 'time'] - np.array (states['time'])
+                tdiff = np.absolute (from_states.loc[lead_index, 'time'] - np.array (states['time']))
                 
                 # heading differences between intersections
                 hdiff = np.absolute (from_states.loc[lead_index, 'heading'] - np.array (states['heading']))
@@ -91,6 +167,16 @@ class intersections:
                 no_self_intersect = from_states.loc[lead_index, 'id'] != np.array (states['id'])
                 mask = mask & no_self_intersect                 # mask out the from_state by id
                 
+                # restrict to pairs within or across vehicles (fleets)
+                if 'vehicle' in states.columns and not self.params.intersect_vehicles == 'all':
+                    same_vehicle = from_states.loc[lead_index, 'vehicle'] == np.array (states['vehicle'])
+                    if self.params.intersect_vehicles == 'within':
+                        mask = mask & same_vehicle
+                    else:
+                        mask = mask & ~same_vehicle
+                self.profiler.count ('pairs_considered', mask.shape[0])
+                self.profiler.count ('pairs_accepted', mask.sum ())
+                
                 # make an add dataframe that is blank
                 add_data = np.zeros((mask[mask].shape[0], len(self.columns)))
                 add = pd.DataFrame (data = np.nan * add_data,
@@ -115,6 +201,91 @@ class intersections:
                 # append to df
                 df = df.append (add, ignore_index = True)
         
+        # ids as float, like the rest of the columns (the empty frame above makes them object)
+        df['id1'] = np.array (df['id1'], dtype = float)
+        df['id2'] = np.array (df['id2'], dtype = float)
+        return (df)
+    
+    def intersect_fused (self, full_states):
+        '''
+        intersect, solve, post-validate, and weight the states that are not done yet in one
+        pass with the fused kernel (numba if available, numpy otherwise). This uses the default
+        validation and weight models with the thresholds on the params object.
+        full_states = the full dataframe of states to be intersected
+        returns a dataframe of the accepted intersections
+        '''
+        # local numpy arrays of the states
+        x = np.array (full_states['x'], dtype = float)
+        y = np.array (full_states['y'], dtype = float)
+        z = np.array (full_states['z'], dtype = float)
+        t = np.array (full_states['time'], dtype = float)
+        track = np.array (full_states['track'], dtype = float)
+        velocity = np.array (full_states['velocity'], dtype = float)
+        heading = np.array (full_states['heading'], dtype = float)
+        ids = np.array (full_states['id'], dtype = float)
+        min_flowspeed = np.array (full_states['min_flowspeed'], dtype = float)
+        max_flowspeed = np.array (full_states['max_flowspeed'], dtype = float)
+        if 'tx' in full_states.columns:
+            tx = np.array (full_states['tx'], dtype = float)
+            ty = np.array (full_states['ty'], dtype = float)
+            hx = np.array (full_states['hx'], dtype = float)
+            hy = np.array (full_states['hy'], dtype = float)
+        else:
+            tx = velocity * np.sin (track * pi / 180.0)
+            ty = velocity * np.cos (track * pi / 180.0)
+            hx = np.sin (heading * pi / 180.0)
+            hy = np.cos (heading * pi / 180.0)
+        
+        # vehicle codes and the within / across vehicle mode
+        vehicle_mode = 0
+        vehicle = np.zeros (x.shape[0], dtype = np.int64)
+        if 'vehicle' in full_states.columns and not self.params.intersect_vehicles == 'all':
+            vehicle = np.array (pd.factorize (full_states['vehicle'])[0], dtype = np.int64)
+            vehicle_mode = 1 if self.params.intersect_vehicles == 'within' else 2
+        
+        p = self.params
+        thresholds = np.array ([p.max_dist, p.max_timediff, p.min_heading_diff, p.space_zero,
+                                p.time_zero, p.heading_zero], dtype = float)
+        leads = np.where (np.array (full_states['done'], dtype = float) < 1.0)[0]
+        
+        # candidate lists from the spatial index (see intersect), otherwise all earlier states
+        cand_offsets = None
+        cand_index = None
+        if not p.candidate_search_radius is None:
+            self.index.sync (full_states, p.candidate_search_radius)
+            candidates = [self.index.query (x[i], y[i], z[i], i) for i in leads]
+            cand_offsets = np.concatenate (([0], np.cumsum ([c.shape[0] for c in candidates])))
+            cand_index = np.concatenate ([np.zeros (0, dtype = np.int64)] + candidates)
+        
+        out, counts = fused (leads, x, y, z, t, heading, tx, ty, hx, hy, ids, vehicle, min_flowspeed,
+                             max_flowspeed, thresholds, vehicle_mode, p.use_numba, cand_offsets, cand_index)
+        self.profiler.count ('pairs_considered', counts[0])
+        self.profiler.count ('pairs_accepted', counts[1])
+        self.profiler.count ('post_validate_rejected', counts[2])
+        
+        # build the intersections dataframe
+        i = out[:, 0].astype (np.int64)
+        j = out[:, 1].astype (np.int64)
+        df = pd.DataFrame (index = np.arange (0, out.shape[0]))
+        df['id1'] = ids[i]
+        df['id2'] = ids[j]
+        df['x'] = (x[i] + x[j]) / 2.0
+        df['y'] = (y[i] + y[j]) / 2.0
+        df['z'] = (z[i] + z[j]) / 2.0
+        df['sdiff'] = out[:, 2]
+        df['tdiff'] = out[:, 3]
+        df['hdiff'] = out[:, 4]
+        df['t1_angle'] = track[i]
+        df['t1_vel'] = velocity[i]
+        df['h1_angle'] = heading[i]
+        df['t2_angle'] = track[j]
+        df['t2_vel'] = velocity[j]
+        df['h2_angle'] = heading[j]
+        df['h1_vel'] = out[:, 5]
+        df['h2_vel'] = out[:, 6]
+        df['flow_x'] = out[:, 7]
+        df['flow_y'] = out[:, 8]
+        df['weight'] = out[:, 9]
         return (df)
     
     def post_validate (self, df, states):
@@ -137,26 +308,62 @@ class intersections:
         df.loc[:, 'weight'] = self.params.calc_weights (df)
         return (df)
     
-    def calc_all (self, df):
+    def calc_all (self, df, states):
         '''
         method to calculate intersections and add intersections data from a subset
         df = a subset dataframe of intersections
+        states = the states dataframe (the precomputed tx, ty, hx, hy vectors are used if present)
         returns the dataframe with appended columns
         '''
-
-        for i in range (0, df.shape[0]):
-            # calculate the intersection and record
-            h1_vel, h2_vel, flow_x, flow_y = self.calc (df['t1_angle'][i], df['t1_vel'][i],
-                                                        df['h1_angle'][i], df['t2_angle'][i],
-                                                        df['t2_vel'][i], df['h2_angle'][i])
+        if df.shape[0] == 0:
+            return (df)
         
-            df['h1_vel'][i] = h1_vel
-            df['h2_vel'][i] = h2_vel
-            df['flow_x'][i] = flow_x
-            df['flow_y'][i] = flow_y
-
+        # get the ground velocity and heading vectors of both states in each pair
+        if 'tx' in states.columns:
+            lookup = states.set_index ('id').loc[:, ['tx', 'ty', 'hx', 'hy']]
+            v1 = np.array (lookup.loc[np.array (df['id1'], dtype = float)], dtype = float)
+            v2 = np.array (lookup.loc[np.array (df['id2'], dtype = float)], dtype = float)
+        else:
+            v1 = np.zeros ((df.shape[0], 4))
+            v2 = np.zeros ((df.shape[0], 4))
+            for v, n in ((v1, '1'), (v2, '2')):
+                t_angle = np.array (df['t' + n + '_angle'], dtype = float) * pi / 180.0
+                t_vel = np.array (df['t' + n + '_vel'], dtype = float)
+                h_angle = np.array (df['h' + n + '_angle'], dtype = float) * pi / 180.0
+                v[:, 0] = t_vel * np.sin (t_angle)
+                v[:, 1] = t_vel * np.cos (t_angle)
+                v[:, 2] = np.sin (h_angle)
+                v[:, 3] = np.cos (h_angle)
+        
+        h1_vel, h2_vel, flow_x, flow_y = self.solve (v1[:, 0], v1[:, 1], v1[:, 2], v1[:, 3],
+                                                     v2[:, 0], v2[:, 1], v2[:, 2], v2[:, 3])
+        df.loc[:, 'h1_vel'] = h1_vel
+        df.loc[:, 'h2_vel'] = h2_vel
+        df.loc[:, 'flow_x'] = flow_x
+        df.loc[:, 'flow_y'] = flow_y
         return (df)
 
+    def solve (self, t1x, t1y, h1x, h1y, t2x, t2y, h2x, h2y):
+        '''
+        method to solve many intersections at once from vectors, this is the 2x2 system
+        t1 - (h1_vel * h1) = t2 - (h2_vel * h2) = flow solved with cramer's rule
+        
+        t1x, t1y = ground velocity vector 1 (numpy arrays)
+        h1x, h1y = heading unit vector 1 (numpy arrays)
+        t2x, t2y = ground velocity vector 2 (numpy arrays)
+        h2x, h2y = heading unit vector 2 (numpy arrays)
+        returns h1_vel, h2_vel, flow_x, flow_y (nan where the headings are parallel)
+        '''
+        dx = t1x - t2x
+        dy = t1y - t2y
+        det = (h2x * h1y) - (h1x * h2y)
+        det = np.where (det == 0.0, np.nan, det)            # parallel headings never intersect
+        h1_vel = ((h2x * dy) - (h2y * dx)) / det
+        h2_vel = ((h1x * dy) - (h1y * dx)) / det
+        flow_x = t1x - (h1_vel * h1x)
+        flow_y = t1y - (h1_vel * h1y)
+        return (h1_vel, h2_vel, flow_x, flow_y)
+
     def calc (self, t1_angle, t1_vel, h1_angle, t2_angle, t2_vel, h2_angle):
         '''
         method to calculate a given intersection
@@ -200,6 +407,139 @@ class intersections:
             
         return (h1_vel, h2_vel, flow_x, flow_y)
     
+    def thin_priority (self, weight):
+        '''
+        method to make the thinning priority keys of intersections for params.thin_method, the
+        weight for 'top', or the weighted reservoir key u^(1/weight) for 'reservoir'
+        weight = the intersection weights (numpy array)
+        returns a numpy array of keys (higher keys are kept)
+        '''
+        if self.params.thin_method == 'reservoir':
+            u = np.random.uniform (0.0, 1.0, weight.shape[0])
+            keys = np.zeros (weight.shape[0])
+            positive = weight > 0.0
+            keys[positive] = u[positive]**(1.0 / weight[positive])
+        else:
+            keys = weight.copy ()
+        keys[np.isnan (keys)] = -1.0
+        return (keys)
+
+    def thin_cell (self, df, states):
+        '''
+        method to find the thinning cells of intersections
+        df = rows of an intersections dataframe
+        states = the states dataframe (for the intersection times, if thinning in time)
+        returns an int numpy array [n, 3] of the column, row, and time bin of each intersection
+        '''
+        size = self.params.thin_cell_size
+        cells = np.zeros ((df.shape[0], 3), dtype = np.int64)
+        cells[:, 0] = np.floor (np.array (df['x'], dtype = float) / size)
+        cells[:, 1] = np.floor (np.array (df['y'], dtype = float) / size)
+        if not self.params.thin_time_bin is None and df.shape[0] > 0:
+            times = states.set_index ('id')['time']
+            time = (np.array (times.loc[np.array (df['id1'], dtype = float)], dtype = float) +
+                    np.array (times.loc[np.array (df['id2'], dtype = float)], dtype = float)) / 2.0
+            cells[:, 2] = np.floor (time / self.params.thin_time_bin)
+        return (cells)
+
+    def thin (self, n_new, states):
+        '''
+        method to cap the number of stored intersections per spatial (and optionally temporal) cell,
+        keeping the highest weight intersections ('top') or a weighted reservoir sample ('reservoir')
+        per params.thin_method. Only the cells touched by the new intersections are ranked. The
+        dropped intersections are summarized in self.thinned (running stats per cell).
+        n_new = the number of new intersections at the end of the stored dataframe
+        states = the states dataframe (for the intersection times, if thinning in time)
+        returns the number of new intersections kept (these stay at the end of the stored dataframe)
+        '''
+        n = self.df.shape[0]
+        n_old = n - n_new
+        
+        # the keys and cells of the stored rows are missing if thinning was just turned on or the
+        # intersections were read from disk, so make them for all the stored rows once
+        if not self.thin_keys.shape[0] == n_old or not self.thin_cells.shape[0] == n_old:
+            old = self.df.iloc[0:n_old]
+            self.thin_keys = self.thin_priority (np.array (old['weight'], dtype = float))
+            self.thin_cells = self.thin_cell (old, states)
+        
+        # priority keys and cells of the new rows (reservoir keys are kept, so the sample stays unbiased)
+        new = self.df.iloc[n_old:]
+        new_keys = self.thin_priority (np.array (new['weight'], dtype = float))
+        self.thin_keys = np.concatenate ((self.thin_keys, new_keys))
+        self.thin_cells = np.concatenate ((self.thin_cells, self.thin_cell (new, states)))
+        if n_new == 0:
+            return (0)
+        
+        # find the rows in the touched cells with a hash of the cells (a collision only adds rows to
+        # the candidates, as they are grouped by the cells themselves below)
+        cells = self.thin_cells
+        code = (cells[:, 0] * 73856093) ^ (cells[:, 1] * 19349663) ^ (cells[:, 2] * 83492791)
+        position = np.where (np.isin (code, np.unique (code[n_old:])))[0]
+        
+        # rank the intersections in the touched cells and drop any over the cap
+        group = np.unique (cells[position], axis = 0, return_inverse = True)[1].ravel ()
+        candidates = pd.DataFrame ({'group': group, 'key': self.thin_keys[position], 'position': position})
+        candidates = candidates.sort_values (['group', 'key'], ascending = [True, False], kind = 'mergesort')
+        rank = candidates.groupby ('group').cumcount ()
+        drop = np.array (candidates.loc[rank >= self.params.thin_max_per_cell, 'position'])
+        if drop.shape[0] == 0:
+            return (n_new)
+        
+        self.thinned.update (self.df.iloc[drop])
+        keep = np.ones (n, dtype = bool)
+        keep[drop] = False
+        self.df = self.df[keep].reset_index (drop = True)
+        self.thin_keys = self.thin_keys[keep]
+        self.thin_cells = self.thin_cells[keep]
+        self.profiler.count ('thinned', drop.shape[0])
+        return (int (n_new - np.sum (drop >= n_old)))
+
+    def compact (self, df):
+        '''
+        method to convert an intersections dataframe to compact storage: the derived state columns
+        are dropped, ids are stored as int32 and measurements as float32. Locations stay float64,
+        as float32 rounds projected coordinates (e.g., ~0.25 m at utm northings)
+        df = an intersections dataframe
+        returns the compact dataframe
+        '''
+        compact = pd.DataFrame (index = df.index)
+        for column in self.compact_columns:
+            if column in ('id1', 'id2'):
+                compact[column] = np.array (df[column], dtype = np.int32)
+            elif column in ('x', 'y', 'z'):
+                compact[column] = np.array (df[column], dtype = np.float64)
+            else:
+                compact[column] = np.array (df[column], dtype = np.float32)
+        return (compact)
+
+    def expand (self, states, df = None):
+        '''
+        method to recompute the derived state columns (t1_angle, t1_vel, h1_angle, t2_angle, t2_vel,
+        h2_angle) of compact intersections from the states dataframe
+        states = the states dataframe
+        df = a compact intersections dataframe (optional, defaults to the stored intersections)
+        returns a dataframe with the full set of intersections columns
+        '''
+        if df is None:
+            df = self.df
+        lookup = states.set_index ('id')
+        full = df.copy ()
+        for n in ('1', '2'):
+            ids = np.array (df['id' + n], dtype = float)
+            full['t' + n + '_angle'] = np.array (lookup.loc[ids, 'track'], dtype = float)
+            full['t' + n + '_vel'] = np.array (lookup.loc[ids, 'velocity'], dtype = float)
+            full['h' + n + '_angle'] = np.array (lookup.loc[ids, 'heading'], dtype = float)
+        full = full.loc[:, list (self.columns)]
+        return (full)
+
+    def bytes_per_intersection (self):
+        '''
+        method to report the memory used per stored intersection (bytes)
+        '''
+        if self.df.shape[0] == 0:
+            return (np.nan)
+        return (float (self.df.memory_usage (index = True, deep = True).sum ()) / self.df.shape[0])
+
     def read_intersections (self, intersections_filename):
         '''
         method to read intersections from disk
@@ -207,6 +547,13 @@ class intersections:
         '''
         try:
             self.df = pd.read_csv (intersections_filename)
+            if self.params.compact_storage:
+                self.df = self.compact (self.df)
+            self.running.reset ()
+            self.running.update (self.df)
+            self.thinned.reset ()
+            self.thin_keys = np.zeros (0)                   # made by the next thin (see thin_priority)
+            self.thin_cells = np.zeros ((0, 3), dtype = np.int64)
         except:
             print ('ERROR: cannot read the intersections filename ' + intersections_filename)
             
@@ -0,0 +1,253 @@
+# flow rider
+# Copyright 2016 Thomas E. Barchyn
+# Contact: Thomas E. Barchyn [tbarchyn@gmail.com]
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# Please familiarize yourself with the license of this tool, available
+# in the distribution with the filename: /docs/license.txt
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# purpose: when you are riding the flow and you gotta know . . .
+
+# NOTES: fused kernels for candidate enumeration, pre-validation, the 2x2 solve, flowspeed
+# post-validation, and weighting. Each new (not done) state is paired with all earlier states and
+# only the accepted intersections are written out. These implement the default params.pre_validate,
+# params.post_validate, and params.calc_weights models with the thresholds on the params object.
+# The numba kernel makes one pass with no temporary arrays, the numpy kernel is the fallback when
+# numba is not installed and is vectorized over the earlier states for each new state. Each new
+# state is paired with all earlier states, or only with its candidates (e.g., from the spatial
+# index for params.candidate_search_radius) if candidate lists are supplied.
+
+import numpy as np
+
+try:
+    import numba
+    numba_available = True
+except ImportError:
+    numba_available = False
+
+# output columns of the kernels
+kernel_columns = ('i', 'j', 'sdiff', 'tdiff', 'hdiff', 'h1_vel', 'h2_vel', 'flow_x', 'flow_y', 'weight')
+
+def fused_numpy (leads, x, y, z, t, heading, tx, ty, hx, hy, ids, vehicle, min_flowspeed, max_flowspeed,
+                 thresholds, vehicle_mode, cand_offsets, cand_index):
+    '''
+    numpy fused kernel, see fused for the arguments
+    '''
+    max_dist, max_timediff, min_heading_diff, space_zero, time_zero, heading_zero = thresholds
+    counts = np.zeros (3, dtype = np.int64)
+    use_candidates = cand_offsets.shape[0] > 0
+    blocks = []
+    for k in range (0, leads.shape[0]):
+        i = leads[k]
+        if use_candidates:
+            j = cand_index[cand_offsets[k]:cand_offsets[k + 1]]
+        else:
+            j = np.arange (0, i)
+        counts[0] = counts[0] + j.shape[0]
+        if j.shape[0] == 0:
+            continue
+
+        # pre-validate
+        sdiff = np.sqrt ((x[i] - x[j])**2.0 + (y[i] - y[j])**2.0 + (z[i] - z[j])**2.0)
+        tdiff = np.absolute (t[i] - t[j])
+        hdiff = np.absolute (heading[i] - heading[j])
+        hdiff = np.where (hdiff > 180.0, 360.0 - hdiff, hdiff)
+        mask = (sdiff < max_dist) & (tdiff < max_timediff) & (hdiff > min_heading_diff) & (ids[j] != ids[i])
+        if vehicle_mode == 1:
+            mask = mask & (vehicle[j] == vehicle[i])
+        elif vehicle_mode == 2:
+            mask = mask & (vehicle[j] != vehicle[i])
+        j = j[mask]
+        counts[1] = counts[1] + j.shape[0]
+        if j.shape[0] == 0:
+            continue
+        sdiff = sdiff[mask]
+        tdiff = tdiff[mask]
+        hdiff = hdiff[mask]
+
+        # solve
+        dx = tx[i] - tx[j]
+        dy = ty[i] - ty[j]
+        det = (hx[j] * hy[i]) - (hx[i] * hy[j])
+        det = np.where (det == 0.0, np.nan, det)
+        h1_vel = ((hx[j] * dy) - (hy[j] * dx)) / det
+        h2_vel = ((hx[i] * dy) - (hy[i] * dx)) / det
+
+        # post-validate
+        mask = ((h1_vel > min_flowspeed[i]) & (h1_vel < max_flowspeed[i]) &
+                (h2_vel > min_flowspeed[j]) & (h2_vel < max_flowspeed[j]))
+        counts[2] = counts[2] + j.shape[0] - np.sum (mask)
+        j = j[mask]
+        if j.shape[0] == 0:
+            continue
+        sdiff = sdiff[mask]
+        tdiff = tdiff[mask]
+        hdiff = hdiff[mask]
+        h1_vel = h1_vel[mask]
+        h2_vel = h2_vel[mask]
+
+        # weights
+        weight = (np.maximum (1.0 - (sdiff / space_zero), 0.0) + np.maximum (1.0 - (tdiff / time_zero), 0.0) +
+                  np.maximum (1.0 - (np.absolute (hdiff - 90.0) / heading_zero), 0.0)) / 3.0
+
+        block = np.empty ((j.shape[0], len (kernel_columns)))
+        block[:, 0] = i
+        block[:, 1] = j
+        block[:, 2] = sdiff
+        block[:, 3] = tdiff
+        block[:, 4] = hdiff
+        block[:, 5] = h1_vel
+        block[:, 6] = h2_vel
+        block[:, 7] = tx[i] - (h1_vel * hx[i])
+        block[:, 8] = ty[i] - (h1_vel * hy[i])
+        block[:, 9] = weight
+        blocks.append (block)
+
+    if len (blocks) == 0:
+        return (np.empty ((0, len (kernel_columns))), counts)
+    return (np.concatenate (blocks), counts)
+
+def fused_loops (leads, x, y, z, t, heading, tx, ty, hx, hy, ids, vehicle, min_flowspeed, max_flowspeed,
+                 thresholds, vehicle_mode, cand_offsets, cand_index):
+    '''
+    scalar fused kernel, this is compiled with numba (it is very slow as plain python), see fused
+    for the arguments
+    '''
+    max_dist = thresholds[0]
+    max_timediff = thresholds[1]
+    min_heading_diff = thresholds[2]
+    space_zero = thresholds[3]
+    time_zero = thresholds[4]
+    heading_zero = thresholds[5]
+
+    capacity = 1024
+    out = np.empty ((capacity, 10))
+    counts = np.zeros (3, dtype = np.int64)
+    use_candidates = cand_offsets.shape[0] > 0
+    n = 0
+    for k in range (leads.shape[0]):
+        i = leads[k]
+        if use_candidates:
+            first = cand_offsets[k]
+            last = cand_offsets[k + 1]
+        else:
+            first = 0
+            last = i
+        counts[0] = counts[0] + last - first
+        for c in range (first, last):
+            if use_candidates:
+                j = cand_index[c]
+            else:
+                j = c
+
+            # pre-validate
+            if ids[j] == ids[i]:
+                continue
+            if vehicle_mode == 1 and vehicle[j] != vehicle[i]:
+                continue
+            if vehicle_mode == 2 and vehicle[j] == vehicle[i]:
+                continue
+            tdiff = abs (t[i] - t[j])
+            if not tdiff < max_timediff:
+                continue
+            hdiff = abs (heading[i] - heading[j])
+            if hdiff > 180.0:
+                hdiff = 360.0 - hdiff
+            if not hdiff > min_heading_diff:
+                continue
+            sdiff = np.sqrt ((x[i] - x[j])**2 + (y[i] - y[j])**2 + (z[i] - z[j])**2)
+            if not sdiff < max_dist:
+                continue
+            counts[1] = counts[1] + 1
+
+            # solve
+            det = (hx[j] * hy[i]) - (hx[i] * hy[j])
+            if det == 0.0:
+                counts[2] = counts[2] + 1
+                continue
+            dx = tx[i] - tx[j]
+            dy = ty[i] - ty[j]
+            h1_vel = ((hx[j] * dy) - (hy[j] * dx)) / det
+            h2_vel = ((hx[i] * dy) - (hy[i] * dx)) / det
+
+            # post-validate
+            if not (h1_vel > min_flowspeed[i] and h1_vel < max_flowspeed[i] and
+                    h2_vel > min_flowspeed[j] and h2_vel < max_flowspeed[j]):
+                counts[2] = counts[2] + 1
+                continue
+
+            # weights
+            weight = max (1.0 - (sdiff / space_zero), 0.0)
+            weight = weight + max (1.0 - (tdiff / time_zero), 0.0)
+            weight = weight + max (1.0 - (abs (hdiff - 90.0) / heading_zero), 0.0)
+
+            # grow the output if needed, and write the accepted intersection
+            if n == capacity:
+                capacity = capacity * 2
+                grown = np.empty ((capacity, 10))
+                grown[:n, :] = out[:n, :]
+                out = grown
+            out[n, 0] = i
+            out[n, 1] = j
+            out[n, 2] = sdiff
+            out[n, 3] = tdiff
+            out[n, 4] = hdiff
+            out[n, 5] = h1_vel
+            out[n, 6] = h2_vel
+            out[n, 7] = tx[i] - (h1_vel * hx[i])
+            out[n, 8] = ty[i] - (h1_vel * hy[i])
+            out[n, 9] = weight / 3.0
+            n = n + 1
+    return (out[:n, :].copy (), counts)
+
+if numba_available:
+    fused_numba = numba.njit (cache = False) (fused_loops)
+else:
+    fused_numba = None
+
+def fused (leads, x, y, z, t, heading, tx, ty, hx, hy, ids, vehicle, min_flowspeed, max_flowspeed,
+           thresholds, vehicle_mode = 0, use_numba = True, cand_offsets = None, cand_index = None):
+    '''
+    function to intersect, solve, validate, and weight in one pass
+    leads = positions of the new states to pair with all earlier states (int numpy array)
+    x, y, z = state positions (numpy arrays)
+    t = state times (numpy array)
+    heading = state headings (degrees, numpy array)
+    tx, ty = state ground velocity vectors (numpy arrays)
+    hx, hy = state heading unit vectors (numpy arrays)
+    ids = state ids (numpy array)
+    vehicle = state vehicle codes (int numpy array)
+    min_flowspeed, max_flowspeed = state realistic flowspeeds (numpy arrays)
+    thresholds = numpy array of max_dist, max_timediff, min_heading_diff, space_zero, time_zero,
+                 heading_zero
+    vehicle_mode = 0 for all pairs, 1 for pairs within vehicles, 2 for pairs across vehicles
+    use_numba = boolean to use the numba kernel if numba is available
+    cand_offsets = candidate list offsets, the candidates of leads[k] are
+                   cand_index[cand_offsets[k]:cand_offsets[k + 1]] (optional, if None each lead is
+                   paired with all earlier states)
+    cand_index = candidate state positions, ascending within each lead (optional)
+    returns an array with a row per accepted intersection and the kernel_columns (i and j are
+    the positions of the pair of states), and an array of the counts of pairs considered, pairs
+    accepted by pre-validation, and pairs rejected by post-validation
+    '''
+    if use_numba and numba_available:
+        kernel = fused_numba
+    else:
+        kernel = fused_numpy
+    if cand_offsets is None:
+        cand_offsets = np.zeros (0, dtype = np.int64)
+        cand_index = np.zeros (0, dtype = np.int64)
+    return (kernel (np.asarray (leads, dtype = np.int64), x, y, z, t, heading, tx, ty, hx, hy, ids, vehicle,
+                    min_flowspeed, max_flowspeed, np.asarray (thresholds, dtype = float), vehicle_mode,
+                    np.asarray (cand_offsets, dtype = np.int64), np.asarray (cand_index, dtype = np.int64)))
@@ -0,0 +1,191 @@
+# flow rider
+# Copyright 2016 Thomas E. Barchyn
+# Contact: Thomas E. Barchyn [tbarchyn@gmail.com]
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# Please familiarize yourself with the license of this tool, available
+# in the distribution with the filename: /docs/license.txt
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# purpose: when you are riding the flow and you gotta know . . .
+
+# NOTES: ordinary kriging of the flow components with local neighbourhoods. An exponential
+# variogram (nugget + sill * (1 - exp (-h / range))) is fit to each flow component from a random
+# sample of the intersections, so fitting costs the same at any size. Each cell is then kriged from
+# its params.kriging_neighbours nearest intersections, with the kriging systems of a chunk of cells
+# solved together as one batched solve. The cost is O(n log n) for the tree and O(m k^3) for m cells
+# and k neighbours, and memory is bounded by the chunk size, so 10^6 intersections and 10^6 cells
+# fit on a CPU-only machine. The nugget is the intersection noise: each intersection gets a nugget
+# of nugget / weight (weights scaled to a mean of 1), so low weight intersections count for less. The
+# estimates and standard deviations are of the smooth flow field (the nugget is not added back), so
+# the standard deviations shrink where there are many good intersections and grow away from them.
+
+from math import *
+import numpy as np
+from scipy.spatial import cKDTree as KDTree
+from scipy.optimize import curve_fit
+
+def exponential_variogram (h, nugget, sill, range_):
+    '''
+    function for the exponential variogram model
+    h = lag distances (numpy array)
+    nugget, sill, range_ = the variogram parameters
+    returns the semivariance (numpy array)
+    '''
+    return (nugget + sill * (1.0 - np.exp (-h / range_)))
+
+def empirical_variogram (locs, values, max_lag, n_lags):
+    '''
+    function to calculate the empirical variogram of all the pairs of a (small) set of points
+    locs = the point locations [n, 2]
+    values = the values at the points (numpy array)
+    max_lag = the maximum lag distance
+    n_lags = the number of lag bins
+    returns the bin centre lags, semivariances, and pair counts (numpy arrays, empty bins removed)
+    '''
+    i, j = np.triu_indices (locs.shape[0], k = 1)
+    h = np.sqrt (np.sum ((locs[i] - locs[j])**2.0, axis = 1))
+    sq = 0.5 * (values[i] - values[j])**2.0
+    keep = h < max_lag
+    edges = np.linspace (0.0, max_lag, n_lags + 1)
+    bins = np.digitize (h[keep], edges) - 1
+    counts = np.bincount (bins, minlength = n_lags)[:n_lags]
+    sums = np.bincount (bins, weights = sq[keep], minlength = n_lags)[:n_lags]
+    lags = (edges[:-1] + edges[1:]) / 2.0
+    ok = counts > 0
+    return (lags[ok], sums[ok] / counts[ok], counts[ok])
+
+class kriging:
+    '''
+    this class fits variograms and runs local ordinary kriging of the flow components
+    '''
+    def __init__ (self, params):
+        '''
+        constructor
+        params = a parameter object
+        '''
+        self.params = params
+        self.variograms = {}                            # flow component -> (nugget, sill, range)
+        return
+
+    def fit_variogram (self, locs, values, seed = 0):
+        '''
+        method to fit an exponential variogram to a sample of the points
+        locs = the point locations [n, 2]
+        values = the values at the points (numpy array)
+        seed = random seed for the sample
+        returns the nugget, sill, and range
+        '''
+        n = locs.shape[0]
+        sample = self.params.kriging_variogram_sample
+        if n > sample:
+            pick = np.random.RandomState (seed).choice (n, sample, replace = False)
+            locs = locs[pick]
+            values = values[pick]
+
+        extent = np.sqrt (np.sum ((locs.max (axis = 0) - locs.min (axis = 0))**2.0))
+        max_lag = self.params.kriging_max_lag
+        if max_lag is None:
+            max_lag = extent / 2.0
+        variance = np.var (values)
+        default = (0.1 * variance, 0.9 * variance, max (max_lag / 3.0, 1e-12))
+        if not max_lag > 0.0 or not variance > 0.0:
+            return (default)
+
+        lags, gamma, counts = empirical_variogram (locs, values, max_lag, self.params.kriging_variogram_lags)
+        if lags.shape[0] < 3:
+            return (default)
+        try:
+            fitted, cov = curve_fit (exponential_variogram, lags, gamma, p0 = default,
+                                     sigma = 1.0 / np.sqrt (counts),
+                                     bounds = ([0.0, 1e-12, 1e-12], [np.inf, np.inf, 10.0 * max_lag]))
+            return (tuple (fitted))
+        except:
+            print ('WARNING: variogram fit failed, using a default variogram')
+            return (default)
+
+    def fit (self, locs, flow_x, flow_y):
+        '''
+        method to fit the variograms of both flow components
+        locs = the intersection locations [n, 2]
+        flow_x, flow_y = the intersection flows (numpy arrays)
+        '''
+        self.variograms['flow_x'] = self.fit_variogram (locs, flow_x, seed = 0)
+        self.variograms['flow_y'] = self.fit_variogram (locs, flow_y, seed = 1)
+        return
+
+    def solve (self, d_data, d_target, noise, variogram):
+        '''
+        method to solve a batch of ordinary kriging systems
+        d_data = distances between the neighbours of each cell [m, k, k]
+        d_target = distances from each cell to its neighbours [m, k]
+        noise = nugget variance of each neighbour [m, k]
+        variogram = the nugget, sill, and range
+        returns the kriging weights [m, k] and the kriging variances [m]
+        '''
+        nugget, sill, range_ = variogram
+        m, k = d_target.shape
+        a = np.ones ((m, k + 1, k + 1))
+        a[:, :k, :k] = sill * np.exp (-d_data / range_)
+        a[:, np.arange (k), np.arange (k)] += noise + 1e-10 * sill     # small jitter for repeated points
+        a[:, k, k] = 0.0
+        b = np.ones ((m, k + 1))
+        b[:, :k] = sill * np.exp (-d_target / range_)
+        try:
+            x = np.linalg.solve (a, b[:, :, None])[:, :, 0]
+        except np.linalg.LinAlgError:
+            x = np.zeros ((m, k + 1))
+            for c in range (0, m):
+                x[c] = np.linalg.lstsq (a[c], b[c], rcond = None)[0]
+        variance = sill - np.sum (x[:, :k] * b[:, :k], axis = 1) - x[:, k]
+        return (x[:, :k], np.maximum (variance, 0.0))
+
+    def predict (self, locs, flow_x, flow_y, weight, points):
+        '''
+        method to krige both flow components at many points, in chunks of params.kriging_chunk_size
+        locs = the intersection locations [n, 2]
+        flow_x, flow_y = the intersection flows (numpy arrays)
+        weight = the intersection weights (numpy array)
+        points = the points to estimate at [m, 2]
+        returns flow_x_mean, flow_y_mean, flow_x_sd, flow_y_sd, flow_x_med, flow_y_med numpy arrays
+        '''
+        m = points.shape[0]
+        out = np.zeros ((6, m)) * np.nan
+        keep = ~(np.isnan (flow_x) | np.isnan (flow_y) | np.isnan (weight)) & (weight > 0.0)
+        locs = locs[keep]
+        flow_x = flow_x[keep]
+        flow_y = flow_y[keep]
+        weight = weight[keep] / np.mean (weight[keep]) if np.any (keep) else weight[keep]
+        k = min (self.params.kriging_neighbours, locs.shape[0])
+        if k == 0:
+            return (out[0], out[1], out[2], out[3], out[4], out[5])
+        self.fit (locs, flow_x, flow_y)
+        tree = KDTree (locs, leafsize = 10)
+
+        chunk = self.params.kriging_chunk_size
+        for start in range (0, m, chunk):
+            end = min (start + chunk, m)
+            dists, indices = tree.query (points[start:end], k = k, eps = 0.0)
+            dists = dists.reshape ((end - start, k))
+            indices = indices.reshape ((end - start, k))
+            near = locs[indices]
+            d_data = np.sqrt (np.sum ((near[:, :, None, :] - near[:, None, :, :])**2.0, axis = 3))
+            for row, name, values in ((0, 'flow_x', flow_x), (1, 'flow_y', flow_y)):
+                variogram = self.variograms[name]
+                noise = variogram[0] / weight[indices]
+                w, variance = self.solve (d_data, dists, noise, variogram)
+                out[row, start:end] = np.sum (w * values[indices], axis = 1)
+                out[row + 2, start:end] = np.sqrt (variance)
+            out[4, start:end] = np.median (flow_x[indices], axis = 1)
+            out[5, start:end] = np.median (flow_y[indices], axis = 1)
+        return (out[0], out[1], out[2], out[3], out[4], out[5])
@@ -0,0 +1,266 @@
+# flow rider
+# Copyright 2016 Thomas E. Barchyn
+# Contact: Thomas E. Barchyn [tbarchyn@gmail.com]
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# Please familiarize yourself with the license of this tool, available
+# in the distribution with the filename: /docs/license.txt
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# purpose: when you are riding the flow and you gotta know . . .
+
+# NOTES: each state gives ground velocity t = flow + s * h, where h is the heading unit vector
+# and s is the (unknown) speed through the flow. Projecting onto the unit vector perpendicular
+# to the heading, n = (cos(heading), -sin(heading)), removes s:  n . flow = n . t
+# so every state contributes one linear equation in the two flow components. A pairwise
+# intersection is this system with exactly two states, here we solve it over all the states
+# in a spatio-temporal neighbourhood with a weighted (and optionally robust) least squares fit.
+
+from math import *
+import numpy as np
+import pandas as pd
+from scipy.spatial import cKDTree as KDTree
+from profiler import *
+from running_stats import *
+
+class neighbourhoods:
+    '''
+    this class manages neighbourhood flow estimates, an alternative to pairwise intersections
+    that gives one estimate per state from all the states in its neighbourhood
+    '''
+    def __init__ (self, params, done_states_callback, prof = None):
+        '''
+        constructor initializes the neighbourhood estimates dataframe
+        params = a parameter object
+        done_states_callback = callback to set all states to 'done'
+        prof = a profiler object to record stage timings (optional, disabled if None)
+        '''
+        self.params = params
+        if prof is None:
+            prof = profiler ()                              # a disabled profiler
+        self.profiler = prof
+        self.columns = ('id', 'x', 'y', 'z', 'n', 'cond', 'resid_sd', 'h_vel',
+                        'flow_x', 'flow_y', 'weight')
+        self.df = pd.DataFrame (columns = self.columns)
+        self.done_states_callback = done_states_callback
+        self.running = running_stats (params)               # weighted running flow stats
+        return
+
+    def update (self, states):
+        '''
+        method to update neighbourhood estimates with a supplied states dataframe
+        states = a states dataframe, estimates are made centered on states that are not done
+        returns the new estimates that were stored
+        '''
+        self.profiler.begin_event ()
+        tic = self.profiler.tic ()
+        df = self.estimate (states)                         # fit the neighbourhoods
+        self.profiler.toc ('neighbourhood_fit', tic)
+
+        tic = self.profiler.tic ()
+        n_fitted = df.shape[0]
+        df = self.post_validate (df, states)                # run post validation
+        self.profiler.count ('post_validate_rejected', n_fitted - df.shape[0])
+        self.profiler.toc ('post_validate', tic)
+
+        tic = self.profiler.tic ()
+        df = self.calc_weights (df)                         # calculate weights
+        self.profiler.toc ('calc_weights', tic)
+
+        tic = self.profiler.tic ()
+        self.df = self.df.append (df, ignore_index = True)  # append to existing estimates
+        self.profiler.count ('intersections_stored', df.shape[0])
+        self.profiler.toc ('append', tic)
+        
+        tic = self.profiler.tic ()
+        self.running.update (df)                            # update the running flow stats
+        self.profiler.toc ('running_stats', tic)
+
+        self.done_states_callback ()                        # call done states callback
+        self.profiler.end_event ('update')
+        return (self.df.iloc[self.df.shape[0] - df.shape[0]:])
+
+    def estimate (self, full_states):
+        '''
+        fit a neighbourhood estimate centered on every state that is not done yet
+        full_states = the full dataframe of states
+        returns a dataframe of estimates (only those with enough states and heading diversity)
+        '''
+        # local numpy arrays of everything we need from the states
+        ids = np.array (full_states['id'], dtype = float)
+        x = np.array (full_states['x'], dtype = float)
+        y = np.array (full_states['y'], dtype = float)
+        z = np.array (full_states['z'], dtype = float)
+        t = np.array (full_states['time'], dtype = float)
+        done = np.array (full_states['done'], dtype = float)
+
+        # ground velocity and heading vectors (precomputed by states, if present)
+        if 'tx' in full_states.columns:
+            tx = np.array (full_states['tx'], dtype = float)
+            ty = np.array (full_states['ty'], dtype = float)
+            hx = np.array (full_states['hx'], dtype = float)
+            hy = np.array (full_states['hy'], dtype = float)
+        else:
+            track = np.array (full_states['track'], dtype = float) * pi / 180.0
+            velocity = np.array (full_states['velocity'], dtype = float)
+            heading = np.array (full_states['heading'], dtype = float) * pi / 180.0
+            tx = velocity * np.sin (track)
+            ty = velocity * np.cos (track)
+            hx = np.sin (heading)
+            hy = np.cos (heading)
+
+        # the unit vector perpendicular to the heading
+        nx = hy
+        ny = -1.0 * hx
+        b = nx * tx + ny * ty
+
+        rows = []
+        centers = np.where (done < 1.0)[0]
+        if centers.shape[0] > 0:
+            tree = KDTree (np.column_stack ((x, y, z)), leafsize = 10)
+            max_dist = self.params.neighbourhood_max_dist
+            max_timediff = self.params.neighbourhood_max_timediff
+            for c in centers:
+                indices = np.array (tree.query_ball_point ([x[c], y[c], z[c]], r = max_dist), dtype = int)
+                tdiff = np.absolute (t[indices] - t[c])
+                indices = indices[tdiff < max_timediff]
+                self.profiler.count ('pairs_considered', indices.shape[0])
+                if indices.shape[0] < self.params.neighbourhood_min_states:
+                    continue
+
+                # spatio-temporal prior weights (linear taper to zero at the neighbourhood edges)
+                sdiff = np.sqrt ((x[indices] - x[c])**2.0 + (y[indices] - y[c])**2.0 +
+                                 (z[indices] - z[c])**2.0)
+                tdiff = np.absolute (t[indices] - t[c])
+                w = (1.0 - sdiff / max_dist) * (1.0 - tdiff / max_timediff)
+                w[w < 0.0] = 0.0
+
+                flow_x, flow_y, resid_sd, cond = self.fit (nx[indices], ny[indices], b[indices], w)
+                if np.isnan (flow_x) or cond < self.params.neighbourhood_min_cond:
+                    continue
+                self.profiler.count ('pairs_accepted', indices.shape[0])
+
+                # speed through the flow of the center state
+                h_vel = (tx[c] - flow_x) * hx[c] + (ty[c] - flow_y) * hy[c]
+                rows.append ((ids[c], x[c], y[c], z[c], indices.shape[0], cond, resid_sd, h_vel,
+                              flow_x, flow_y, np.nan))
+
+        df = pd.DataFrame (data = rows, columns = self.columns)
+        return (df)
+
+    def fit (self, nx, ny, b, w):
+        '''
+        method to fit a single neighbourhood with weighted least squares, reweighted with a
+        huber loss if params.neighbourhood_huber_k is set
+
+        nx = x components of the unit vectors perpendicular to heading (numpy array)
+        ny = y components of the unit vectors perpendicular to heading (numpy array)
+        b = the ground velocity projected onto the perpendicular unit vectors (numpy array)
+        w = the prior weights (numpy array)
+        returns flow_x, flow_y, resid_sd, cond (cond is the ratio of the normal matrix
+        eigenvalues, 1.0 is perfect heading diversity, 0.0 is all parallel headings)
+        '''
+        flow_x = np.nan
+        flow_y = np.nan
+        resid_sd = np.nan
+        cond = 0.0
+
+        robust_w = np.ones (b.shape[0])
+        iterations = 1
+        if not self.params.neighbourhood_huber_k is None:
+            iterations = iterations + self.params.neighbourhood_max_iterations
+
+        for it in range (0, iterations):
+            ww = w * robust_w
+
+            # normal equations for the 2x2 system
+            a11 = np.sum (ww * nx * nx)
+            a12 = np.sum (ww * nx * ny)
+            a22 = np.sum (ww * ny * ny)
+            r1 = np.sum (ww * nx * b)
+            r2 = np.sum (ww * ny * b)
+            det = a11 * a22 - a12 * a12
+            if not det > 0.0:
+                return (np.nan, np.nan, np.nan, 0.0)
+
+            new_flow_x = (a22 * r1 - a12 * r2) / det
+            new_flow_y = (a11 * r2 - a12 * r1) / det
+            converged = (abs (new_flow_x - flow_x) < 1e-6 and abs (new_flow_y - flow_y) < 1e-6)
+            flow_x = new_flow_x
+            flow_y = new_flow_y
+            resid = b - (nx * flow_x + ny * flow_y)
+            if converged:
+                break
+
+            # huber reweighting from a robust (MAD) estimate of the residual scale
+            if not self.params.neighbourhood_huber_k is None:
+                scale = 1.4826 * np.median (np.absolute (resid - np.median (resid)))
+                if not scale > 0.0:
+                    break
+                u = np.absolute (resid) / (self.params.neighbourhood_huber_k * scale)
+                robust_w = np.ones (b.shape[0])
+                robust_w[u > 1.0] = 1.0 / u[u > 1.0]
+
+        # conditioning from the eigenvalues of the normal matrix
+        trace = a11 + a22
+        disc = sqrt (max ((a11 - a22)**2.0 + 4.0 * a12**2.0, 0.0))
+        cond = (trace - disc) / (trace + disc)
+        resid_sd = sqrt (np.sum (ww * resid**2.0) / np.sum (ww))
+        return (flow_x, flow_y, resid_sd, cond)
+
+    def post_validate (self, df, states):
+        '''
+        method to remove estimates where the center state has an unrealistic speed through the flow
+        df = the dataframe of estimates in this add
+        states = the states dataframe
+        returns a dataframe, but masked by post_validation
+        '''
+        if df.shape[0] == 0:
+            return (df)
+        lookup = states.set_index ('id')
+        min_flowspeed = np.array (lookup.loc[df['id'], 'min_flowspeed'], dtype = float)
+        max_flowspeed = np.array (lookup.loc[df['id'], 'max_flowspeed'], dtype = float)
+        h_vel = np.array (df['h_vel'], dtype = float)
+        mask = (h_vel > min_flowspeed) & (h_vel < max_flowspeed)
+        df = df[mask]
+        return (df)
+
+    def calc_weights (self, df):
+        '''
+        method to calculate static weights for interpolation
+        df = the dataframe of estimates in this add
+        returns a dataframe with weights column calculated
+        '''
+        df.loc[:, 'weight'] = self.params.calc_neighbourhood_weights (df)
+        return (df)
+
+    def read_neighbourhoods (self, neighbourhoods_filename):
+        '''
+        method to read neighbourhood estimates from disk
+        neighbourhoods_filename = filename of the neighbourhoods file
+        '''
+        try:
+            self.df = pd.read_csv (neighbourhoods_filename)
+            self.running.reset ()
+            self.running.update (self.df)
+        except:
+            print ('ERROR: cannot read the neighbourhoods filename ' + neighbourhoods_filename)
+
+        return
+
+    def write_neighbourhoods (self, neighbourhoods_filename):
+        '''
+        method to write the neighbourhood estimates to disk for post analysis
+        '''
+        self.df.to_csv (neighbourhoods_filename, index = False)
+        return
@@ -0,0 +1,192 @@
+# flow rider
+# Copyright 2016 Thomas E. Barchyn
+# Contact: Thomas E. Barchyn [tbarchyn@gmail.com]
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# Please familiarize yourself with the license of this tool, available
+# in the distribution with the filename: /docs/license.txt
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# purpose: when you are riding the flow and you gotta know . . .
+
+# NOTES: this is a 2 state kalman filter on the flow vector (flow_x, flow_y). Each new state is a
+# scalar measurement of the flow along the unit vector perpendicular to the heading,
+# n = (cos(heading), -sin(heading)), as n . flow = n . ground_velocity (see neighbourhoods.py).
+# Intersections (or neighbourhood estimates) can alternatively be used as direct measurements
+# of both components. Intersections are pairs that reuse the same states, so they are not
+# independent: the measurement variance of each is inflated by the number of intersections in its
+# batch that share its busiest state. Every update is O(1) and nothing is stored but the flow and
+# covariance.
+
+from math import *
+import numpy as np
+
+class online_flow:
+    '''
+    this class keeps a recursive (kalman) estimate of the global flow vector and its covariance
+    '''
+    def __init__ (self, params):
+        '''
+        constructor initializes the flow state
+        params = a parameter object
+        '''
+        self.params = params
+        self.reset ()
+        return
+
+    def reset (self):
+        '''
+        method to reset the flow state to the prior (zero flow, large variance)
+        '''
+        self.flow = np.zeros (2)
+        self.P = np.eye (2) * self.params.online_initial_variance
+        self.last_time = None
+        self.n_updates = 0
+        return
+
+    def predict (self, time):
+        '''
+        method to grow the covariance with process noise for the time since the last update, the
+        clock only moves forward, so measurements older than the last update add no process noise
+        time = the time of the new measurement (None skips the prediction)
+        '''
+        if not time is None:
+            if self.last_time is None:
+                self.last_time = time
+            elif time > self.last_time:
+                q = self.params.online_process_noise * (time - self.last_time)
+                self.P[0, 0] = self.P[0, 0] + q
+                self.P[1, 1] = self.P[1, 1] + q
+                self.last_time = time
+        return
+
+    def update_state (self, time, track, velocity, heading):
+        '''
+        method to update the flow estimate with a single state
+        time = time of the state
+        track = the azimuth the vehicle is going over the ground (degrees)
+        velocity = the velocity the vehicle is going over the ground (m/s)
+        heading = the azimuth the vehicle is pointing (degrees)
+        '''
+        self.predict (time)
+
+        # measurement along the unit vector perpendicular to the heading
+        h = np.array ([cos (heading * pi/180.0), -1.0 * sin (heading * pi/180.0)])
+        t = np.array ([velocity * sin (track * pi/180.0), velocity * cos (track * pi/180.0)])
+        innovation = np.dot (h, t) - np.dot (h, self.flow)
+        Ph = np.dot (self.P, h)
+        S = np.dot (h, Ph) + self.params.online_measurement_variance
+
+        # optional innovation gate to ignore gross outliers
+        if not self.params.online_gate is None:
+            if innovation**2.0 / S > self.params.online_gate**2.0:
+                return
+
+        K = Ph / S
+        self.flow = self.flow + K * innovation
+        self.P = self.P - np.outer (K, Ph)
+        self.P = (self.P + self.P.T) / 2.0                  # keep it symmetric
+        self.n_updates = self.n_updates + 1
+        return
+
+    def update_estimate (self, flow_x, flow_y, weight = 1.0, time = None):
+        '''
+        method to update the flow estimate with a direct flow estimate (e.g., an intersection)
+        flow_x = the x component of the flow estimate
+        flow_y = the y component of the flow estimate
+        weight = the weight of the estimate, the measurement variance is scaled by 1/weight
+        time = time of the estimate (optional, used for process noise)
+        '''
+        if not weight > 0.0 or np.isnan (flow_x) or np.isnan (flow_y):
+            return
+        self.predict (time)
+
+        innovation = np.array ([flow_x, flow_y]) - self.flow
+        S = self.P + np.eye (2) * (self.params.online_measurement_variance / weight)
+        S_inv = np.linalg.inv (S)
+
+        if not self.params.online_gate is None:
+            if np.dot (innovation, np.dot (S_inv, innovation)) > self.params.online_gate**2.0:
+                return
+
+        K = np.dot (self.P, S_inv)
+        self.flow = self.flow + np.dot (K, innovation)
+        self.P = self.P - np.dot (K, self.P)
+        self.P = (self.P + self.P.T) / 2.0                  # keep it symmetric
+        self.n_updates = self.n_updates + 1
+        return
+
+    def estimate_times (self, df, states):
+        '''
+        method to look up the time of each estimate from its states, this is the mean time of the
+        pair of states for intersections, or the time of the centre state for neighbourhoods
+        df = rows of an intersections (or neighbourhoods) dataframe
+        states = the states dataframe
+        returns a numpy array of times
+        '''
+        lookup = states.set_index ('id')['time']
+        if 'id1' in df.columns:
+            time_1 = np.array (lookup.loc[np.array (df['id1'], dtype = float)], dtype = float)
+            time_2 = np.array (lookup.loc[np.array (df['id2'], dtype = float)], dtype = float)
+            return ((time_1 + time_2) / 2.0)
+        return (np.array (lookup.loc[np.array (df['id'], dtype = float)], dtype = float))
+
+    def shared_states (self, df):
+        '''
+        method to count how many estimates share the states of each estimate, for intersections this
+        is the number of intersections in df that use id1 or id2 (the larger of the two), so a new
+        state paired with k earlier states counts as about one measurement rather than k
+        df = rows of an intersections (or neighbourhoods) dataframe
+        returns a numpy array of counts (ones for neighbourhoods, which have a single centre state)
+        '''
+        if not 'id1' in df.columns or df.shape[0] == 0:
+            return (np.ones (df.shape[0]))
+        id1 = np.array (df['id1'], dtype = float)
+        id2 = np.array (df['id2'], dtype = float)
+        ids, inverse, counts = np.unique (np.concatenate ((id1, id2)), return_inverse = True, return_counts = True)
+        uses = counts[inverse.ravel ()]
+        return (np.maximum (uses[0:id1.shape[0]], uses[id1.shape[0]:]).astype (float))
+
+    def update_estimates (self, df, states = None):
+        '''
+        method to update the flow estimate with a dataframe of new estimates, these are
+        applied in time order, so the cost is proportional to the new rows only. The pairs of a
+        batch reuse the same states, so each measurement variance is multiplied by the number of
+        estimates sharing its states (see shared_states), rather than treating every pair as an
+        independent measurement, which would make the covariance overconfident
+        df = the new rows of an intersections (or neighbourhoods) dataframe
+        states = the states dataframe (optional, used to time the estimates for process noise)
+        '''
+        flow_x = np.array (df['flow_x'], dtype = float)
+        flow_y = np.array (df['flow_y'], dtype = float)
+        weight = np.array (df['weight'], dtype = float) / self.shared_states (df)
+        if states is None or df.shape[0] == 0:
+            times = [None] * flow_x.shape[0]
+            order = range (0, flow_x.shape[0])
+        else:
+            times = self.estimate_times (df, states)
+            order = np.argsort (times, kind = 'mergesort')
+        for i in order:
+            self.update_estimate (flow_x[i], flow_y[i], weight[i], times[i])
+        return
+
+    def estimate (self):
+        '''
+        method to return the present flow estimate
+        returns: flow_x, flow_y, flow_az, flow_vel
+        '''
+        flow_x = self.flow[0]
+        flow_y = self.flow[1]
+        flow_az = (atan2 (flow_x, flow_y) * 180.0 / pi) % 360.0
+        flow_vel = sqrt (flow_x**2.0 + flow_y**2.0)
+        return (flow_x, flow_y, flow_az, flow_vel)
@@ -37,7 +37,74 @@ class params:
         # default filenames for saving the state
         self.states_filename = 'flow_rider_states.csv'
         self.intersections_filename = 'flow_rider_intersections.csv'
+        self.neighbourhoods_filename = 'flow_rider_neighbourhoods.csv'
+        
+        # flow estimator: 'intersections' (pairwise 2x2 solves) or 'neighbourhoods'
+        # (one weighted least squares fit over all the states near each new state)
+        self.flow_estimator = 'intersections'
+        self.neighbourhood_max_dist = 10.0                      # neighbourhood radius (m)
+        self.neighbourhood_max_timediff = 10000.0               # neighbourhood time window
+        self.neighbourhood_min_states = 3                       # minimum states for a fit
+        self.neighbourhood_min_cond = 0.05                      # minimum heading diversity (0 to 1)
+        self.neighbourhood_huber_k = 1.345                      # huber tuning constant (None for plain
+                                                                # weighted least squares)
+        self.neighbourhood_max_iterations = 10                  # maximum robust reweighting iterations
+        
+        # candidate pairs and fleets of vehicles
+        self.candidate_search_radius = None                     # only pair states within this distance
+                                                                # (m) using a spatial index, this should
+                                                                # be >= the pre_validate max_dist (None
+                                                                # pairs each state with all earlier states)
+        self.intersect_vehicles = 'all'                         # 'all', 'within' (same vehicle only),
+                                                                # or 'across' (different vehicles only)
+        
+        # compact storage: intersections are stored without the state columns that can be recovered
+        # from id1 and id2 (see intersections.expand), with int32 ids, float32 measurements, and
+        # float64 locations, and assimilation rasters are float32
+        self.compact_storage = False
+        
+        # thinning: cap the stored intersections per spatial (and temporal) cell, so storage and
+        # assimilation cost scale with the area covered rather than the time spent there
+        self.thin_max_per_cell = None                           # maximum intersections per cell (None
+                                                                # to keep all intersections)
+        self.thin_cell_size = 1.0                               # spatial cell size (m)
+        self.thin_time_bin = None                               # temporal bin size (None for space only)
+        self.thin_method = 'top'                                # 'top' keeps the highest weights,
+                                                                # 'reservoir' a weighted random sample
+        
+        # running weighted flow stats, kept up to date as estimates are added
+        self.running_stats_bin_size = None                      # spatial bin size (m) for per bin stats
+                                                                # (None for global stats only)
+        
+        # online (recursive kalman) global flow estimate, updated at every add_state call
+        self.online_flow = False                                # turn on the online estimate
+        self.online_flow_source = 'states'                      # 'states' updates from every state,
+                                                                # 'estimates' from every new intersection
+                                                                # (or neighbourhood estimate)
+        self.online_initial_variance = 100.0                    # prior variance of each flow component
+        self.online_measurement_variance = 0.01                 # measurement variance (flow units^2)
+        self.online_process_noise = 0.0                         # variance growth per unit time for
+                                                                # drifting flow (0 is a constant flow)
+        self.online_gate = None                                 # innovation gate in standard deviations
+                                                                # (None to accept all measurements)
 
+        # pre-validation thresholds (see pre_validate)
+        self.max_dist = 10.0                                    # maximum space difference for a pair
+        self.max_timediff = 10000.0                             # maximum time difference for a pair
+        self.min_heading_diff = 10.0                            # minimum heading difference (degrees)
+        
+        # weight model zero points (see calc_weights)
+        self.space_zero = 10.0                                  # this is whatever units space is in
+        self.time_zero = 10000.0                                # this is whatever units time are in
+        self.heading_zero = 80.0                                # this is in distance from 90 degrees
+        
+        # fused intersect, solve, validate, and weight kernel (compiled with numba if it is
+        # installed, with a numpy fallback). This implements the default pre_validate, post_validate
+        # and calc_weights models directly, so leave it off if you customize those methods.
+        self.fused_kernel = False
+        self.use_numba = True                                   # use numba for the fused kernel if
+                                                                # it is available
+        
         self.set_assimilation_bounds_dynamically = True         # set the assimilation bounds every
                                                                 # assimilate call with the dimensions
                                                                 # of the states . . if no prototype
@@ -46,6 +113,35 @@ class params:
         self.default_grid_size = 100                            # default grid size
         self.k_nearest = 100                                    # get k nearest points for assimilations
         self.distance_exponent = 1.0                            # distance weighting = 1/dist^x, this is x
+        self.assimilation_chunk_size = 10000                    # cells per batched neighbour query
+        self.assimilation_method = 'idw'                        # 'idw' (inverse distance weighting) or
+                                                                # 'kriging' (local ordinary kriging)
+        self.kriging_neighbours = 32                            # nearest intersections kriged per cell
+        self.kriging_chunk_size = 2000                          # cells per batched kriging solve
+        self.kriging_variogram_sample = 2000                    # intersections sampled to fit variograms
+        self.kriging_variogram_lags = 15                        # number of variogram lag bins
+        self.kriging_max_lag = None                             # maximum variogram lag (m) (None for half
+                                                                # the extent of the intersections)
+        
+        # assimilation cache, keyed by a fingerprint of the estimates, grid, and assimilation params
+        self.assimilation_cache = False                         # turn on the cache
+        self.assimilation_cache_size = 8                        # number of results kept in memory
+        self.assimilation_cache_folder = None                   # folder for the on disk tier (optional)
+        
+        # local tile server (see tile_server.py)
+        self.tile_server_host = '127.0.0.1'                     # host to serve on
+        self.tile_server_port = 8000                            # port to serve on (0 for any free port)
+        self.tile_size = 256                                    # tile size (pixels)
+        self.tile_cache_size = 512                              # number of rendered tiles kept in memory
+        self.tile_arrow_scale = 1.0                             # arrow length per unit flow velocity (m)
+        
+        # 3D (voxel) assimilations
+        self.default_grid_layers = 10                           # default number of layers
+        self.default_assimilations_vertical_pad = 1.0           # default pad in z outside of states
+        self.vertical_distance_scale = 1.0                      # vertical distances are multiplied by
+                                                                # this in the neighbour search and weights
+                                                                # (> 1 where flow changes faster in z)
+        self.assimilation_3d_format = 'tiff'                    # 'tiff' (multi-band) or 'npz'
         
         # default names for writing assimilation rasters
         self.assimilation_flow_x_mean_name = 'flow_x_mean.tif'
@@ -56,6 +152,11 @@ class params:
         self.assimilation_flow_y_med_name = 'flow_y_med.tif'
         self.assimilation_flow_vel_name = 'flow_vel.tif'
         self.assimilation_flow_az = 'flow_az.tif'
+        self.assimilation_3d_prefix = '3d_'                     # prefix for 3D assimilation filenames
+        
+        # profiling (off by default), records per-stage wall times and pair counts
+        self.profile = False                                    # turn on stage timing and counters
+        self.profile_log_filename = None                        # optional json lines log of each event
 
         return
         
@@ -70,13 +171,9 @@ class params:
         
         this returns a boolean mask which can be applied over the test intersections
         '''
-        max_dist = 10.0
-        max_timediff = 10000.0
-        min_heading_diff = 10.0
-        
-        smask = sdiff < max_dist
-        tmask = tdiff < max_timediff
-        hmask = hdiff > min_heading_diff
+        smask = sdiff < self.max_dist
+        tmask = tdiff < self.max_timediff
+        hmask = hdiff > self.min_heading_diff
         mask = smask & tmask & hmask
         return (mask)
     
@@ -91,24 +188,20 @@ class params:
         this returns a mask which is True where we should keep the intersections
         '''
         
-        # check the vehicle velocities to see if they are reasonable
-        mask = np.array (df['h1_vel']) > 0.0            # get a basic boolean mask
-        mask[:] = False                                 # and . . set it all to false
-        for i in range (0, df.shape[0]):
-            state_1_id = df.loc[i, 'id1']
-            state_2_id = df.loc[i, 'id2']
-            h1_vel = df.loc[i, 'h1_vel']
-            h2_vel = df.loc[i, 'h2_vel']
-            state_1_min_flowspeed = states.loc[states['id'] == state_1_id, states.columns == 'min_flowspeed'].iloc[0, 0]
-            state_1_max_flowspeed = states.loc[states['id'] == state_1_id, states.columns == 'max_flowspeed'].iloc[0, 0]
-            state_2_min_flowspeed = states.loc[states['id'] == state_2_id, states.columns == 'min_flowspeed'].iloc[0, 0]
-            state_2_max_flowspeed = states.loc[states['id'] == state_2_id, states.columns == 'max_flowspeed'].iloc[0, 0]
-            
-            # check to see if this intersection has reasonable estimated speeds
-            if h1_vel > state_1_min_flowspeed and h1_vel < state_1_max_flowspeed:
-                if h2_vel > state_2_min_flowspeed and h2_vel < state_2_max_flowspeed:
-                    mask[i] = True
-                    
+        # look up the realistic flowspeeds of both states in each intersection
+        lookup = states.set_index ('id')
+        id1 = np.array (df['id1'], dtype = float)
+        id2 = np.array (df['id2'], dtype = float)
+        state_1_min_flowspeed = np.array (lookup.loc[id1, 'min_flowspeed'], dtype = float)
+        state_1_max_flowspeed = np.array (lookup.loc[id1, 'max_flowspeed'], dtype = float)
+        state_2_min_flowspeed = np.array (lookup.loc[id2, 'min_flowspeed'], dtype = float)
+        state_2_max_flowspeed = np.array (lookup.loc[id2, 'max_flowspeed'], dtype = float)
+        h1_vel = np.array (df['h1_vel'], dtype = float)
+        h2_vel = np.array (df['h2_vel'], dtype = float)
+        
+        # check to see if the intersections have reasonable estimated speeds
+        mask = ((h1_vel > state_1_min_flowspeed) & (h1_vel < state_1_max_flowspeed) &
+                (h2_vel > state_2_min_flowspeed) & (h2_vel < state_2_max_flowspeed))
         return (mask)
     
     def calc_weights (self, df):
@@ -126,18 +219,15 @@ class params:
         hdiff = np.array (df['hdiff'])
 
         # space diff weight (linear model from 0 to a zero weight, where the weight is set to 0)
-        space_zero = 10.0                # this is whatever units space is in
-        sdiff_weight = 1.0 - (sdiff / space_zero)
+        sdiff_weight = 1.0 - (sdiff / self.space_zero)
         sdiff_weight[sdiff_weight < 0.0] = 0.0
         
         # time diff weight
-        time_zero = 10000.0               # this is whatever units time are in
-        tdiff_weight = 1.0 - (tdiff / time_zero)
+        tdiff_weight = 1.0 - (tdiff / self.time_zero)
         tdiff_weight[tdiff_weight < 0.0] = 0.0
         
         # heading diff weight
-        heading_zero = 80.0               # this is in distance from 90 degrees
-        hdiff_weight = 1.0 - (np.absolute (hdiff - 90.0) / heading_zero)
+        hdiff_weight = 1.0 - (np.absolute (hdiff - 90.0) / self.heading_zero)
         hdiff_weight[hdiff_weight < 0.0] = 0.0
         
         # bring together the weights, then normalize to 3.0 as max possible
@@ -146,5 +236,35 @@ class params:
         weights = sdiff_weight + tdiff_weight + hdiff_weight
         weights = weights / 3.0
         return (weights)
+    
+    def calc_neighbourhood_weights (self, df):
+        '''
+        method to calculate the static weights for each neighbourhood estimate, this is the
+        neighbourhood counterpart of calc_weights.
+        
+        df = the full neighbourhoods dataframe
+        returns a numpy array to slot into the dataframe weights column
+        '''
+        # make local numpy arrays
+        n = np.array (df['n'], dtype = float)
+        cond = np.array (df['cond'], dtype = float)
+        resid_sd = np.array (df['resid_sd'], dtype = float)
+        
+        # number of states weight (linear model up to a full weight)
+        n_full = 20.0
+        n_weight = n / n_full
+        n_weight[n_weight > 1.0] = 1.0
+        
+        # heading diversity weight (cond is already 0 to 1)
+        cond_weight = cond
+        
+        # residual weight (linear model from 0 to a zero weight)
+        resid_zero = 1.0                  # this is in flow velocity units
+        resid_weight = 1.0 - (resid_sd / resid_zero)
+        resid_weight[resid_weight < 0.0] = 0.0
+        
+        weights = n_weight + cond_weight + resid_weight
+        weights = weights / 3.0
+        return (weights)
 
         
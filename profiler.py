@@ -0,0 +1,172 @@
+# flow rider
+# Copyright 2016 Thomas E. Barchyn
+# Contact: Thomas E. Barchyn [tbarchyn@gmail.com]
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# Please familiarize yourself with the license of this tool, available
+# in the distribution with the filename: /docs/license.txt
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# purpose: when you are riding the flow and you gotta know . . .
+
+import time
+import json
+
+class profiler:
+    '''
+    this class records per-stage wall times and counters for the flow rider pipeline. It is
+    off by default, in which case every method returns immediately.
+    '''
+    def __init__ (self, enabled = False, log_filename = None, params = None):
+        '''
+        constructor
+        enabled = boolean to turn on recording
+        log_filename = optional filename to append a json line per event (update, assimilate)
+        params = a parameter object (optional), if supplied params.profile and
+                 params.profile_log_filename are read at every call instead of enabled and
+                 log_filename, so profiling can be turned on and off on a running flow
+        '''
+        self.enabled = enabled
+        self.log_filename = log_filename
+        self.params = params
+        self.reset ()
+        return
+
+    def is_enabled (self):
+        '''
+        method to check if recording is on
+        '''
+        if not self.params is None:
+            return (bool (self.params.profile))
+        return (self.enabled)
+
+    def get_log_filename (self):
+        '''
+        method to return the structured log filename (None for no log)
+        '''
+        if not self.params is None:
+            return (self.params.profile_log_filename)
+        return (self.log_filename)
+
+    def reset (self):
+        '''
+        method to clear all the recorded stats
+        '''
+        self.stage_time = {}                # total wall time per stage (s)
+        self.stage_calls = {}               # number of times each stage was timed
+        self.counters = {}                  # running counters (pairs considered, accepted, etc.)
+        self.event = None                   # the stats for the event presently being recorded
+        return
+
+    def tic (self):
+        '''
+        method to start a stage timer
+        returns a start time to hand back to toc, or None if disabled
+        '''
+        if not self.is_enabled ():
+            return (None)
+        return (time.time ())
+
+    def toc (self, stage, start):
+        '''
+        method to stop a stage timer and record the elapsed time
+        stage = the name of the stage (e.g., 'intersect')
+        start = the start time returned by tic
+        '''
+        if start is None:
+            return
+        elapsed = time.time () - start
+        self.stage_time[stage] = self.stage_time.get (stage, 0.0) + elapsed
+        self.stage_calls[stage] = self.stage_calls.get (stage, 0) + 1
+        if not self.event is None:
+            self.event[stage] = self.event.get (stage, 0.0) + elapsed
+        return
+
+    def count (self, name, n):
+        '''
+        method to add to a counter
+        name = the name of the counter (e.g., 'pairs_considered')
+        n = the number to add
+        '''
+        if not self.is_enabled ():
+            return
+        self.counters[name] = self.counters.get (name, 0) + int (n)
+        if not self.event is None:
+            self.event[name] = self.event.get (name, 0) + int (n)
+        return
+
+    def begin_event (self):
+        '''
+        method to start recording a loggable event
+        '''
+        if not self.is_enabled ():
+            return
+        self.event = {}
+        return
+
+    def end_event (self, name):
+        '''
+        method to finish an event and write it to the structured log (if set)
+        name = the name of the event (e.g., 'update')
+        '''
+        if not self.is_enabled () or self.event is None:
+            self.event = None
+            return
+        self.event['event'] = name
+        self.event['timestamp'] = time.time ()
+        log_filename = self.get_log_filename ()
+        if not log_filename is None:
+            try:
+                with open (log_filename, 'a') as f:
+                    f.write (json.dumps (self.event, sort_keys = True) + '\n')
+            except:
+                print ('ERROR: cannot write to the profile log ' + log_filename)
+        self.event = None
+        return
+
+    def report (self):
+        '''
+        method to return a snapshot of the recorded stats as a dictionary
+        '''
+        stats = {}
+        stats['stage_time'] = dict (self.stage_time)
+        stats['stage_calls'] = dict (self.stage_calls)
+        stats['counters'] = dict (self.counters)
+
+        # derived rates
+        considered = self.counters.get ('pairs_considered', 0)
+        accepted = self.counters.get ('pairs_accepted', 0)
+        if considered > 0:
+            stats['pre_validate_accept_ratio'] = float (accepted) / considered
+        cells = self.counters.get ('assimilation_cells', 0)
+        assimilate_time = self.stage_time.get ('assimilate', 0.0)
+        if assimilate_time > 0.0:
+            stats['assimilation_cells_per_second'] = cells / assimilate_time
+        return (stats)
+
+    def print_state (self):
+        '''
+        utility method to print the recorded stats
+        '''
+        stats = self.report ()
+        print ('profiler state report')
+        for stage in sorted (stats['stage_time']):
+            print (stage + ': ' + str(stats['stage_time'][stage]) + ' s over ' +
+                   str(stats['stage_calls'][stage]) + ' calls')
+        for name in sorted (stats['counters']):
+            print (name + ': ' + str(stats['counters'][name]))
+        if 'pre_validate_accept_ratio' in stats:
+            print ('pre_validate_accept_ratio: ' + str(stats['pre_validate_accept_ratio']))
+        if 'assimilation_cells_per_second' in stats:
+            print ('assimilation_cells_per_second: ' + str(stats['assimilation_cells_per_second']))
+        return
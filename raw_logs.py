@@ -0,0 +1,256 @@
+# flow rider
+# Copyright 2016 Thomas E. Barchyn
+# Contact: Thomas E. Barchyn [tbarchyn@gmail.com]
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# Please familiarize yourself with the license of this tool, available
+# in the distribution with the filename: /docs/license.txt
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# purpose: when you are riding the flow and you gotta know . . .
+
+# NOTES: bulk import of raw GNSS (NMEA RMC, VTG, GGA sentences) and IMU (csv of time and heading) logs
+# into states. Everything is vectorized with numpy and pandas, there are no per fix python loops.
+# Sentences with a checksum that does not match are dropped (sentences without a checksum are
+# kept). Times are seconds since midnight unwrapped over midnight, which are placed on the unix
+# epoch by the RMC dates when there are any (fixes without an RMC, e.g. GGA sent faster than RMC,
+# take the date of the nearest RMC). The IMU times must be in the same convention (or shifted with
+# imu_time_offset). Positions are projected to a local tangent plane (equirectangular) about an
+# origin, which is fine over the few km a vehicle covers in a mission, but use a proper projection
+# for anything larger.
+
+from math import *
+import numpy as np
+import pandas as pd
+
+earth_radius = 6371008.8                    # mean earth radius (m)
+knots_to_ms = 1852.0 / 3600.0               # knots to m/s
+
+def nmea_degrees (value, hemisphere):
+    '''
+    function to convert NMEA ddmm.mmmm coordinates to decimal degrees
+    value = NMEA coordinates (pandas series of strings)
+    hemisphere = N, S, E, or W (pandas series of strings)
+    returns a numpy array of decimal degrees (negative south and west)
+    '''
+    v = pd.to_numeric (value, errors = 'coerce').values
+    degrees = np.floor (v / 100.0)
+    degrees = degrees + (v - degrees * 100.0) / 60.0
+    south_west = np.array (hemisphere.isin (['S', 'W']))
+    degrees[south_west] = -1.0 * degrees[south_west]
+    return (degrees)
+
+def nmea_seconds (value):
+    '''
+    function to convert NMEA hhmmss.ss times to seconds since midnight
+    value = NMEA times (pandas series of strings)
+    returns a numpy array of seconds
+    '''
+    v = pd.to_numeric (value, errors = 'coerce').values
+    hours = np.floor (v / 10000.0)
+    minutes = np.floor ((v - hours * 10000.0) / 100.0)
+    seconds = v - hours * 10000.0 - minutes * 100.0
+    return (hours * 3600.0 + minutes * 60.0 + seconds)
+
+def nmea_checksum_ok (sentences, checksums):
+    '''
+    function to check NMEA checksums, the XOR of the characters between the $ and the *
+    sentences = the sentences from the $ up to the * (pandas series of strings)
+    checksums = the two hex digits after the * (pandas series of strings, nan if there is no *)
+    returns a boolean numpy array, True if the checksum matches or there is no checksum
+    '''
+    bodies = sentences.str.slice (1)
+    lengths = np.array (bodies.str.len (), dtype = np.int64)
+    data = np.frombuffer (''.join (bodies).encode ('ascii', 'replace'), dtype = np.uint8)
+    computed = np.zeros (lengths.shape[0], dtype = np.int64)
+    full = lengths > 0
+    if np.any (full):
+        starts = np.concatenate (([0], np.cumsum (lengths)[:-1]))
+        computed[full] = np.bitwise_xor.reduceat (data, starts[full])
+
+    present = np.array (checksums.notnull ())
+    digits = checksums.fillna ('00').str.upper ()
+    valid = np.array (digits.str.match ('^[0-9A-F]{2}$'))
+    digits = digits.where (valid, '00')
+    codes = np.frombuffer (''.join (digits).encode ('ascii'), dtype = np.uint8).reshape ((-1, 2)).astype (np.int64)
+    codes = np.where (codes <= ord ('9'), codes - ord ('0'), codes - ord ('A') + 10)
+    expected = codes[:, 0] * 16 + codes[:, 1]
+    return (~present | (valid & (computed == expected)))
+
+def read_nmea (nmea_filename):
+    '''
+    function to parse RMC, VTG, and GGA sentences from an NMEA log (any talker id, e.g. GP, GN)
+    nmea_filename = the NMEA log filename
+    returns a dataframe of fixes with columns time, lat, lon, alt, track, velocity (m/s)
+    '''
+    with open (nmea_filename, 'r') as f:
+        lines = pd.Series (f.read ().splitlines ())
+
+    # strip everything before the $, and drop sentences with a bad checksum
+    parts = lines.str.extract ('(\\$[^*]*)(?:\\*(\\S*))?', expand = True).dropna (subset = [0])
+    lines = parts[0][nmea_checksum_ok (parts[0], parts[1])]
+    sentence = lines.str.slice (3, 6)
+    lines = lines[sentence.isin (['RMC', 'VTG', 'GGA'])]
+    sentence = sentence[lines.index]
+    fields = lines.str.split (',', expand = True)
+    fields = fields.reindex (columns = range (0, 13))
+
+    # VTG sentences have no time, they belong to the timed sentence before them in the epoch
+    line_seconds = pd.Series (np.nan, index = lines.index)
+    timed = sentence.isin (['RMC', 'GGA'])
+    line_seconds[timed] = nmea_seconds (fields.loc[timed, 1])
+    line_seconds = line_seconds.ffill ()
+
+    # RMC: time, status, lat, N/S, lon, E/W, speed (knots), track, date
+    rmc = fields[(sentence == 'RMC') & (fields[2] == 'A')]
+    rmc = pd.DataFrame ({'seconds': np.array (line_seconds[rmc.index]),
+                         'lat': nmea_degrees (rmc[3], rmc[4]),
+                         'lon': nmea_degrees (rmc[5], rmc[6]),
+                         'velocity': pd.to_numeric (rmc[7], errors = 'coerce').values * knots_to_ms,
+                         'track': pd.to_numeric (rmc[8], errors = 'coerce').values,
+                         'date': np.array (rmc[9])})
+
+    # GGA: time, lat, N/S, lon, E/W, fix quality, satellites, hdop, altitude
+    gga = fields[(sentence == 'GGA') & (pd.to_numeric (fields[6], errors = 'coerce') > 0)]
+    gga = pd.DataFrame ({'seconds': np.array (line_seconds[gga.index]),
+                         'gga_lat': nmea_degrees (gga[2], gga[3]),
+                         'gga_lon': nmea_degrees (gga[4], gga[5]),
+                         'alt': pd.to_numeric (gga[9], errors = 'coerce').values})
+
+    # VTG: track (true), T, track (magnetic), M, speed (knots), N, speed (km/h), K
+    vtg = fields[sentence == 'VTG']
+    vtg = pd.DataFrame ({'seconds': np.array (line_seconds[vtg.index]),
+                         'vtg_track': pd.to_numeric (vtg[1], errors = 'coerce').values,
+                         'vtg_velocity': pd.to_numeric (vtg[7], errors = 'coerce').values / 3.6})
+
+    # bring the sentences of each epoch together
+    rmc = rmc.dropna (subset = ['seconds']).drop_duplicates ('seconds')
+    gga = gga.dropna (subset = ['seconds']).drop_duplicates ('seconds')
+    vtg = vtg.dropna (subset = ['seconds']).drop_duplicates ('seconds')
+    fixes = pd.merge (rmc, gga, on = 'seconds', how = 'outer')
+    fixes = pd.merge (fixes, vtg, on = 'seconds', how = 'left')
+    fixes['lat'] = fixes['lat'].fillna (fixes['gga_lat'])
+    fixes['lon'] = fixes['lon'].fillna (fixes['gga_lon'])
+    fixes['track'] = fixes['track'].fillna (fixes['vtg_track'])
+    fixes['velocity'] = fixes['velocity'].fillna (fixes['vtg_velocity'])
+
+    # back to the log order (the merge sorts by seconds), then make times monotonic
+    order = line_seconds[timed].drop_duplicates ()
+    order = pd.Series (np.arange (0, order.shape[0]), index = np.array (order))
+    fixes['order'] = np.array (order[np.array (fixes['seconds'])])
+    fixes = fixes.sort_values ('order', kind = 'mergesort').reset_index (drop = True)
+    fixes = fixes.dropna (subset = ['lat', 'lon', 'track', 'velocity'])
+
+    # unwrap times over midnight, then place them on the epoch with the dates of the RMC fixes
+    seconds = np.array (fixes['seconds'], dtype = float)
+    days = np.concatenate (([0.0], np.cumsum (np.diff (seconds) < -43200.0)))
+    fixes['time'] = seconds + days * 86400.0
+    dates = pd.to_datetime (fixes['date'], format = '%d%m%y', errors = 'coerce')
+    if dates.notnull ().any ():
+        epoch = (dates - pd.Timestamp ('1970-01-01')) / pd.Timedelta (seconds = 1)
+        offset = pd.Series (np.array (epoch, dtype = float) - days * 86400.0).ffill ().bfill ()
+        fixes['time'] = np.array (fixes['time'], dtype = float) + np.array (offset)
+        fixes = fixes.sort_values ('time', kind = 'mergesort')
+
+    fixes = fixes.loc[:, ['time', 'lat', 'lon', 'alt', 'track', 'velocity']]
+    fixes['alt'] = fixes['alt'].fillna (0.0)
+    return (fixes.reset_index (drop = True))
+
+def read_imu (imu_filename, time_column = 'time', heading_column = 'heading'):
+    '''
+    function to read a simple IMU csv log of time and heading
+    imu_filename = the IMU csv filename
+    time_column = the name of the time column
+    heading_column = the name of the heading column (compass azimuth, degrees)
+    returns a dataframe with columns time, heading sorted by time
+    '''
+    imu = pd.read_csv (imu_filename, usecols = [time_column, heading_column])
+    imu.columns = ['time', 'heading']
+    imu = imu.dropna ().sort_values ('time', kind = 'mergesort').reset_index (drop = True)
+    return (imu)
+
+def interpolate_heading (imu_time, imu_heading, time):
+    '''
+    function to interpolate headings onto new times, handling the 0/360 wraparound
+    imu_time = IMU times (numpy array, sorted)
+    imu_heading = IMU headings (degrees, numpy array)
+    time = the times to interpolate onto (numpy array)
+    returns headings (degrees, 0 to 360), nan outside the IMU times
+    '''
+    unwrapped = np.unwrap (np.array (imu_heading, dtype = float) * pi / 180.0)
+    heading = np.interp (time, imu_time, unwrapped, left = np.nan, right = np.nan)
+    return ((heading * 180.0 / pi) % 360.0)
+
+def project (lat, lon, lat0 = None, lon0 = None):
+    '''
+    function to project lat/lon onto a local tangent plane (m)
+    lat = latitudes (degrees, numpy array)
+    lon = longitudes (degrees, numpy array)
+    lat0 = origin latitude (optional, defaults to the first fix)
+    lon0 = origin longitude (optional, defaults to the first fix)
+    returns x, y, lat0, lon0
+    '''
+    if lat0 is None:
+        lat0 = lat[0]
+    if lon0 is None:
+        lon0 = lon[0]
+    x = earth_radius * cos (lat0 * pi / 180.0) * (lon - lon0) * pi / 180.0
+    y = earth_radius * (lat - lat0) * pi / 180.0
+    return (x, y, lat0, lon0)
+
+def raw_to_states (fixes, imu, imu_time_offset = 0.0, min_velocity = 0.0, lat0 = None, lon0 = None,
+                   min_flowspeed = 0.0, max_flowspeed = 100.0):
+    '''
+    function to derive a block of states from GNSS fixes and IMU headings
+    fixes = a dataframe from read_nmea
+    imu = a dataframe from read_imu
+    imu_time_offset = seconds to add to the IMU times to align them with the GNSS times
+    min_velocity = drop fixes slower than this (m/s), the track is unreliable when stationary
+    lat0 = origin latitude of the local frame (optional, defaults to the first fix)
+    lon0 = origin longitude of the local frame (optional, defaults to the first fix)
+    min_flowspeed = the minimum flow speed that is realistic (m/s)
+    max_flowspeed = the maximum flow speed that is realistic (m/s)
+    returns a states block (see states.add_states), and the origin lat0, lon0
+    '''
+    time = np.array (fixes['time'], dtype = float)
+    heading = interpolate_heading (np.array (imu['time'], dtype = float) + imu_time_offset,
+                                   np.array (imu['heading'], dtype = float), time)
+    x, y, lat0, lon0 = project (np.array (fixes['lat'], dtype = float), np.array (fixes['lon'], dtype = float),
+                                lat0, lon0)
+
+    block = pd.DataFrame ({'x': x, 'y': y, 'z': np.array (fixes['alt'], dtype = float), 'time': time,
+                           'track': np.array (fixes['track'], dtype = float) % 360.0,
+                           'velocity': np.array (fixes['velocity'], dtype = float),
+                           'heading': heading})
+    block['min_flowspeed'] = min_flowspeed
+    block['max_flowspeed'] = max_flowspeed
+    keep = ~np.isnan (heading) & (np.array (block['velocity']) >= min_velocity)
+    return (block[keep].reset_index (drop = True), lat0, lon0)
+
+def import_raw_logs (states, nmea_filename, imu_filename, imu_time_offset = 0.0, min_velocity = 0.0,
+                     lat0 = None, lon0 = None, min_flowspeed = 0.0, max_flowspeed = 100.0):
+    '''
+    function to parse NMEA and IMU logs and load the derived states into a states object in one block
+    states = the states object (e.g., myflow.states)
+    nmea_filename = the NMEA log filename
+    imu_filename = the IMU csv filename (columns time and heading)
+    see raw_to_states for the other arguments
+    returns the origin lat0, lon0 of the local frame
+    '''
+    fixes = read_nmea (nmea_filename)
+    imu = read_imu (imu_filename)
+    block, lat0, lon0 = raw_to_states (fixes, imu, imu_time_offset = imu_time_offset,
+                                       min_velocity = min_velocity, lat0 = lat0, lon0 = lon0,
+                                       min_flowspeed = min_flowspeed, max_flowspeed = max_flowspeed)
+    states.add_states (block)
+    return (lat0, lon0)
@@ -0,0 +1,173 @@
+# flow rider
+# Copyright 2016 Thomas E. Barchyn
+# Contact: Thomas E. Barchyn [tbarchyn@gmail.com]
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# Please familiarize yourself with the license of this tool, available
+# in the distribution with the filename: /docs/license.txt
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# purpose: when you are riding the flow and you gotta know . . .
+
+# NOTES: weighted means and variances are merged batch by batch with the parallel (chan et al.)
+# update, so the stats never need the full intersections dataframe. Each accumulator is a list:
+# [count, sum of weights, mean flow_x, mean flow_y, M2 flow_x, M2 flow_y], where M2 is the
+# weighted sum of squared deviations from the mean.
+
+from math import *
+import numpy as np
+import pandas as pd
+
+class running_stats:
+    '''
+    this class keeps weighted running flow statistics, globally and (optionally) per spatial bin
+    '''
+    def __init__ (self, params, bin_size = None):
+        '''
+        constructor initializes empty accumulators
+        params = a parameter object
+        bin_size = spatial bin size (m) (optional, defaults to params.running_stats_bin_size)
+        '''
+        self.params = params
+        self.bin_size = bin_size
+        self.reset ()
+        return
+
+    def reset (self):
+        '''
+        method to clear all the accumulators
+        '''
+        self.total = [0, 0.0, 0.0, 0.0, 0.0, 0.0]
+        self.bins = {}                                  # (column, row) bin index -> accumulator
+        return
+
+    def merge (self, acc, n, w, mean_x, mean_y, m2_x, m2_y):
+        '''
+        method to merge batch stats into an accumulator (in place)
+        acc = the accumulator list
+        n = the batch count
+        w = the batch sum of weights
+        mean_x, mean_y = the batch weighted means
+        m2_x, m2_y = the batch weighted sums of squared deviations
+        '''
+        total_w = acc[1] + w
+        if not total_w > 0.0:
+            return
+        delta_x = mean_x - acc[2]
+        delta_y = mean_y - acc[3]
+        acc[0] = acc[0] + n
+        acc[2] = acc[2] + delta_x * w / total_w
+        acc[3] = acc[3] + delta_y * w / total_w
+        acc[4] = acc[4] + m2_x + delta_x**2.0 * acc[1] * w / total_w
+        acc[5] = acc[5] + m2_y + delta_y**2.0 * acc[1] * w / total_w
+        acc[1] = total_w
+        return
+
+    def get_bin_size (self):
+        '''
+        method to return the spatial bin size (None if there are no per bin stats)
+        '''
+        if self.bin_size is None:
+            return (self.params.running_stats_bin_size)
+        return (self.bin_size)
+
+    def bin_index (self, x, y):
+        '''
+        method to get the spatial bin indices of locations
+        x = x locations (numpy array)
+        y = y locations (numpy array)
+        returns column and row bin indices as integer numpy arrays
+        '''
+        size = self.get_bin_size ()
+        return (np.floor (x / size).astype (int), np.floor (y / size).astype (int))
+
+    def update (self, df):
+        '''
+        method to add new flow estimates to the stats, the cost is proportional to the new rows
+        df = the new rows of an intersections (or neighbourhoods) dataframe
+        '''
+        flow_x = np.array (df['flow_x'], dtype = float)
+        flow_y = np.array (df['flow_y'], dtype = float)
+        weight = np.array (df['weight'], dtype = float)
+        keep = ~(np.isnan (flow_x) | np.isnan (flow_y) | np.isnan (weight)) & (weight > 0.0)
+        if not np.any (keep):
+            return
+        flow_x = flow_x[keep]
+        flow_y = flow_y[keep]
+        weight = weight[keep]
+
+        # global batch stats
+        w = np.sum (weight)
+        mean_x = np.sum (weight * flow_x) / w
+        mean_y = np.sum (weight * flow_y) / w
+        m2_x = np.sum (weight * (flow_x - mean_x)**2.0)
+        m2_y = np.sum (weight * (flow_y - mean_y)**2.0)
+        self.merge (self.total, flow_x.shape[0], w, mean_x, mean_y, m2_x, m2_y)
+
+        # per bin batch stats
+        if not self.get_bin_size () is None:
+            col, row = self.bin_index (np.array (df['x'], dtype = float)[keep],
+                                       np.array (df['y'], dtype = float)[keep])
+            batch = pd.DataFrame ({'col': col, 'row': row, 'w': weight,
+                                   'wx': weight * flow_x, 'wy': weight * flow_y})
+            groups = batch.groupby (['col', 'row'])
+            sums = groups[['w', 'wx', 'wy']].sum ()
+            counts = groups.size ()
+            means_x = sums['wx'] / sums['w']
+            means_y = sums['wy'] / sums['w']
+
+            # deviations from the batch bin means
+            keys = pd.MultiIndex.from_arrays ((col, row))
+            batch['m2x'] = weight * (flow_x - np.array (means_x.reindex (keys)))**2.0
+            batch['m2y'] = weight * (flow_y - np.array (means_y.reindex (keys)))**2.0
+            m2 = batch.groupby (['col', 'row'])[['m2x', 'm2y']].sum ()
+
+            for key in sums.index:
+                if not key in self.bins:
+                    self.bins[key] = [0, 0.0, 0.0, 0.0, 0.0, 0.0]
+                self.merge (self.bins[key], counts[key], sums.loc[key, 'w'], means_x[key], means_y[key],
+                            m2.loc[key, 'm2x'], m2.loc[key, 'm2y'])
+        return
+
+    def describe (self, acc):
+        '''
+        method to turn an accumulator into a stats dictionary
+        acc = the accumulator list
+        '''
+        stats = {'count': acc[0], 'weight': acc[1], 'flow_x_mean': np.nan, 'flow_y_mean': np.nan,
+                 'flow_x_var': np.nan, 'flow_y_var': np.nan, 'flow_az': np.nan, 'flow_vel': np.nan}
+        if acc[1] > 0.0:
+            stats['flow_x_mean'] = acc[2]
+            stats['flow_y_mean'] = acc[3]
+            stats['flow_x_var'] = acc[4] / acc[1]
+            stats['flow_y_var'] = acc[5] / acc[1]
+            stats['flow_az'] = (atan2 (acc[2], acc[3]) * 180.0 / pi) % 360.0
+            stats['flow_vel'] = sqrt (acc[2]**2.0 + acc[3]**2.0)
+        return (stats)
+
+    def stats (self, x = None, y = None):
+        '''
+        method to return the running flow stats, this is O(1)
+        x = x location (optional, if x and y are supplied the stats for that spatial bin are returned)
+        y = y location (optional)
+        returns a dictionary with count, weight, flow_x_mean, flow_y_mean, flow_x_var, flow_y_var,
+        flow_az, flow_vel
+        '''
+        if x is None or y is None:
+            return (self.describe (self.total))
+        if self.get_bin_size () is None:
+            print ('ERROR: there is no bin size set, there are no per bin stats')
+            return (self.describe ([0, 0.0, 0.0, 0.0, 0.0, 0.0]))
+        col, row = self.bin_index (np.array ([x], dtype = float), np.array ([y], dtype = float))
+        acc = self.bins.get ((col[0], row[0]), [0, 0.0, 0.0, 0.0, 0.0, 0.0])
+        return (self.describe (acc))
@@ -0,0 +1,117 @@
+# flow rider
+# Copyright 2016 Thomas E. Barchyn
+# Contact: Thomas E. Barchyn [tbarchyn@gmail.com]
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# Please familiarize yourself with the license of this tool, available
+# in the distribution with the filename: /docs/license.txt
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# purpose: when you are riding the flow and you gotta know . . .
+
+# NOTES: a uniform grid over x and y with cells the size of the search radius, holding the row
+# positions of the states in each cell. The states dataframe only grows, so sync only indexes the
+# rows added since the last call and the cost of keeping the index up to date is proportional to
+# the new states (amortized, not O(N log N) per update like rebuilding a tree). A query gathers the 3 x 3
+# block of cells around a point and keeps the positions within the radius (in x, y, and z).
+
+import numpy as np
+
+class candidate_index:
+    '''
+    this class is an incrementally updated spatial index of the states for candidate pair searches
+    '''
+    def __init__ (self):
+        '''
+        constructor initializes an empty index
+        '''
+        self.reset (None)
+        return
+
+    def reset (self, cell_size):
+        '''
+        method to empty the index
+        cell_size = the grid cell size (the search radius)
+        '''
+        self.cell_size = cell_size
+        self.cells = {}                                 # (col, row) -> list of state positions
+        self.n = 0                                      # number of states indexed
+        self.last = None                                # (id, x, y) of the last state indexed
+        self.xyz = np.zeros ((1024, 3))                 # indexed locations, grown by doubling
+        return
+
+    def sync (self, full_states, radius):
+        '''
+        method to bring the index up to date with the states, only new rows are indexed unless the
+        states were replaced (e.g., read from disk) or the radius changed
+        full_states = the full states dataframe
+        radius = the search radius
+        '''
+        n = full_states.shape[0]
+        if (not radius == self.cell_size or n < self.n or
+            (self.n > 0 and not self.row_key (full_states, self.n - 1) == self.last)):
+            self.reset (radius)
+        if n == self.n:
+            return
+
+        x = np.array (full_states['x'].iloc[self.n:], dtype = float)
+        y = np.array (full_states['y'].iloc[self.n:], dtype = float)
+        z = np.array (full_states['z'].iloc[self.n:], dtype = float)
+        cols = np.floor (x / self.cell_size).astype (np.int64)
+        rows = np.floor (y / self.cell_size).astype (np.int64)
+        for k in range (0, x.shape[0]):
+            key = (cols[k], rows[k])
+            if not key in self.cells:
+                self.cells[key] = []
+            self.cells[key].append (self.n + k)
+
+        if n > self.xyz.shape[0]:
+            grown = np.zeros ((max (n, 2 * self.xyz.shape[0]), 3))
+            grown[:self.n, :] = self.xyz[:self.n, :]
+            self.xyz = grown
+        self.xyz[self.n:n, 0] = x
+        self.xyz[self.n:n, 1] = y
+        self.xyz[self.n:n, 2] = z
+        self.n = n
+        self.last = self.row_key (full_states, n - 1)
+        return
+
+    def row_key (self, full_states, position):
+        '''
+        method to identify a states row, to check the indexed states have not been replaced
+        full_states = the full states dataframe
+        position = the row position
+        returns a tuple of the id, x, and y
+        '''
+        row = full_states.iloc[position]
+        return ((float (row['id']), float (row['x']), float (row['y'])))
+
+    def query (self, x, y, z, before):
+        '''
+        method to find the states within the search radius of a point
+        x, y, z = the point
+        before = only return positions less than this (the earlier states)
+        returns a sorted numpy array of state positions
+        '''
+        col = int (np.floor (x / self.cell_size))
+        row = int (np.floor (y / self.cell_size))
+        found = []
+        for c in (col - 1, col, col + 1):
+            for r in (row - 1, row, row + 1):
+                if (c, r) in self.cells:
+                    found.extend (self.cells[(c, r)])
+        positions = np.array (found, dtype = np.int64)
+        positions = positions[positions < before]
+        near = self.xyz[positions]
+        d2 = (near[:, 0] - x)**2.0 + (near[:, 1] - y)**2.0 + (near[:, 2] - z)**2.0
+        return (np.sort (positions[d2 <= self.cell_size**2.0]))
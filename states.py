@@ -34,13 +34,13 @@ class states:
         '''
         self.frame = 0                     # a running id for state adds
         self.columns = ('id', 'x', 'y', 'z', 'time', 'track', 'velocity', 'heading', 'min_flowspeed',
-                        'max_flowspeed', 'done')
+                        'max_flowspeed', 'done', 'vehicle', 'tx', 'ty', 'hx', 'hy')
         self.df = pd.DataFrame (columns = self.columns)
         
         self.start_time = datetime.datetime.now ()
         return
     
-    def add_state (self, x, y, z, time, track, velocity, heading, min_flowspeed, max_flowspeed):
+    def add_state (self, x, y, z, time, track, velocity, heading, min_flowspeed, max_flowspeed, vehicle = 0):
         '''
         add a state to the state dataframe
         
@@ -53,10 +53,14 @@ class states:
         heading = the azimuth the vehicle is pointing (degrees)
         min_flowspeed = the minimum flow speed that is realistic (m/s)
         max_flowspeed = the maximum flow speed that is realistic (m/s)
+        vehicle = the vehicle id, for fleets of vehicles (defaults to 0)
         
         Note: 'done' is a column to log if it has been intersected, this is set to 0.0 (not done),
               or to 1.0 (done). Pandas dataframes are not capable enough to reliably handle a boolean
               column.
+        
+        Note: 'tx', 'ty' (ground velocity vector) and 'hx', 'hy' (heading unit vector) are computed
+              here once, so the intersection solves do not need any trig.
         '''
         frame = self.frame
         self.frame = self.frame + 1
@@ -67,10 +71,70 @@ class states:
             time = time_diff.seconds + (1e-6 * time_diff.microseconds)
 
         add = pd.Series ((frame, x, y, z, time, track, velocity, heading, min_flowspeed,
-                          max_flowspeed, 0.0), index = self.columns)
+                          max_flowspeed, 0.0, vehicle,
+                          velocity * sin (track * pi/180.0), velocity * cos (track * pi/180.0),
+                          sin (heading * pi/180.0), cos (heading * pi/180.0)), index = self.columns)
         self.df = self.df.append (add, ignore_index = True)
         return
     
+    def add_states (self, block):
+        '''
+        add a block of states to the state dataframe in one append, ids are assigned in the
+        order of the block
+        
+        block = a dataframe with columns x, y, z, time, track, velocity, heading, min_flowspeed,
+                max_flowspeed and (optionally) vehicle. If time is missing or nan, the time
+                since init is used.
+        '''
+        n = block.shape[0]
+        if n == 0:
+            return
+        add = pd.DataFrame (index = np.arange (0, n))
+        add['id'] = np.arange (self.frame, self.frame + n)
+        self.frame = self.frame + n
+        for column in ('x', 'y', 'z', 'track', 'velocity', 'heading', 'min_flowspeed', 'max_flowspeed'):
+            add[column] = np.array (block[column], dtype = float)
+        
+        # record time difference if unsupplied
+        time_diff = datetime.datetime.now () - self.start_time
+        now = time_diff.seconds + (1e-6 * time_diff.microseconds)
+        if 'time' in block.columns:
+            add['time'] = np.array (block['time'], dtype = float)
+            add.loc[np.isnan (add['time']), 'time'] = now
+        else:
+            add['time'] = now
+        
+        add['done'] = 0.0
+        if 'vehicle' in block.columns:
+            add['vehicle'] = np.array (block['vehicle'])
+        else:
+            add['vehicle'] = 0
+        
+        add = self.calc_vectors (add)
+        add = add.loc[:, list (self.columns)]
+        if self.df.shape[0] == 0:
+            self.df = add.reset_index (drop = True)     # keep numeric dtypes (appending to the empty
+                                                        # frame makes object columns)
+        else:
+            self.df = self.df.append (add, ignore_index = True)
+        return
+    
+    def calc_vectors (self, df):
+        '''
+        method to calculate the ground velocity vector (tx, ty) and heading unit vector (hx, hy)
+        columns of a states dataframe
+        df = a states dataframe
+        returns the dataframe with the vector columns
+        '''
+        track = np.array (df['track'], dtype = float) * pi / 180.0
+        velocity = np.array (df['velocity'], dtype = float)
+        heading = np.array (df['heading'], dtype = float) * pi / 180.0
+        df['tx'] = velocity * np.sin (track)
+        df['ty'] = velocity * np.cos (track)
+        df['hx'] = np.sin (heading)
+        df['hy'] = np.cos (heading)
+        return (df)
+    
     def done_all_callback (self):
         '''
         callback method to set all the done flags to 'done', this is called by intersection code
@@ -92,6 +156,11 @@ class states:
                 print ('adding min and max flowspeed for compatibility with old states dataframes')
                 self.df['min_flowspeed'] = self.params.min_flowspeed_default
                 self.df['max_flowspeed'] = self.params.max_flowspeed_default
+            if not 'vehicle' in self.df.columns:
+                self.df['vehicle'] = 0                      # single vehicle states dataframes
+            if self.df.shape[0] > 0:
+                self.frame = int (self.df['id'].max ()) + 1 # keep new ids unique
+            self.df = self.calc_vectors (self.df)
         
         except:
             print ('ERROR: cannot read the states filename ' + states_filename)
@@ -0,0 +1,262 @@
+# flow rider
+# Copyright 2016 Thomas E. Barchyn
+# Contact: Thomas E. Barchyn [tbarchyn@gmail.com]
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# Please familiarize yourself with the license of this tool, available
+# in the distribution with the filename: /docs/license.txt
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# parameter sweeps and cross-validation
+#
+# usage: python sweep.py
+#
+# the states are intersected and solved once with the widest pre-validation thresholds in the sweep.
+# Each parameter set is then just a mask (params.pre_validate and params.post_validate) and a
+# re-weighting (params.calc_weights) of those candidate intersections, followed by a batched
+# inverse distance weighted assimilation (assimilations.idw_query, the same estimator that
+# flow.assimilate uses for the maps), so no pairs are re-solved.
+# Parameter sets are scored against a known flow field (synthetic ground truth), or with spatial
+# block cross-validation: the candidate intersections are split into square blocks and the blocks
+# are dealt into folds. For each fold, a parameter set's intersections outside the fold predict
+# all the candidate intersections in the fold. The targets (and their weights, from the base
+# params) are the same for every parameter set, so a strict set cannot score well just by
+# throwing out hard test points. Parameter sets run in parallel processes.
+
+import copy
+import itertools
+import multiprocessing
+import numpy as np
+import pandas as pd
+from scipy.spatial import cKDTree as KDTree
+
+from params import *
+from states import *
+from intersections import *
+from assimilations import *
+from synthetic import *
+
+# the sweep data, set in each worker process by init_worker
+sweep_data = {}
+
+def param_grid (grid):
+    '''
+    function to expand a grid of parameter values into a list of parameter sets
+    grid = dictionary of param name -> list of values
+    returns a list of dictionaries of param name -> value
+    '''
+    names = sorted (grid.keys ())
+    return ([dict (zip (names, values)) for values in itertools.product (*[grid[name] for name in names])])
+
+def candidates (states_df, base_params, param_sets):
+    '''
+    function to intersect and solve the states once with the widest pre-validation thresholds
+    in the parameter sets
+    states_df = a states dataframe
+    base_params = the parameter object the sets are applied to
+    param_sets = list of dictionaries of param name -> value
+    returns a full (not compact, not thinned) intersections dataframe
+    '''
+    wide = copy.deepcopy (base_params)
+    wide.max_dist = max ([s.get ('max_dist', base_params.max_dist) for s in param_sets])
+    wide.max_timediff = max ([s.get ('max_timediff', base_params.max_timediff) for s in param_sets])
+    wide.min_heading_diff = min ([s.get ('min_heading_diff', base_params.min_heading_diff) for s in param_sets])
+    wide.compact_storage = False
+    wide.thin_max_per_cell = None
+    if not wide.candidate_search_radius is None:
+        wide.candidate_search_radius = max (wide.candidate_search_radius, wide.max_dist)
+
+    s = states ()
+    s.df = states_df.copy ()
+    s.df['done'] = 0.0
+    i = intersections (wide, s.done_all_callback)
+    i.update (s.df)
+    return (i.df.reset_index (drop = True))
+
+def score_truth (flow_x, flow_y, weight, locs, a, field, points):
+    '''
+    function to score an assimilation against a known flow field
+    flow_x, flow_y, weight = the intersection flows and weights (numpy arrays)
+    locs = the intersection locations [n, 2]
+    a = an assimilations object with the parameter set
+    field = flow field function of (x, y)
+    points = the points to score at [n, 2]
+    returns the root mean squared vector error (nan if nothing could be estimated)
+    '''
+    tree = KDTree (locs, leafsize = 10)
+    mean_x, mean_y, sd_x, sd_y, med_x, med_y = a.idw_query (tree, flow_x, flow_y, weight, points)
+    true_x, true_y = field (points[:, 0], points[:, 1])
+    error = (mean_x - true_x)**2.0 + (mean_y - true_y)**2.0
+    if np.all (np.isnan (error)):
+        return (np.nan)
+    return (np.sqrt (np.nanmean (error)))
+
+def block_folds (locs, folds, block_size, seed):
+    '''
+    function to deal square blocks of locations into cross-validation folds
+    locs = the locations [n, 2]
+    folds = number of folds
+    block_size = the size of the square blocks (m)
+    seed = random seed for dealing the blocks into folds
+    returns the fold of each location (int numpy array)
+    '''
+    blocks = np.floor (locs / block_size).astype (np.int64)
+    keys, block = np.unique (blocks, axis = 0, return_inverse = True)
+    fold = np.random.RandomState (seed).permutation (keys.shape[0]) % folds
+    return (fold[block.ravel ()])
+
+def score_cv (flow_x, flow_y, weight, locs, fold, a, targets, folds):
+    '''
+    function to score a parameter set with spatial block cross-validation against fixed targets
+    flow_x, flow_y, weight = the intersection flows and weights of the parameter set (numpy arrays)
+    locs = the intersection locations [n, 2]
+    fold = the fold of each intersection (int numpy array)
+    a = an assimilations object with the parameter set
+    targets = dictionary of the held out targets, with flow_x, flow_y, weight, locs, and fold
+    folds = number of folds
+    returns the weighted root mean squared vector error over the targets
+    '''
+    total = 0.0
+    total_weight = 0.0
+    for k in range (0, folds):
+        train = fold != k
+        test = targets['fold'] == k
+        if not np.any (test) or not np.any (train):
+            continue
+        tree = KDTree (locs[train], leafsize = 10)
+        mean_x, mean_y, sd_x, sd_y, med_x, med_y = a.idw_query (tree, flow_x[train], flow_y[train],
+                                                                weight[train], targets['locs'][test])
+        error = (mean_x - targets['flow_x'][test])**2.0 + (mean_y - targets['flow_y'][test])**2.0
+        target_weight = targets['weight'][test]
+        ok = ~np.isnan (error) & ~np.isnan (target_weight)
+        total = total + np.sum (target_weight[ok] * error[ok])
+        total_weight = total_weight + np.sum (target_weight[ok])
+    if not total_weight > 0.0:
+        return (np.nan)
+    return (np.sqrt (total / total_weight))
+
+def init_worker (data):
+    '''
+    function to set the sweep data in a worker process
+    data = dictionary of the sweep data (see run_sweep)
+    '''
+    sweep_data.clear ()
+    sweep_data.update (data)
+    return
+
+def evaluate (param_set):
+    '''
+    function to evaluate one parameter set against the sweep data (see run_sweep)
+    param_set = dictionary of param name -> value
+    returns a dictionary with the parameter set, the number of intersections, and the score
+    '''
+    p = copy.deepcopy (sweep_data['params'])
+    for name in param_set:
+        setattr (p, name, param_set[name])
+    df = sweep_data['candidates']
+    states_df = sweep_data['states']
+
+    # mask and re-weight the candidate intersections
+    result = dict (param_set)
+    mask = p.pre_validate (np.array (df['sdiff'], dtype = float), np.array (df['tdiff'], dtype = float),
+                           np.array (df['hdiff'], dtype = float))
+    df = df[mask]
+    if df.shape[0] > 0:
+        df = df[p.post_validate (df, states_df)]
+    result['intersections'] = df.shape[0]
+    if df.shape[0] == 0:
+        result['score'] = np.nan
+        return (result)
+    weight = np.array (p.calc_weights (df), dtype = float)
+    flow_x = np.array (df['flow_x'], dtype = float)
+    flow_y = np.array (df['flow_y'], dtype = float)
+    locs = np.column_stack ((np.array (df['x'], dtype = float), np.array (df['y'], dtype = float)))
+
+    a = assimilations (p)
+    if sweep_data['field'] is None:
+        targets = sweep_data['targets']
+        fold = targets['fold'][np.array (df.index)]
+        result['score'] = score_cv (flow_x, flow_y, weight, locs, fold, a, targets, sweep_data['folds'])
+    else:
+        result['score'] = score_truth (flow_x, flow_y, weight, locs, a, sweep_data['field'],
+                                       sweep_data['points'])
+    return (result)
+
+def run_sweep (states_df, grid, base_params = None, field = None, points = None, folds = 5, block_size = None,
+               processes = None, seed = 0):
+    '''
+    function to evaluate a grid of parameter sets, intersecting and solving the states only once
+    states_df = a states dataframe
+    grid = dictionary of param name -> list of values (or a list of parameter set dictionaries)
+    base_params = the parameter object the sets are applied to (optional, defaults to params ())
+    field = known flow field function of (x, y) to score against (optional, if None the sets are
+            scored with spatial block cross-validation)
+    points = the points to score against the field at [n, 2] (optional, defaults to the states)
+    folds = number of cross-validation folds
+    block_size = cross-validation block size (m) (optional, defaults to 2 * the widest max_dist, so
+                 pairs rarely straddle the folds)
+    processes = number of processes (optional, defaults to the number of cpus, 1 runs in this process)
+    seed = random seed for dealing the blocks into folds
+    returns a dataframe with a row per parameter set, the number of intersections, and the score
+    (lower is better), sorted by score
+    '''
+    if base_params is None:
+        base_params = params ()
+    if isinstance (grid, dict):
+        param_sets = param_grid (grid)
+    else:
+        param_sets = list (grid)
+    if block_size is None:
+        block_size = 2.0 * max ([s.get ('max_dist', base_params.max_dist) for s in param_sets])
+    if points is None:
+        points = np.column_stack ((np.array (states_df['x'], dtype = float),
+                                   np.array (states_df['y'], dtype = float)))
+
+    df = candidates (states_df, base_params, param_sets)
+    data = {'params': base_params, 'states': states_df, 'candidates': df, 'field': field, 'points': points,
+            'folds': folds}
+
+    # cross-validation targets: all the candidate intersections, weighted by the base params
+    if field is None:
+        locs = np.column_stack ((np.array (df['x'], dtype = float), np.array (df['y'], dtype = float)))
+        data['targets'] = {'locs': locs, 'flow_x': np.array (df['flow_x'], dtype = float),
+                           'flow_y': np.array (df['flow_y'], dtype = float),
+                           'weight': np.array (base_params.calc_weights (df), dtype = float),
+                           'fold': block_folds (locs, folds, block_size, seed)}
+
+    if processes == 1:
+        init_worker (data)
+        rows = [evaluate (s) for s in param_sets]
+    else:
+        pool = multiprocessing.Pool (processes, init_worker, (data,))
+        try:
+            rows = pool.map (evaluate, param_sets)
+        finally:
+            pool.close ()
+            pool.join ()
+
+    table = pd.DataFrame (rows)
+    table = table.sort_values ('score', na_position = 'last').reset_index (drop = True)
+    return (table)
+
+if __name__ == '__main__':
+    field = constant_flow (0.3, -0.2)
+    block = synthetic_states (1000, field = field, heading_noise = 2.0, velocity_noise = 0.05, seed = 3)
+    s = states ()
+    s.add_states (block)
+    grid = {'max_dist': [2.0, 5.0, 10.0], 'min_heading_diff': [10.0, 30.0, 60.0], 'space_zero': [2.0, 10.0],
+            'k_nearest': [20, 100], 'distance_exponent': [1.0, 2.0]}
+    print ('scored against the synthetic flow:')
+    print (run_sweep (s.df, grid, field = field).head (10).to_string (index = False))
+    print ('scored with spatial block cross-validation:')
+    print (run_sweep (s.df, grid).head (10).to_string (index = False))
@@ -0,0 +1,108 @@
+# flow rider
+# Copyright 2016 Thomas E. Barchyn
+# Contact: Thomas E. Barchyn [tbarchyn@gmail.com]
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# Please familiarize yourself with the license of this tool, available
+# in the distribution with the filename: /docs/license.txt
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# purpose: when you are riding the flow and you gotta know . . .
+
+# NOTES: synthetic vehicles riding a known flow, for benchmarks and for scoring parameters against
+# ground truth. The vehicle wanders with a random walk heading and speed through the flow, and the
+# track and velocity over the ground are the vector sum of the flow and the velocity through it.
+
+from math import *
+import numpy as np
+import pandas as pd
+
+def constant_flow (flow_x, flow_y):
+    '''
+    function to make a constant flow field
+    flow_x, flow_y = the flow vector
+    returns a function of (x, y) numpy arrays that returns flow_x, flow_y numpy arrays
+    '''
+    def field (x, y):
+        return (np.zeros (np.shape (x)) + flow_x, np.zeros (np.shape (y)) + flow_y)
+    return (field)
+
+def synthetic_states (n, field = None, extent = 50.0, speed = (0.5, 2.0), turn_sd = 20.0, dt = 1.0,
+                      heading_noise = 0.0, velocity_noise = 0.0, vehicles = 1, seed = 0,
+                      min_flowspeed = 0.0, max_flowspeed = 100.0):
+    '''
+    function to simulate vehicles riding in a flow
+    n = the number of states per vehicle
+    field = flow field function of (x, y) (defaults to constant_flow (0.3, -0.2))
+    extent = the vehicles wrap around in a square of this size (m)
+    speed = range of speeds through the flow (m/s)
+    turn_sd = standard deviation of the heading change per step (degrees)
+    dt = time step (s)
+    heading_noise = standard deviation of noise added to the recorded heading (degrees)
+    velocity_noise = standard deviation of noise added to the recorded ground velocity (m/s)
+    vehicles = number of vehicles
+    seed = random seed
+    min_flowspeed, max_flowspeed = realistic flowspeeds recorded with the states
+    returns a states block (see states.add_states), in time order
+    '''
+    if field is None:
+        field = constant_flow (0.3, -0.2)
+    rng = np.random.RandomState (seed)
+
+    blocks = []
+    for v in range (0, vehicles):
+        heading = (rng.uniform (0.0, 360.0) + np.cumsum (rng.normal (0.0, turn_sd, n))) % 360.0
+        through = rng.uniform (speed[0], speed[1], n)
+        x = np.zeros (n)
+        y = np.zeros (n)
+        gx = np.zeros (n)
+        gy = np.zeros (n)
+        px = rng.uniform (0.0, extent)
+        py = rng.uniform (0.0, extent)
+        for k in range (0, n):
+            fx, fy = field (np.array ([px]), np.array ([py]))
+            gx[k] = fx[0] + through[k] * sin (heading[k] * pi / 180.0)
+            gy[k] = fy[0] + through[k] * cos (heading[k] * pi / 180.0)
+            x[k] = px
+            y[k] = py
+            px = (px + gx[k] * dt) % extent
+            py = (py + gy[k] * dt) % extent
+
+        gx = gx + rng.normal (0.0, velocity_noise, n) if velocity_noise > 0.0 else gx
+        gy = gy + rng.normal (0.0, velocity_noise, n) if velocity_noise > 0.0 else gy
+        recorded_heading = heading + rng.normal (0.0, heading_noise, n) if heading_noise > 0.0 else heading
+        block = pd.DataFrame ({'x': x, 'y': y, 'z': np.zeros (n), 'time': np.arange (0, n) * dt,
+                               'track': (np.arctan2 (gx, gy) * 180.0 / pi) % 360.0,
+                               'velocity': np.sqrt (gx**2.0 + gy**2.0),
+                               'heading': recorded_heading % 360.0})
+        block['min_flowspeed'] = min_flowspeed
+        block['max_flowspeed'] = max_flowspeed
+        block['vehicle'] = v
+        blocks.append (block)
+
+    block = pd.concat (blocks, ignore_index = True)
+    block = block.sort_values (['time', 'vehicle'], kind = 'mergesort').reset_index (drop = True)
+    return (block)
+
+def synthetic_suite ():
+    '''
+    function to return the standard synthetic cases used for benchmarks
+    returns a list of (name, states block) tuples
+    '''
+    suite = []
+    suite.append (('constant_500', synthetic_states (500, seed = 1)))
+    suite.append (('constant_2000', synthetic_states (2000, seed = 2)))
+    suite.append (('noisy_2000', synthetic_states (2000, heading_noise = 2.0, velocity_noise = 0.05, seed = 3)))
+    suite.append (('fleet_3x1000', synthetic_states (1000, vehicles = 3, seed = 4)))
+    suite.append (('loiter_2000', synthetic_states (2000, extent = 10.0, seed = 5)))
+    return (suite)
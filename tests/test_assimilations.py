@@ -0,0 +1,112 @@
+# flow rider
+# Copyright 2016 Thomas E. Barchyn
+# Contact: Thomas E. Barchyn [tbarchyn@gmail.com]
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# Please familiarize yourself with the license of this tool, available
+# in the distribution with the filename: /docs/license.txt
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# purpose: when you are riding the flow and you gotta know . . .
+
+
+# tests of the 2D assimilations
+
+import numpy as np
+import pandas as pd
+import pytest
+
+pytest.importorskip ('gdal')
+
+from params import *
+from assimilations import *
+
+def random_intersections (n, seed):
+    '''
+    function to make a random intersections dataframe
+    '''
+    rng = np.random.RandomState (seed)
+    return (pd.DataFrame ({'x': rng.uniform (0.0, 10.0, n), 'y': rng.uniform (0.0, 10.0, n),
+                           'flow_x': rng.normal (0.3, 0.1, n), 'flow_y': rng.normal (-0.2, 0.1, n),
+                           'weight': rng.uniform (0.1, 2.0, n)}))
+
+def test_assimilate_matches_per_cell_idw ():
+    '''
+    the batched 2D assimilation matches inverse distance weighting computed cell by cell
+    '''
+    p = params ()
+    p.k_nearest = 10
+    df = random_intersections (200, 1)
+    a = assimilations (p)
+    a.initialize (originX = 0.0, originY = 0.0, cell_Width = 1.0, cell_Height = 1.0, ncols = 8, nrows = 6)
+    a.assimilate (df)
+
+    locs = np.column_stack ((df['x'], df['y']))
+    for i in range (0, 6):
+        for j in range (0, 8):
+            d = np.sqrt (np.sum ((locs - [a.flow_x_mean.x_index[j], a.flow_x_mean.y_index[i]])**2.0, axis = 1))
+            near = np.argsort (d)[0:10]
+            w = np.array (df['weight'])[near] / d[near]**p.distance_exponent
+            fx = np.array (df['flow_x'])[near]
+            mean = np.average (fx, weights = w)
+            assert np.isclose (a.flow_x_mean.ras[i, j], mean)
+            assert np.isclose (a.flow_x_sd.ras[i, j], np.sqrt (np.average ((fx - mean)**2.0, weights = w)))
+            assert np.isclose (a.flow_x_med.ras[i, j], np.median (fx))
+            assert np.isclose (a.flow_y_mean.ras[i, j], np.average (np.array (df['flow_y'])[near], weights = w))
+
+def test_assimilate_on_an_intersection_and_with_few_intersections ():
+    '''
+    a cell centre right on an intersection takes its flow, and fewer than k_nearest intersections
+    are all used
+    '''
+    p = params ()
+    p.k_nearest = 50
+    df = random_intersections (5, 2)
+    df.loc[0, 'x'] = 0.5
+    df.loc[0, 'y'] = 0.5
+    a = assimilations (p)
+    a.initialize (originX = 0.0, originY = 0.0, cell_Width = 1.0, cell_Height = 1.0, ncols = 4, nrows = 4)
+    a.assimilate (df)
+    assert np.all (np.isfinite (a.flow_x_mean.ras))
+    row = np.argmin (np.abs (a.flow_x_mean.y_index - 0.5))
+    assert np.isclose (a.flow_x_mean.ras[row, 0], df.loc[0, 'flow_x'])
+    assert np.isclose (a.flow_y_mean.ras[row, 0], df.loc[0, 'flow_y'])
+
+def test_compute_rasters_at_the_same_time ():
+    '''
+    rasters computed at the same time for different intersections do not overwrite each other,
+    and the stored rasters are only changed by set_rasters
+    '''
+    import threading
+    p = params ()
+    a = assimilations (p)
+    a.initialize (originX = 0.0, originY = 0.0, cell_Width = 0.5, cell_Height = 0.5, ncols = 40, nrows = 40)
+    inputs = [random_intersections (300, seed) for seed in range (10, 14)]
+    expected = [a.compute_rasters (df) for df in inputs]
+    assert np.all (np.isnan (a.flow_x_mean.ras))
+
+    got = [None] * len (inputs)
+    def run (n):
+        got[n] = a.compute_rasters (inputs[n])
+        return
+    threads = [threading.Thread (target = run, args = (n,)) for n in range (0, len (inputs))]
+    for t in threads:
+        t.start ()
+    for t in threads:
+        t.join ()
+    for n in range (0, len (inputs)):
+        for name in a.voxel_names:
+            assert np.array_equal (got[n][name], expected[n][name], equal_nan = True)
+
+    a.set_rasters (got[2])
+    assert np.array_equal (a.get_rasters ()['flow_vel'], expected[2]['flow_vel'], equal_nan = True)
@@ -0,0 +1,145 @@
+# flow rider
+# Copyright 2016 Thomas E. Barchyn
+# Contact: Thomas E. Barchyn [tbarchyn@gmail.com]
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# Please familiarize yourself with the license of this tool, available
+# in the distribution with the filename: /docs/license.txt
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# purpose: when you are riding the flow and you gotta know . . .
+
+
+# tests of the assimilation cache
+
+import os
+import threading
+import numpy as np
+import pandas as pd
+import pytest
+
+from params import *
+from cache import *
+
+def cache_params (size = 8, folder = None):
+    '''
+    function to make a parameter object for the cache
+    '''
+    p = params ()
+    p.assimilation_cache = True
+    p.assimilation_cache_size = size
+    p.assimilation_cache_folder = folder
+    return (p)
+
+def estimates (seed):
+    '''
+    function to make a small random intersections dataframe
+    '''
+    rng = np.random.RandomState (seed)
+    return (pd.DataFrame ({'x': rng.uniform (0.0, 10.0, 20), 'y': rng.uniform (0.0, 10.0, 20),
+                           'z': np.zeros (20), 'flow_x': rng.normal (0.0, 1.0, 20),
+                           'flow_y': rng.normal (0.0, 1.0, 20), 'weight': rng.uniform (0.0, 1.0, 20)}))
+
+def result (value):
+    '''
+    function to make a dictionary of raster arrays
+    '''
+    return ({'flow_x_mean': np.zeros ((3, 4)) + value, 'flow_y_mean': np.zeros ((3, 4)) - value})
+
+def test_fingerprint ():
+    '''
+    the fingerprint depends on the intersections, the grid, and the assimilation params only
+    '''
+    c = assimilation_cache (cache_params ())
+    df = estimates (1)
+    grid = (None, 0.0, 0.0, 1.0, 1.0, 10, 10, False)
+    key = c.fingerprint (df, grid)
+    assert c.fingerprint (df.copy (), grid) == key
+    assert c.fingerprint (df, (None, 0.0, 0.0, 1.0, 1.0, 10, 11, False)) != key
+
+    changed = df.copy ()
+    changed.loc[3, 'flow_x'] = changed.loc[3, 'flow_x'] + 1e-9
+    assert c.fingerprint (changed, grid) != key
+
+    c.params.k_nearest = c.params.k_nearest + 1
+    assert c.fingerprint (df, grid) != key
+    c.params.k_nearest = c.params.k_nearest - 1
+    c.params.max_dist = c.params.max_dist + 1.0       # not an assimilation param
+    assert c.fingerprint (df, grid) == key
+
+def test_lru_eviction ():
+    '''
+    the least recently used key is dropped when the cache is full
+    '''
+    c = assimilation_cache (cache_params (size = 2))
+    c.store ('a', result (1.0))
+    c.store ('b', result (2.0))
+    assert not c.get ('a') is None                     # a is now more recently used than b
+    c.store ('c', result (3.0))
+    assert c.get ('b') is None
+    assert np.all (c.get ('a')['flow_x_mean'] == 1.0)
+    assert np.all (c.get ('c')['flow_x_mean'] == 3.0)
+
+def test_disk_tier (tmp_path):
+    '''
+    results are written to the folder and read back by a new cache
+    '''
+    folder = str (tmp_path / 'cache')
+    c = assimilation_cache (cache_params (folder = folder))
+    calls = []
+    def compute ():
+        calls.append (1)
+        return (result (4.0))
+    c.get_or_compute ('k', compute)
+    assert os.listdir (folder) == ['k.npz']             # no temporary files are left behind
+
+    d = assimilation_cache (cache_params (folder = folder))
+    got = d.get_or_compute ('k', compute)
+    assert len (calls) == 1
+    assert np.all (got['flow_y_mean'] == -4.0)
+    assert d.hits == 1 and d.misses == 0
+    d.clear ()
+    assert not d.get ('k') is None                      # clear leaves the disk tier alone
+
+def test_inflight_requests_compute_once ():
+    '''
+    concurrent requests for the same key wait for one compute, other keys compute at the same time
+    '''
+    c = assimilation_cache (cache_params ())
+    release = threading.Event ()
+    started = threading.Event ()
+    calls = []
+    def slow ():
+        calls.append ('slow')
+        started.set ()
+        release.wait (10.0)
+        return (result (5.0))
+
+    results = []
+    threads = [threading.Thread (target = lambda: results.append (c.get_or_compute ('k', slow)))
+               for t in range (0, 4)]
+    for t in threads:
+        t.start ()
+    assert started.wait (10.0)
+
+    # another key is not held up by the slow one
+    other = c.get_or_compute ('other', lambda: result (6.0))
+    assert np.all (other['flow_x_mean'] == 6.0)
+
+    release.set ()
+    for t in threads:
+        t.join (10.0)
+    assert calls == ['slow']
+    assert len (results) == 4
+    assert all ([np.all (r['flow_x_mean'] == 5.0) for r in results])
+    assert c.misses == 2 and c.hits == 3
@@ -0,0 +1,173 @@
+# flow rider
+# Copyright 2016 Thomas E. Barchyn
+# Contact: Thomas E. Barchyn [tbarchyn@gmail.com]
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# Please familiarize yourself with the license of this tool, available
+# in the distribution with the filename: /docs/license.txt
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# purpose: when you are riding the flow and you gotta know . . .
+
+
+# tests of intersection storage and thinning
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from params import *
+from states import *
+from intersections import *
+from synthetic import *
+
+def run_updates (p, block, step, turn_on = None):
+    '''
+    function to intersect a states block in steps of step states
+    p = a parameter object
+    block = a states block
+    step = the number of states added per update
+    turn_on = dictionary of params to set after the first update (optional)
+    returns the states and intersections objects
+    '''
+    s = states ()
+    i = intersections (p, s.done_all_callback)
+    for start in range (0, block.shape[0], step):
+        s.add_states (block.iloc[start:start + step])
+        i.update (s.df)
+        if not turn_on is None and start == 0:
+            for name in turn_on:
+                setattr (p, name, turn_on[name])
+    return (s, i)
+
+def max_per_cell (df, size):
+    '''
+    function to count the most intersections in any thinning cell
+    '''
+    cells = pd.DataFrame ({'col': np.floor (np.array (df['x'], dtype = float) / size),
+                           'row': np.floor (np.array (df['y'], dtype = float) / size)})
+    return (cells.groupby (['col', 'row']).size ().max ())
+
+def test_thin_caps_cells_and_keeps_the_highest_weights ():
+    '''
+    'top' thinning keeps at most thin_max_per_cell intersections per cell, the highest weights
+    '''
+    block = synthetic_states (200, extent = 20.0, seed = 3)
+    p = params ()
+    p.thin_cell_size = 4.0
+    s, full = run_updates (p, block, 200)               # one update, so no cells are thinned early
+
+    p = params ()
+    p.thin_cell_size = 4.0
+    p.thin_max_per_cell = 5
+    s, thinned = run_updates (p, block, 200)
+    assert max_per_cell (thinned.df, 4.0) <= 5
+    assert thinned.df.shape[0] + thinned.thinned.stats ()['count'] == full.df.shape[0]
+
+    cells = [np.floor (np.array (full.df[c], dtype = float) / 4.0) for c in ('x', 'y')]
+    top = full.df.assign (col = cells[0], row = cells[1])
+    top = top.sort_values ('weight', ascending = False, kind = 'mergesort').groupby (['col', 'row']).head (5)
+    assert np.allclose (np.sort (np.array (thinned.df['weight'], dtype = float)),
+                        np.sort (np.array (top['weight'], dtype = float)))
+
+def test_thin_turned_on_after_intersections_are_stored ():
+    '''
+    turning thinning on with intersections already stored makes the keys of the stored rows
+    '''
+    block = synthetic_states (150, extent = 20.0, seed = 4)
+    p = params ()
+    p.thin_cell_size = 4.0
+    s, i = run_updates (p, block, 50, turn_on = {'thin_max_per_cell': 3})
+    assert i.thin_keys.shape[0] == i.df.shape[0]
+    assert i.thin_cells.shape[0] == i.df.shape[0]
+    assert i.thinned.stats ()['count'] > 0
+
+def test_thin_after_read (tmp_path):
+    '''
+    intersections read from disk get thinning keys for the thinning method at the next update
+    '''
+    block = synthetic_states (100, extent = 20.0, seed = 5)
+    p = params ()
+    p.thin_cell_size = 4.0
+    p.thin_max_per_cell = 4
+    p.thin_method = 'reservoir'
+    s, i = run_updates (p, block.iloc[0:50], 50)
+    filename = str (tmp_path / 'intersections.csv')
+    i.write_intersections (filename)
+
+    j = intersections (p, s.done_all_callback)
+    j.read_intersections (filename)
+    s.add_states (block.iloc[50:100])
+    j.update (s.df)
+    assert j.thin_keys.shape[0] == j.df.shape[0]
+    assert np.all ((j.thin_keys >= 0.0) & (j.thin_keys <= 1.0))
+    assert max_per_cell (j.df, 4.0) <= 4
+
+def test_solve_recovers_a_known_flow ():
+    '''
+    the vectorized solve recovers the flow and in-flow speeds, and matches the scalar calc
+    '''
+    rng = np.random.RandomState (6)
+    n = 200
+    flow = np.array ([0.4, -0.7])
+    h1 = rng.uniform (0.0, 360.0, n)
+    h2 = rng.uniform (0.0, 360.0, n)
+    s1 = rng.uniform (0.5, 2.0, n)
+    s2 = rng.uniform (0.5, 2.0, n)
+    t1x = flow[0] + s1 * np.sin (h1 * np.pi / 180.0)
+    t1y = flow[1] + s1 * np.cos (h1 * np.pi / 180.0)
+    t2x = flow[0] + s2 * np.sin (h2 * np.pi / 180.0)
+    t2y = flow[1] + s2 * np.cos (h2 * np.pi / 180.0)
+
+    i = intersections (params (), None)
+    h1_vel, h2_vel, flow_x, flow_y = i.solve (t1x, t1y, np.sin (h1 * np.pi / 180.0), np.cos (h1 * np.pi / 180.0),
+                                              t2x, t2y, np.sin (h2 * np.pi / 180.0), np.cos (h2 * np.pi / 180.0))
+    assert np.allclose (flow_x, flow[0]) and np.allclose (flow_y, flow[1])
+    assert np.allclose (h1_vel, s1) and np.allclose (h2_vel, s2)
+
+    for k in range (0, 10):
+        scalar = i.calc (np.arctan2 (t1x[k], t1y[k]) * 180.0 / np.pi, np.hypot (t1x[k], t1y[k]), h1[k],
+                         np.arctan2 (t2x[k], t2y[k]) * 180.0 / np.pi, np.hypot (t2x[k], t2y[k]), h2[k])
+        assert np.allclose (scalar, (h1_vel[k], h2_vel[k], flow_x[k], flow_y[k]))
+
+    parallel = i.solve (np.array ([1.0]), np.array ([0.0]), np.array ([0.0]), np.array ([1.0]),
+                        np.array ([0.5]), np.array ([0.0]), np.array ([0.0]), np.array ([1.0]))
+    assert np.all (np.isnan (parallel))
+
+def test_compact_storage ():
+    '''
+    compact storage keeps int32 ids, float64 locations, and float32 values, takes 64 bytes per
+    intersection, and expands back to the full intersections
+    '''
+    block = synthetic_states (150, seed = 8)
+    block['x'] = block['x'] + 500000.0                 # utm magnitudes
+    block['y'] = block['y'] + 5650000.0
+    s, full = run_updates (params (), block, 50)
+    p = params ()
+    p.compact_storage = True
+    s, compact = run_updates (p, block, 50)
+
+    assert compact.df.shape[0] == full.df.shape[0]
+    assert list (compact.df.columns) == list (compact.compact_columns)
+    assert compact.df['id1'].dtype == np.int32 and compact.df['x'].dtype == np.float64
+    assert compact.df['flow_x'].dtype == np.float32 and compact.df['weight'].dtype == np.float32
+    assert np.isclose (compact.bytes_per_intersection (), 64.0, atol = 0.5)
+    assert np.isclose (full.bytes_per_intersection (), 152.0, atol = 0.5)
+
+    expanded = compact.expand (s.df)
+    assert list (expanded.columns) == list (full.columns)
+    for column in ('id1', 'id2', 'x', 'y', 'z', 't1_angle', 't2_vel', 'h2_angle'):
+        assert np.array_equal (np.array (expanded[column], dtype = float), np.array (full.df[column], dtype = float))
+    for column in ('flow_x', 'flow_y', 'weight'):
+        assert np.allclose (np.array (expanded[column], dtype = float), np.array (full.df[column], dtype = float),
+                            rtol = 1e-6, atol = 1e-6)
@@ -0,0 +1,111 @@
+# flow rider
+# Copyright 2016 Thomas E. Barchyn
+# Contact: Thomas E. Barchyn [tbarchyn@gmail.com]
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# Please familiarize yourself with the license of this tool, available
+# in the distribution with the filename: /docs/license.txt
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# purpose: when you are riding the flow and you gotta know . . .
+
+
+# tests of the kriging assimilation backend
+
+import numpy as np
+import pytest
+
+from params import *
+from kriging import *
+
+def systems (m, k, seed):
+    '''
+    function to make a batch of random kriging neighbourhoods
+    returns the neighbour locations [m, k, 2], the cell locations [m, 2], and the distances
+    '''
+    rng = np.random.RandomState (seed)
+    near = rng.uniform (0.0, 10.0, (m, k, 2))
+    cells = rng.uniform (0.0, 10.0, (m, 2))
+    d_data = np.sqrt (np.sum ((near[:, :, None, :] - near[:, None, :, :])**2.0, axis = 3))
+    d_target = np.sqrt (np.sum ((near - cells[:, None, :])**2.0, axis = 2))
+    return (near, cells, d_data, d_target)
+
+def test_solve_matches_one_system_at_a_time ():
+    '''
+    the batched solve gives the ordinary kriging weights and variances of each system
+    '''
+    m, k = 30, 12
+    near, cells, d_data, d_target = systems (m, k, 1)
+    noise = np.random.RandomState (2).uniform (0.01, 0.2, (m, k))
+    variogram = (0.1, 1.5, 4.0)
+    nugget, sill, range_ = variogram
+    weights, variance = kriging (params ()).solve (d_data, d_target, noise, variogram)
+    assert weights.shape == (m, k) and variance.shape == (m,)
+    assert np.allclose (np.sum (weights, axis = 1), 1.0)        # ordinary kriging is unbiased
+
+    for c in range (0, m):
+        a = np.ones ((k + 1, k + 1))
+        a[:k, :k] = sill * np.exp (-d_data[c] / range_) + np.diag (noise[c] + 1e-10 * sill)
+        a[k, k] = 0.0
+        b = np.ones (k + 1)
+        b[:k] = sill * np.exp (-d_target[c] / range_)
+        x = np.linalg.solve (a, b)
+        assert np.allclose (weights[c], x[:k])
+        assert np.isclose (variance[c], max (sill - np.dot (x[:k], b[:k]) - x[k], 0.0))
+
+def test_solve_interpolates_a_noise_free_point ():
+    '''
+    with no noise, a cell on a neighbour takes all the weight and has no variance
+    '''
+    near, cells, d_data, d_target = systems (1, 8, 3)
+    d_target = np.sqrt (np.sum ((near - near[:, 2:3, :])**2.0, axis = 2))
+    weights, variance = kriging (params ()).solve (d_data, d_target, np.zeros ((1, 8)), (0.0, 1.0, 3.0))
+    assert np.allclose (weights[0], np.eye (8)[2], atol = 1e-6)
+    assert variance[0] < 1e-6
+
+def test_predict_recovers_a_smooth_field ():
+    '''
+    kriging a noisy smooth flow is closer to the flow than the intersections are, and the standard
+    deviations cover most of the errors
+    '''
+    def field (locs):
+        return (0.3 + 0.2 * np.sin (locs[:, 0] / 15.0) * np.cos (locs[:, 1] / 15.0),
+                -0.2 + 0.1 * np.cos (locs[:, 0] / 20.0))
+    rng = np.random.RandomState (4)
+    n = 1500
+    locs = rng.uniform (0.0, 100.0, (n, 2))
+    true_x, true_y = field (locs)
+    flow_x = true_x + rng.normal (0.0, 0.05, n)
+    flow_y = true_y + rng.normal (0.0, 0.05, n)
+    points = rng.uniform (10.0, 90.0, (300, 2))
+    point_x, point_y = field (points)
+
+    p = params ()
+    p.kriging_chunk_size = 128                          # more than one chunk
+    krig = kriging (p)
+    mean_x, mean_y, sd_x, sd_y, med_x, med_y = krig.predict (locs, flow_x, flow_y, np.ones (n), points)
+    error_x = mean_x - point_x
+    error_y = mean_y - point_y
+    assert np.sqrt (np.mean (error_x**2.0)) < 0.05      # the intersection noise
+    assert np.sqrt (np.mean (error_y**2.0)) < 0.05
+    assert np.mean (np.abs (error_x) < 2.0 * sd_x) > 0.85
+    assert np.mean (np.abs (error_y) < 2.0 * sd_y) > 0.85
+    assert set (krig.variograms.keys ()) == set (['flow_x', 'flow_y'])
+
+def test_predict_with_no_usable_intersections ():
+    '''
+    with no usable intersections every estimate is nan
+    '''
+    locs = np.zeros ((3, 2))
+    results = kriging (params ()).predict (locs, np.ones (3), np.ones (3), np.zeros (3), np.ones ((5, 2)))
+    assert all ([np.all (np.isnan (r)) for r in results])
@@ -0,0 +1,122 @@
+# flow rider
+# Copyright 2016 Thomas E. Barchyn
+# Contact: Thomas E. Barchyn [tbarchyn@gmail.com]
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# Please familiarize yourself with the license of this tool, available
+# in the distribution with the filename: /docs/license.txt
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# purpose: when you are riding the flow and you gotta know . . .
+
+# tests of the online (recursive) flow estimate
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from params import *
+from online import *
+from synthetic import *
+
+def test_thinning_feeds_only_new_stored_rows ():
+    '''
+    with thinning on, the online estimate gets exactly the new intersections that survive thinning
+    '''
+    pytest.importorskip ('gdal')
+    from flow import flow
+
+    p = params ()
+    p.thin_max_per_cell = 3
+    p.thin_cell_size = 5.0
+    p.online_flow = True
+    p.online_flow_source = 'estimates'
+    fl = flow (quiet = True, params_object = p)
+
+    fed = []
+    update_estimates = fl.online.update_estimates
+    def record (df, states = None):
+        fed.append (df.copy ())
+        update_estimates (df, states)
+        return
+    fl.online.update_estimates = record
+
+    block = synthetic_states (120, seed = 7)
+    for start in range (0, block.shape[0], 20):
+        before = set (zip (fl.intersections.df['id1'], fl.intersections.df['id2']))
+        fl.states.add_states (block.iloc[start:start + 20])
+        fl.update ()
+        after = set (zip (fl.intersections.df['id1'], fl.intersections.df['id2']))
+        got = list (zip (fed[-1]['id1'], fed[-1]['id2']))
+        assert len (got) == len (set (got))
+        assert set (got) == after - before
+
+    assert fl.intersections.thinned.stats ()['count'] > 0     # thinning did drop rows
+
+def test_overlapping_batches_do_not_repeat_process_noise ():
+    '''
+    a batch that starts before the last update only adds process noise for the time past it
+    '''
+    p = params ()
+    p.online_initial_variance = 1.0
+    p.online_measurement_variance = 1e12                # measurements barely shrink the variance
+    p.online_process_noise = 1.0
+    o = online_flow (p)
+
+    ids = np.arange (0.0, 13.0)
+    states = pd.DataFrame ({'id': ids, 'time': ids})
+    first = pd.DataFrame ({'id1': np.arange (0.0, 10.0), 'id2': np.arange (1.0, 11.0)})
+    second = pd.DataFrame ({'id1': np.arange (4.0, 11.0), 'id2': np.arange (6.0, 13.0)})
+    for batch in (first, second):
+        batch['flow_x'] = 0.3
+        batch['flow_y'] = -0.2
+        batch['weight'] = 1.0
+
+    o.update_estimates (first, states)                  # pair times 0.5 to 9.5
+    assert o.last_time == 9.5
+    assert np.allclose (np.diag (o.P), 1.0 + 9.0, rtol = 1e-6)
+    o.update_estimates (second, states)                 # pair times 5 to 11, overlapping the first
+    assert o.last_time == 11.0
+    assert np.allclose (np.diag (o.P), 1.0 + 10.5, rtol = 1e-6)
+
+def test_pairs_sharing_a_state_count_as_one_measurement ():
+    '''
+    a new state paired with k earlier states shrinks the variance about as much as one measurement
+    '''
+    p = params ()
+    p.online_initial_variance = 1.0
+    p.online_measurement_variance = 0.5
+    o = online_flow (p)
+
+    k = 25
+    df = pd.DataFrame ({'id1': np.arange (0.0, k), 'id2': np.zeros (k) + k, 'flow_x': 0.3, 'flow_y': -0.2,
+                        'weight': 1.0})
+    assert np.all (o.shared_states (df) == k)
+    o.update_estimates (df)
+    assert np.allclose (np.diag (o.P), 1.0 / (1.0 / 1.0 + 1.0 / 0.5))
+    assert np.allclose (o.flow, [0.3 * 2.0 / 3.0, -0.2 * 2.0 / 3.0])
+
+def test_independent_pairs_are_not_inflated ():
+    '''
+    pairs that share no states are each a full measurement
+    '''
+    p = params ()
+    p.online_initial_variance = 1.0
+    p.online_measurement_variance = 0.5
+    o = online_flow (p)
+
+    df = pd.DataFrame ({'id1': [0.0, 2.0, 4.0], 'id2': [1.0, 3.0, 5.0], 'flow_x': 0.3, 'flow_y': -0.2,
+                        'weight': 1.0})
+    assert np.all (o.shared_states (df) == 1)
+    o.update_estimates (df)
+    assert np.allclose (np.diag (o.P), 1.0 / (1.0 / 1.0 + 3.0 / 0.5))
@@ -0,0 +1,98 @@
+# flow rider
+# Copyright 2016 Thomas E. Barchyn
+# Contact: Thomas E. Barchyn [tbarchyn@gmail.com]
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# Please familiarize yourself with the license of this tool, available
+# in the distribution with the filename: /docs/license.txt
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# purpose: when you are riding the flow and you gotta know . . .
+
+
+# tests of the NMEA log parser
+
+from functools import reduce
+import numpy as np
+import pandas as pd
+import pytest
+
+from raw_logs import *
+
+def sentence (body, checksum = None):
+    '''
+    function to make an NMEA sentence with its checksum
+    body = the sentence without the $ and the checksum
+    checksum = the checksum to write (optional, defaults to the correct one)
+    '''
+    if checksum is None:
+        checksum = '%02X' % reduce (lambda a, b: a ^ b, [ord (c) for c in body], 0)
+    return ('$' + body + '*' + checksum)
+
+def write_log (tmp_path, lines):
+    '''
+    function to write an NMEA log
+    '''
+    filename = str (tmp_path / 'log.nmea')
+    with open (filename, 'w') as f:
+        f.write ('\n'.join (lines) + '\n')
+    return (filename)
+
+def test_nmea_checksum ():
+    '''
+    the checksum is the XOR of the characters between the $ and the *
+    '''
+    s = sentence ('GPGGA,123519,4807.038,N,01131.000,E,1,08,0.9,545.4,M,46.9,M,,')
+    assert s.endswith ('*47')
+    sentences = pd.Series ([s[:-3], s[:-3], s[:-3], '$GPVTG,054.7,T,034.4,M,005.5,N,010.2,K'])
+    checksums = pd.Series (['47', '4a', '46', np.nan])
+    assert list (nmea_checksum_ok (sentences, checksums)) == [True, False, False, True]
+
+def test_read_nmea_over_midnight (tmp_path):
+    '''
+    RMC, GGA, and VTG sentences are combined per epoch, GGA/VTG epochs without an RMC take the
+    date of the nearest RMC (across midnight), and bad checksums are dropped
+    '''
+    lines = [sentence ('GPRMC,235958.00,A,5103.0000,N,11405.0000,W,1.944,90.0,310124,,,A'),
+             sentence ('GPGGA,235958.00,5103.0000,N,11405.0000,W,1,08,0.9,1045.0,M,-17.0,M,,'),
+             sentence ('GPVTG,90.0,T,,M,1.944,N,3.6,K,A'),
+             sentence ('GPGGA,235959.00,5103.0005,N,11405.0000,W,1,08,0.9,1045.5,M,-17.0,M,,'),
+             sentence ('GPVTG,45.0,T,,M,3.888,N,7.2,K,A'),
+             'logger junk ' + sentence ('GNGGA,000000.00,5103.0010,N,11405.0000,W,1,08,0.9,1046.0,M,-17.0,M,,'),
+             sentence ('GNVTG,0.0,T,,M,1.944,N,3.6,K,A'),
+             sentence ('GPRMC,000001.00,A,5103.0015,N,11405.0000,W,1.944,180.0,010224,,,A'),
+             sentence ('GPGGA,000001.00,5103.0015,N,11405.0000,W,1,08,0.9,1046.5,M,-17.0,M,,'),
+             sentence ('GPRMC,000002.00,A,5103.0020,N,11405.0000,W,1.944,270.0,010224,,,A', '00'),
+             sentence ('GPRMC,000003.00,V,,,,,,,010224,,,N'),
+             sentence ('GPGSV,3,1,11,03,03,111,00,04,15,270,00,06,01,010,00,13,06,292,00')]
+    fixes = read_nmea (write_log (tmp_path, lines))
+
+    midnight = (pd.Timestamp ('2024-02-01') - pd.Timestamp ('1970-01-01')) / pd.Timedelta (seconds = 1)
+    assert fixes.shape[0] == 4
+    assert np.allclose (fixes['time'], midnight + np.array ([-2.0, -1.0, 0.0, 1.0]))
+    assert np.allclose (fixes['track'], [90.0, 45.0, 0.0, 180.0])
+    assert np.allclose (fixes['velocity'], [1.0, 2.0, 1.0, 1.0], rtol = 1e-3)
+    assert np.allclose (fixes['alt'], [1045.0, 1045.5, 1046.0, 1046.5])
+    assert np.allclose (fixes['lat'], 51.0 + (3.0 + np.array ([0.0, 0.0005, 0.001, 0.0015])) / 60.0)
+    assert np.allclose (fixes['lon'], -1.0 * (114.0 + 5.0 / 60.0))
+
+def test_read_nmea_without_dates (tmp_path):
+    '''
+    without any RMC dates the times are seconds since midnight, unwrapped over midnight
+    '''
+    lines = [sentence ('GPGGA,235959.00,5103.0000,N,11405.0000,W,1,08,0.9,10.0,M,-17.0,M,,'),
+             sentence ('GPVTG,90.0,T,,M,1.944,N,3.6,K,A'),
+             sentence ('GPGGA,000000.50,5103.0005,N,11405.0000,W,1,08,0.9,10.0,M,-17.0,M,,'),
+             sentence ('GPVTG,90.0,T,,M,1.944,N,3.6,K,A')]
+    fixes = read_nmea (write_log (tmp_path, lines))
+    assert np.allclose (fixes['time'], [86399.0, 86400.5])
@@ -0,0 +1,112 @@
+# flow rider
+# Copyright 2016 Thomas E. Barchyn
+# Contact: Thomas E. Barchyn [tbarchyn@gmail.com]
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# Please familiarize yourself with the license of this tool, available
+# in the distribution with the filename: /docs/license.txt
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# purpose: when you are riding the flow and you gotta know . . .
+
+
+# tests of the weighted running flow stats
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from params import *
+from running_stats import *
+
+def batches (seed):
+    '''
+    function to make random batches of flow estimates, with some unusable rows
+    '''
+    rng = np.random.RandomState (seed)
+    out = []
+    for n in (1, 7, 40, 3, 120):
+        df = pd.DataFrame ({'x': rng.uniform (0.0, 10.0, n), 'y': rng.uniform (0.0, 10.0, n),
+                            'flow_x': rng.normal (0.3, 0.5, n), 'flow_y': rng.normal (-0.2, 0.2, n),
+                            'weight': rng.uniform (0.0, 3.0, n)})
+        if n > 5:
+            df.loc[0, 'flow_x'] = np.nan
+            df.loc[1, 'weight'] = 0.0
+            df.loc[2, 'weight'] = np.nan
+        out.append (df)
+    return (out)
+
+def expected (df):
+    '''
+    function to compute the weighted stats of all the usable rows at once
+    '''
+    df = df[df['flow_x'].notnull () & df['flow_y'].notnull () & (df['weight'] > 0.0)]
+    w = np.array (df['weight'])
+    xy = np.array (df[['flow_x', 'flow_y']]).T
+    cov = np.cov (xy, aweights = w, ddof = 0)
+    return (df.shape[0], np.sum (w), np.average (xy[0], weights = w), np.average (xy[1], weights = w),
+            cov[0, 0], cov[1, 1])
+
+def check (stats, values):
+    '''
+    function to compare a stats dictionary with expected values
+    '''
+    n, w, mean_x, mean_y, var_x, var_y = values
+    assert stats['count'] == n
+    assert np.isclose (stats['weight'], w)
+    assert np.isclose (stats['flow_x_mean'], mean_x)
+    assert np.isclose (stats['flow_y_mean'], mean_y)
+    assert np.isclose (stats['flow_x_var'], var_x)
+    assert np.isclose (stats['flow_y_var'], var_y)
+    return
+
+def test_merged_batches_match_one_array ():
+    '''
+    the chan merge of the batches gives the mean and variance of the concatenated batches
+    '''
+    r = running_stats (params ())
+    parts = batches (1)
+    for df in parts:
+        r.update (df)
+    check (r.stats (), expected (pd.concat (parts, ignore_index = True)))
+
+def test_unusable_batches_are_ignored ():
+    '''
+    batches with no usable rows leave the stats alone
+    '''
+    r = running_stats (params ())
+    r.update (pd.DataFrame ({'x': [0.0], 'y': [0.0], 'flow_x': [1.0], 'flow_y': [1.0], 'weight': [0.0]}))
+    assert r.stats ()['count'] == 0 and np.isnan (r.stats ()['flow_x_mean'])
+    parts = batches (2)
+    for df in parts:
+        r.update (df)
+        r.update (df.iloc[0:0])
+    check (r.stats (), expected (pd.concat (parts, ignore_index = True)))
+
+def test_per_bin_stats_match_one_array ():
+    '''
+    the per bin stats of the merged batches match each bin of the concatenated batches
+    '''
+    r = running_stats (params (), bin_size = 2.5)
+    parts = batches (3)
+    for df in parts:
+        r.update (df)
+    full = pd.concat (parts, ignore_index = True)
+    col = np.floor (full['x'] / 2.5)
+    row = np.floor (full['y'] / 2.5)
+    for (c, w), cell in full.groupby ([col, row]):
+        values = expected (cell)
+        if values[0] == 0:
+            continue
+        check (r.stats ((c + 0.5) * 2.5, (w + 0.5) * 2.5), values)
+    assert sum ([acc[0] for acc in r.bins.values ()]) == r.stats ()['count']
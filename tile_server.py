@@ -0,0 +1,357 @@
+# flow rider
+# Copyright 2016 Thomas E. Barchyn
+# Contact: Thomas E. Barchyn [tbarchyn@gmail.com]
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# Please familiarize yourself with the license of this tool, available
+# in the distribution with the filename: /docs/license.txt
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# purpose: when you are riding the flow and you gotta know . . .
+
+# NOTES: a small local http server for looking at the flow while riding it. publish takes a copy
+# of the present assimilation rasters and builds an overview pyramid once (each level halves the
+# resolution by averaging flow_x and flow_y over 2 x 2 blocks, then velocity and azimuth are
+# recalculated from the averaged vectors). The new snapshot is swapped in with one assignment, so
+# requests never wait on ingestion or assimilation and never see half a snapshot. Tiles are on the
+# euclidean grid of the assimilations (not web mercator): zoom 0 is the coarsest level, which fits
+# in one tile, and each zoom doubles the resolution up to the full resolution rasters.
+#
+# urls:
+# /snapshot.json                        snapshot version, zoom levels, bounds, and colour ranges
+# /tiles/<layer>/<z>/<x>/<y>.png        layer is vel, az, flow_x, or flow_y (x is the column, y the
+#                                       row of the tile, counted from the top left)
+# /arrows/<z>/<x>/<y>.geojson           flow arrows at the cell centres of a tile
+
+import json
+import zlib
+import struct
+import threading
+import collections
+from math import *
+import numpy as np
+
+try:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+except ImportError:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+
+def encode_png (rgba):
+    '''
+    function to encode an image as a png (no imaging library required)
+    rgba = uint8 numpy array [row, col, 4]
+    returns the png as bytes
+    '''
+    nrows, ncols = rgba.shape[0], rgba.shape[1]
+    raw = np.zeros ((nrows, ncols * 4 + 1), dtype = np.uint8)     # filter byte 0 at the start of each row
+    raw[:, 1:] = rgba.reshape (nrows, ncols * 4)
+
+    def chunk (kind, data):
+        body = kind + data
+        return (struct.pack ('>I', len (data)) + body + struct.pack ('>I', zlib.crc32 (body) & 0xffffffff))
+
+    header = struct.pack ('>IIBBBBB', ncols, nrows, 8, 6, 0, 0, 0)
+    return (b'\x89PNG\r\n\x1a\n' + chunk (b'IHDR', header) + chunk (b'IDAT', zlib.compress (raw.tobytes (), 6)) +
+            chunk (b'IEND', b''))
+
+def colour_ramp (values, vmin, vmax, stops):
+    '''
+    function to map values to colours with a linear ramp, nans are transparent
+    values = numpy array of values
+    vmin, vmax = the values mapped to the first and last stops
+    stops = list of (r, g, b) stops, evenly spaced
+    returns a uint8 numpy array [row, col, 4]
+    '''
+    stops = np.array (stops, dtype = float)
+    span = vmax - vmin
+    if not span > 0.0:
+        span = 1.0
+    frac = np.clip ((np.nan_to_num (values) - vmin) / span, 0.0, 1.0) * (stops.shape[0] - 1)
+    rgba = np.zeros (values.shape + (4,), dtype = np.uint8)
+    for band in range (0, 3):
+        rgba[..., band] = np.interp (frac, np.arange (0, stops.shape[0]), stops[:, band]).astype (np.uint8)
+    rgba[..., 3] = np.where (np.isnan (values), 0, 255)
+    return (rgba)
+
+# colour stops for the layers
+sequential_stops = [(68, 1, 84), (59, 82, 139), (33, 145, 140), (94, 201, 98), (253, 231, 37)]
+diverging_stops = [(33, 102, 172), (146, 197, 222), (247, 247, 247), (244, 165, 130), (178, 24, 43)]
+cyclic_stops = [(230, 50, 50), (230, 230, 50), (50, 230, 50), (50, 230, 230), (50, 50, 230), (230, 50, 230),
+                (230, 50, 50)]
+
+class flow_snapshot:
+    '''
+    this class is an immutable overview pyramid of one set of assimilation rasters
+    '''
+    def __init__ (self, assimilations, version, tile_size):
+        '''
+        constructor copies the rasters and builds the overviews
+        assimilations = an assimilations object that has been assimilated
+        version = the snapshot version number
+        tile_size = tile size (pixels)
+        '''
+        self.version = version
+        self.tile_size = tile_size
+        base = assimilations.flow_x_mean
+        flow_x = np.array (assimilations.flow_x_mean.ras, dtype = float)
+        flow_y = np.array (assimilations.flow_y_mean.ras, dtype = float)
+
+        # cell centre geometry of the full resolution rasters (row 0 is the top)
+        self.x0 = base.x_index[0]
+        self.y0 = base.y_index[0]
+        self.dx = base.x_index[1] - base.x_index[0] if base.ncols > 1 else abs (base.cell_Width)
+        self.dy = base.y_index[1] - base.y_index[0] if base.nrows > 1 else -abs (base.cell_Height)
+
+        # build the levels from full resolution to a level that fits in one tile
+        levels = [(flow_x, flow_y)]
+        while max (levels[-1][0].shape) > tile_size:
+            levels.append (self.downsample (levels[-1][0], levels[-1][1]))
+        levels.reverse ()                               # zoom 0 is the coarsest
+        self.levels = []
+        for flow_x, flow_y in levels:
+            vel = np.sqrt (flow_x**2.0 + flow_y**2.0)
+            az = (np.arctan2 (flow_x, flow_y) * 180.0 / pi) % 360.0
+            self.levels.append ({'flow_x': flow_x, 'flow_y': flow_y, 'vel': vel, 'az': az})
+        self.max_zoom = len (self.levels) - 1
+
+        # colour ranges are fixed per snapshot, so the tiles match each other
+        full = self.levels[-1]
+        self.vel_max = float (np.nanmax (full['vel'])) if np.any (~np.isnan (full['vel'])) else 1.0
+        self.flow_max = float (np.nanmax (np.absolute (np.concatenate ((full['flow_x'].ravel (),
+                                                                        full['flow_y'].ravel ()))))) \
+                        if np.any (~np.isnan (full['flow_x'])) else 1.0
+        return
+
+    def downsample (self, flow_x, flow_y):
+        '''
+        method to halve the resolution of a pair of rasters by averaging 2 x 2 blocks (ignoring nans)
+        flow_x, flow_y = numpy arrays
+        returns the downsampled flow_x and flow_y
+        '''
+        nrows = flow_x.shape[0] + flow_x.shape[0] % 2
+        ncols = flow_x.shape[1] + flow_x.shape[1] % 2
+        result = []
+        for ras in (flow_x, flow_y):
+            padded = np.zeros ((nrows, ncols)) * np.nan
+            padded[:ras.shape[0], :ras.shape[1]] = ras
+            blocks = padded.reshape (nrows // 2, 2, ncols // 2, 2)
+            valid = ~np.isnan (blocks)
+            count = valid.sum (axis = (1, 3))
+            total = np.where (valid, blocks, 0.0).sum (axis = (1, 3))
+            result.append (np.where (count > 0, total / np.maximum (count, 1), np.nan))
+        return (result[0], result[1])
+
+    def window (self, z, x, y):
+        '''
+        method to return the raster window of a tile
+        z, x, y = the zoom, tile column, and tile row
+        returns the level dictionary and the row and column slices (None if the tile is off the grid)
+        '''
+        if z < 0 or z > self.max_zoom:
+            return (None, None, None)
+        level = self.levels[z]
+        nrows, ncols = level['vel'].shape
+        if x < 0 or y < 0 or x * self.tile_size >= ncols or y * self.tile_size >= nrows:
+            return (None, None, None)
+        rows = slice (y * self.tile_size, min ((y + 1) * self.tile_size, nrows))
+        cols = slice (x * self.tile_size, min ((x + 1) * self.tile_size, ncols))
+        return (level, rows, cols)
+
+    def tile (self, layer, z, x, y):
+        '''
+        method to render a png tile
+        layer = vel, az, flow_x, or flow_y
+        z, x, y = the zoom, tile column, and tile row
+        returns png bytes (None if the tile does not exist)
+        '''
+        level, rows, cols = self.window (z, x, y)
+        if level is None or not layer in level:
+            return (None)
+        values = np.zeros ((self.tile_size, self.tile_size)) * np.nan
+        block = level[layer][rows, cols]
+        values[:block.shape[0], :block.shape[1]] = block
+        if layer == 'vel':
+            rgba = colour_ramp (values, 0.0, self.vel_max, sequential_stops)
+        elif layer == 'az':
+            rgba = colour_ramp (values, 0.0, 360.0, cyclic_stops)
+        else:
+            rgba = colour_ramp (values, -self.flow_max, self.flow_max, diverging_stops)
+        return (encode_png (rgba))
+
+    def arrows (self, z, x, y, scale):
+        '''
+        method to make geojson flow arrows at the cell centres of a tile
+        z, x, y = the zoom, tile column, and tile row
+        scale = arrow length per unit flow velocity (m)
+        returns a geojson feature collection dictionary (None if the tile does not exist)
+        '''
+        level, rows, cols = self.window (z, x, y)
+        if level is None:
+            return (None)
+        factor = 2**(self.max_zoom - z)                 # full resolution cells per cell at this zoom
+        row, col = np.mgrid[rows, cols]
+        cx = self.x0 - self.dx / 2.0 + (col + 0.5) * factor * self.dx
+        cy = self.y0 - self.dy / 2.0 + (row + 0.5) * factor * self.dy
+        flow_x = level['flow_x'][rows, cols]
+        flow_y = level['flow_y'][rows, cols]
+        keep = ~(np.isnan (flow_x) | np.isnan (flow_y))
+        features = []
+        for px, py, fx, fy, vel, az in zip (cx[keep], cy[keep], flow_x[keep], flow_y[keep],
+                                            level['vel'][rows, cols][keep], level['az'][rows, cols][keep]):
+            features.append ({'type': 'Feature',
+                              'geometry': {'type': 'LineString',
+                                           'coordinates': [[float (px), float (py)],
+                                                           [float (px + fx * scale), float (py + fy * scale)]]},
+                              'properties': {'flow_vel': float (vel), 'flow_az': float (az)}})
+        return ({'type': 'FeatureCollection', 'features': features})
+
+    def describe (self):
+        '''
+        method to describe the snapshot
+        returns a dictionary
+        '''
+        full = self.levels[-1]['vel']
+        return ({'version': self.version, 'tile_size': self.tile_size, 'max_zoom': self.max_zoom,
+                 'shape': list (full.shape),
+                 'bounds': [float (self.x0 - self.dx / 2.0), float (self.y0 - self.dy / 2.0 + full.shape[0] * self.dy),
+                            float (self.x0 - self.dx / 2.0 + full.shape[1] * self.dx), float (self.y0 - self.dy / 2.0)],
+                 'vel_max': self.vel_max, 'flow_max': self.flow_max,
+                 'layers': ['vel', 'az', 'flow_x', 'flow_y']})
+
+class threading_http_server (ThreadingMixIn, HTTPServer):
+    '''
+    http server that answers each request in its own thread
+    '''
+    daemon_threads = True
+
+class tile_server:
+    '''
+    this class serves flow tiles and arrows from the latest published snapshot
+    '''
+    def __init__ (self, fl, host = None, port = None):
+        '''
+        constructor
+        fl = a flow object
+        host = the host to serve on (optional, defaults to params.tile_server_host)
+        port = the port to serve on (optional, defaults to params.tile_server_port)
+        '''
+        self.flow = fl
+        self.params = fl.params
+        self.host = self.params.tile_server_host if host is None else host
+        self.port = self.params.tile_server_port if port is None else port
+        self.snapshot = None                            # the present snapshot, swapped whole
+        self.version = 0
+        self.publish_lock = threading.Lock ()
+        self.cache = collections.OrderedDict ()         # (version, path) -> (content type, bytes)
+        self.cache_lock = threading.Lock ()
+        self.server = None
+        self.thread = None
+        return
+
+    def publish (self):
+        '''
+        method to publish the present assimilations as a new snapshot, call this after
+        flow.assimilate (flow.assimilate does this itself when the server is attached as
+        flow.tile_server)
+        '''
+        if not self.flow.assimilations.assimilation_bounds_set:
+            print ('ERROR: there are no assimilations to publish, run assimilate first')
+            return
+        with self.publish_lock:
+            snapshot = flow_snapshot (self.flow.assimilations, self.version + 1, self.params.tile_size)
+            self.version = snapshot.version
+            self.snapshot = snapshot                    # one assignment, so readers see old or new
+        with self.cache_lock:
+            self.cache.clear ()                         # tiles of old snapshots will not be asked for again
+        return
+
+    def respond (self, path):
+        '''
+        method to answer a request path from the latest snapshot, using the tile cache
+        path = the url path
+        returns the http status, content type, and body bytes
+        '''
+        snapshot = self.snapshot
+        if snapshot is None:
+            return (503, 'text/plain', b'no snapshot has been published')
+
+        key = (snapshot.version, path)
+        with self.cache_lock:
+            if key in self.cache:
+                self.cache[key] = self.cache.pop (key)  # move to most recently used
+                return ((200,) + self.cache[key])
+
+        parts = path.strip ('/').split ('/')
+        content = None
+        try:
+            if parts == ['snapshot.json']:
+                content = ('application/json', json.dumps (snapshot.describe ()).encode ('utf-8'))
+            elif len (parts) == 5 and parts[0] == 'tiles' and parts[4].endswith ('.png'):
+                body = snapshot.tile (parts[1], int (parts[2]), int (parts[3]), int (parts[4][:-4]))
+                if not body is None:
+                    content = ('image/png', body)
+            elif len (parts) == 4 and parts[0] == 'arrows' and parts[3].endswith ('.geojson'):
+                arrows = snapshot.arrows (int (parts[1]), int (parts[2]), int (parts[3][:-8]),
+                                          self.params.tile_arrow_scale)
+                if not arrows is None:
+                    content = ('application/geo+json', json.dumps (arrows).encode ('utf-8'))
+        except ValueError:
+            content = None
+        if content is None:
+            return (404, 'text/plain', b'not found')
+
+        with self.cache_lock:
+            self.cache[key] = content
+            while len (self.cache) > self.params.tile_cache_size:
+                self.cache.popitem (last = False)       # drop the least recently used
+        return ((200,) + content)
+
+    def start (self):
+        '''
+        method to start serving in a background thread
+        '''
+        server = self
+
+        class handler (BaseHTTPRequestHandler):
+            def do_GET (self):
+                status, content_type, body = server.respond (self.path.split ('?')[0])
+                self.send_response (status)
+                self.send_header ('Content-Type', content_type)
+                self.send_header ('Content-Length', str(len (body)))
+                self.send_header ('Access-Control-Allow-Origin', '*')
+                self.end_headers ()
+                self.wfile.write (body)
+                return
+
+            def log_message (self, format, *args):
+                return                                  # keep quiet
+
+        self.server = threading_http_server ((self.host, self.port), handler)
+        self.port = self.server.server_address[1]      # in case port 0 picked a free port
+        self.thread = threading.Thread (target = self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start ()
+        print ('serving flow tiles at http://' + self.host + ':' + str(self.port) + '/')
+        return
+
+    def stop (self):
+        '''
+        method to stop serving
+        '''
+        if not self.server is None:
+            self.server.shutdown ()
+            self.server.server_close ()
+            self.server = None
+        return